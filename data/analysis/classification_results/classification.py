@@ -8,7 +8,6 @@ import pandas as pd
 import os
 
 from sklearn.model_selection import StratifiedShuffleSplit
-from sklearn.model_selection import GridSearchCV
 from sklearn.metrics import confusion_matrix
 from sklearn.metrics import roc_curve, auc
 from sklearn.model_selection import train_test_split
@@ -16,19 +15,43 @@ from sklearn.model_selection import train_test_split
 import datetime
 import csv
 
+sys.path.insert(0, os.getcwd() + '/../../../src/util')
+import spectrum_matrix
+import feature_table
+import model_search
+
+# Fixed so that re-runs draw the same splits and hit search_cache/
+SEED = 0
+
 
 class Trainer:
-  def __init__(self):
+  '''
+  seed is the random_state of the validation/test split and of the
+  cross-validation folds of the hyperparameter searches. With the default
+  None, every run draws new splits, so the data hash and every cell key
+  change and cached search cells are never reused: caching needs a fixed
+  seed, which is why the script below passes SEED.
+  '''
+  def __init__(self, seed=None):
+    self.seed = seed
     self.classes = ['Organic acids and derivatives;', 'Lipids and lipid-like molecules;', 'Organoheterocyclic compounds;', 'Organic oxygen compounds;', 'Benzenoids;', 'Nucleosides, nucleotides, and analogues;', 'Carboxylic acids and derivatives;', 'Steroids and steroid derivatives;', 'Organooxygen compounds;', 'Fatty Acyls;', 'Benzene and substituted derivatives;', 'Phenylpropanoids and polyketides;']
     self.subclasses = ['carboxylic acids and derivatives', 'fatty acyls', 'organooxygen compounds', 'amino acids, peptides, and analogues', 'benzene and substituted derivatives', 'imidazopyrimidines', 'fatty acids and conjugates', 'phenols', 'indoles and derivatives', 'carbohydrates and carbohydrate conjugates', 'organonitrogen compounds', 'Fatty acids and conjugates', 'Phenols', 'Indoles and derivatives', 'Carbohydrates and carbohydrate conjugates', 'Organonitrogen compounds']
     main_csv = open(os.getcwd() + '/main.csv', 'w+')
     self.writer = csv.writer(main_csv)
     self.id_counter = 1
+    # Cell scores of the hyperparameter searches, so re-runs skip them
+    self.cache_dir = os.getcwd() + '/search_cache'
     self.writer.writerow(['ID', 'Type', 'C', 'gamma', 'n_estimators', 'max_features', 'min_samples_leaf', 'val accuracy', 'test accuracy', 'classes', 'feature importances', 'feature names'])
 
 
 
   def preprocess(self, path, tax_type):
+    if spectrum_matrix.isSpectrumMatrix(path):
+      self.preprocessMatrix(path, tax_type)
+      return
+    if feature_table.isFeatureTable(path):
+      self.preprocessColumnar(path, tax_type)
+      return
     df = pd.read_table(path)
     df = df.rename(index=str, columns={"class": "_class"})
 
@@ -56,51 +79,112 @@ class Trainer:
       else:
         self.X = df.loc[:, '0':'1980']
       self.Y = df.loc[:, 'kingdom']
+    self.feature_names = self.X.columns.values
+
+
+  '''
+  Same as preprocess(), but for a sparse spectrum matrix written by
+  make_mz_feature_tables.py --format csr. X is kept as a CSR matrix.
+  '''
+  def preprocessMatrix(self, path, tax_type):
+    data = spectrum_matrix.loadSpectrumMatrix(path).selectColumns(0, 1980)
+    if tax_type == 'subclass':
+      label = 'sub_class'
+      data = data.selectRows(np.in1d(data.labels[label], self.subclasses))
+    elif tax_type == 'class':
+      label = 'class'
+      data = data.selectRows(np.in1d(data.labels[label], self.classes))
+    else:
+      label = 'kingdom'
+    self.X = data.matrix
+    self.Y = pd.Series(data.labels[label])
+    self.feature_names = np.array(data.featureNames())
+
+
+  '''
+  Same as preprocess(), but for a columnar feature table written with
+  --format columnar. Only the wanted columns, and the row groups with the
+  wanted labels, are read. X is a float32 array.
+  '''
+  def preprocessColumnar(self, path, tax_type):
+    if 'ms2lda' in path:
+      column_range = ('motif_0-overlap', 'motif_99-prob')
+    else:
+      column_range = (0, 1980)
+    if tax_type == 'subclass':
+      label = 'sub_class'
+      where = {label: self.subclasses}
+    elif tax_type == 'class':
+      label = 'class'
+      where = {label: self.classes}
+    else:
+      label = 'kingdom'
+      where = None
+    data = feature_table.loadFeatureTable(path, column_range=column_range, where=where)
+    self.X = data.X
+    self.Y = pd.Series(data.labels[label])
+    self.feature_names = np.array(data.feature_columns)
 
 
   def partitionData(self):
-    cv = StratifiedShuffleSplit(n_splits=5, test_size=0.2)
+    cv = StratifiedShuffleSplit(n_splits=5, test_size=0.2, random_state=self.seed)
     split = [ _ for _ in cv.split(self.X, self.Y)]
+    val, test = split[0]
 
-    self.X_val = pd.DataFrame(self.X.iloc[[split[0][0][0]]])
-    self.Y_val = list(self.Y.iloc[[split[0][0][0]]])
-    for index in split[0][0][1:]:
-      val_row = self.X.iloc[[index]]
-      self.X_val = self.X_val.append(val_row)
-      val_label = self.Y.iloc[[index]]
-      self.Y_val.append(val_label[0])
-    self.Y_val = pd.DataFrame(self.Y_val)
-
-    self.X_test = pd.DataFrame(self.X.iloc[[split[0][1][0]]])
-    self.Y_test = list(self.Y.iloc[[split[0][1][0]]])
-    for index in split[0][1][1:]:
-      test_row = self.X.iloc[[index]]
-      self.X_test = self.X_test.append(test_row)
-      test_label = self.Y.iloc[[index]]
-      self.Y_test.append(test_label[0])
-    self.Y_test = pd.DataFrame(self.Y_test)
+    if isinstance(self.X, pd.DataFrame):
+      self.X_val = self.X.iloc[val]
+      self.X_test = self.X.iloc[test]
+    else:
+      # CSR matrix or float32 array
+      self.X_val = self.X[val]
+      self.X_test = self.X[test]
+    # One label column (0) for every kind of X
+    self.Y_val = pd.DataFrame(list(self.Y.iloc[val]))
+    self.Y_test = pd.DataFrame(list(self.Y.iloc[test]))
 
 
 
   '''
-  ID#.csv is the cv_results_ dictionary from k-folds validation
-  main.csv records optimal parameters
+  The SVM and RF hyperparameter searches for the current data, as
+  model_search.SearchTasks named name + '/SVM' and name + '/RF'
   '''
-  def tuning(self, tax_type):
-    print 'Tuning SVM'
+  def searchTasks(self, name):
     C_range = np.logspace(-3, 3, 10)
     gamma_range = np.logspace(-9, 3, 10)
     # C_range = [1]
     # gamma_range = [1]
     param_grid = dict(gamma=gamma_range, C=C_range)
-    cv = StratifiedShuffleSplit(n_splits=4, test_size=0.2)
-    grid = GridSearchCV(SVC(kernel='rbf', tol=1e-3, decision_function_shape='ovr'), param_grid=param_grid, cv=cv, return_train_score=True)
+    cv = StratifiedShuffleSplit(n_splits=4, test_size=0.2, random_state=self.seed)
+    svm_task = model_search.SearchTask(name + '/SVM', SVC(kernel='rbf', tol=1e-3, decision_function_shape='ovr'), param_grid, self.X_val, self.Y_val, cv, seed=self.seed)
+
+    max_features = ['auto', 'log2']
+    # max_features = ['auto']
+    min_samples_leaf = [1, 2, 3]
+    # min_samples_leaf = [1]
+    n_estimators = [100, 1000, 5000]
+    # n_estimators = [10]
+    param_grid = dict(max_features=max_features, min_samples_leaf=min_samples_leaf, n_estimators=n_estimators)
+    cv = StratifiedShuffleSplit(n_splits=4, test_size=0.2, random_state=self.seed)
+    rf_task = model_search.SearchTask(name + '/RF', RandomForestClassifier(), param_grid, self.X, self.Y, cv, seed=self.seed)
+    return [svm_task, rf_task]
 
-    grid.fit(self.X_val, self.Y_val)
-    c_opt = grid.best_params_['C']
-    gamma_opt = grid.best_params_['gamma']
-    # score_opt = grid.best_score_
-    pd.DataFrame(grid.cv_results_).to_csv(str(self.id_counter)+'.csv')
+
+  '''
+  ID#.csv is the cv_results_ table from the k-folds validation search
+  main.csv records optimal parameters
+  search_results are from model_search.searchAll() on searchTasks(name); if
+  not given, the search is run here for this data alone
+  '''
+  def tuning(self, tax_type, search_results=None, name=''):
+    if search_results is None:
+      search_results = model_search.searchAll(self.searchTasks(name), cache_dir=self.cache_dir)
+
+    print 'Tuning SVM'
+    search = search_results[name + '/SVM']
+    c_opt = search.best_params['C']
+    gamma_opt = search.best_params['gamma']
+    # score_opt = search.best_score
+    search.cv_results.to_csv(str(self.id_counter)+'.csv')
 
     #retrain on validation data
     clf = SVC(kernel='rbf', tol=1e-3, decision_function_shape='ovr', C=c_opt, gamma=gamma_opt, probability=True)
@@ -151,20 +235,11 @@ class Trainer:
 
 
     print 'Tuning Random Forest'
-    max_features = ['auto', 'log2']
-    # max_features = ['auto']
-    min_samples_leaf = [1, 2, 3]
-    # min_samples_leaf = [1]
-    n_estimators = [100, 1000, 5000]
-    # n_estimators = [10]
-    param_grid = dict(max_features=max_features, min_samples_leaf=min_samples_leaf, n_estimators=n_estimators)
-    cv = StratifiedShuffleSplit(n_splits=4, test_size=0.2)
-    grid = GridSearchCV(RandomForestClassifier(), param_grid=param_grid, cv=cv)
-    grid.fit(self.X, self.Y)
-    max_features_opt = grid.best_params_['max_features']
-    min_samples_leaf_opt = grid.best_params_['min_samples_leaf']
-    n_estimators_opt = grid.best_params_['n_estimators']
-    pd.DataFrame(grid.cv_results_).to_csv(str(self.id_counter)+'.csv')
+    search = search_results[name + '/RF']
+    max_features_opt = search.best_params['max_features']
+    min_samples_leaf_opt = search.best_params['min_samples_leaf']
+    n_estimators_opt = search.best_params['n_estimators']
+    search.cv_results.to_csv(str(self.id_counter)+'.csv')
 
     #retrain on validation data
     clf = RandomForestClassifier(max_features=max_features_opt, min_samples_leaf=min_samples_leaf_opt, n_estimators=n_estimators_opt)
@@ -204,7 +279,7 @@ class Trainer:
 
     # self.AUC(tax_type)
     
-    row = [self.id_counter, 'RF', '', '', n_estimators_opt, max_features_opt, min_samples_leaf_opt, val_score, test_score, str(clf.classes_), str(clf.feature_importances_), self.X.columns.values]
+    row = [self.id_counter, 'RF', '', '', n_estimators_opt, max_features_opt, min_samples_leaf_opt, val_score, test_score, str(clf.classes_), str(clf.feature_importances_), self.feature_names]
     self.writer.writerow(row)
 
     self.id_counter += 1
@@ -248,20 +323,40 @@ class Trainer:
     ms2lda_path = os.getcwd() + '/../../../data/feature_tables/ms2lda_feature_table.merged_spectra.txt'
 
 
+    # Prepare every dataset first, so that all of the hyperparameter
+    # searches run through one process pool
+    runs = []
+    tasks = []
     for path in (binned_path, ms2lda_path):
     # for path in [binned_path]:
       for tax_type in ('kingdom', 'subclass', 'class'):
       # for tax_type in ['subclass']:
-        print 'Running pipeline for data=%s, tax_type=%s' % (['binned data', 'ms2lda data'][[binned_path, ms2lda_path].index(path)], tax_type)
+        data_name = ['binned data', 'ms2lda data'][[binned_path, ms2lda_path].index(path)]
         self.preprocess(path, tax_type)
         self.partitionData()
-        self.tuning(tax_type)
+        name = data_name + '/' + tax_type
+        tasks += self.searchTasks(name)
+        runs.append((name, tax_type, self.dataAttributes()))
+
+    search_results = model_search.searchAll(tasks, cache_dir=self.cache_dir)
+
+    for name, tax_type, data in runs:
+      print 'Running pipeline for data=%s, tax_type=%s' % tuple(name.split('/'))
+      self.__dict__.update(data)
+      self.tuning(tax_type, search_results, name)
+
+
+  '''
+  The data attributes set by preprocess() and partitionData()
+  '''
+  def dataAttributes(self):
+    return dict((k, getattr(self, k)) for k in ('X', 'Y', 'X_val', 'Y_val', 'X_test', 'Y_test', 'feature_names'))
 
 
 
 if __name__ == '__main__':
   start = datetime.datetime.now()
-  trainer = Trainer()
+  trainer = Trainer(seed=SEED)
   trainer.main()
   end = datetime.datetime.now()
   duration = end-start
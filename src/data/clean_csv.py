@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 """
-This script unpacks the CSV that contains the HMDB parsed data and writes a JSON
-file with only the molecules we want to keep.
+This script unpacks the CSV (or spectra store) that contains the HMDB parsed
+data and writes a JSON file with only the molecules we want to keep.
 
 It keeps spectra which have:
 - associated parent mass
@@ -21,6 +21,10 @@ It writes a json file with:
 
 where spec_id is inchikey--MS2_i--ionization (where i is the index of the
 MS2 spectrum, in the original unpacked CSV).
+
+If the output file ends in .jsonl, it is written line-delimited instead, one
+spectrum per line (see src/util/clean_spectra.py), as each metabolite is
+read.
 """
 
 import json
@@ -31,31 +35,30 @@ import os, sys
 src_dir = os.path.normpath('src/util')
 sys.path.insert(0, src_dir)
 import util
+import clean_spectra
 
-p = argparse.ArgumentParser()
-p.add_argument('infile', help='input csv file (to unpack)')
-p.add_argument('outfile', help='json file to write output to')
-p.add_argument('--npeaks', help='min number of peaks in MS2 spectrum. '
-    + '[default: %(default)s]', default=3, type=int)
-args = p.parse_args()
-
-# Read in the csv data
-fname = args.infile
-all_mtabs = util.unpackCSV(fname)
+def clean_metabolite(m, mtab, min_npeaks):
+    """
+    Get the spectra of one metabolite that we want to keep.
 
-all_spectra = {}
-for m in all_mtabs:
-    mtab = all_mtabs[m]
+    Args:
+        m: inchikey of the metabolite
+        mtab: Metabolite object with populated MS2 field
+        min_npeaks: spectra need more than this many peaks to be kept
+    Returns:
+        {spec_id: spectrum} dict, empty if the metabolite is filtered out
+    """
+    spectra = {}
 
     # Only look at metabolites with at least one MS2 spectrum
     n_ms2 = len(mtab.MS2)
     if n_ms2 == 0:
-        continue
+        return spectra
 
     # Keep only metabolites with a parent mass
     parentmass = mtab.monisotopic_molecular_weight
     if parentmass is None:
-        continue
+        return spectra
     else:
         parentmass = float(parentmass)
 
@@ -66,10 +69,10 @@ for m in all_mtabs:
         sub_class = taxonomy_dict['sub_class']
         mclass = taxonomy_dict['class']
     else:
-        continue
+        return spectra
     # Make sure at least one of the taxonomies of interest is not empty str
     if not kingdom and not sub_class and not mclass:
-        continue
+        return spectra
 
     ## Now that we definitely want to keep this metabolite, go through and
     ## get each of its MS2 spectra
@@ -83,19 +86,95 @@ for m in all_mtabs:
         else:
             npeaks = len(peaks)
         ionization = mtab.MS2[i].ionization_mode
-        if ionization is not None and npeaks > args.npeaks:
+        if ionization is not None and npeaks > min_npeaks:
             # Give this spectra unique ID: inchi--MS2_i--ionization_mode
             spec_id = m + '_MS2-' + str(i) + '_' + ionization
 
-            all_spectra[spec_id] = {
+            spectra[spec_id] = {
                 'inchi': m,
                 'parentmass': parentmass,
                 'kingdom': kingdom,
                  'sub_class': sub_class,
                  'class': mclass,
                  'ionization': ionization,
-                 'peaks': peaks
+                 'peaks': peaks.tolist()
                  }
+    return spectra
+
+def stream_spectra(mtabs, outfile, min_npeaks):
+    """
+    Cleans metabolites one at a time and writes the spectra that are kept to
+    outfile as soon as each metabolite is done, so that only one metabolite
+    is ever held in memory. The output is the same json object that
+    json.dump() of the whole dict would give (up to key order).
+
+    Args:
+        mtabs: iterable of Metabolite objects with populated MS2 field
+        outfile: open file to write the json to
+        min_npeaks: spectra need more than this many peaks to be kept
+    Returns:
+        number of spectra written
+    """
+    n_spectra = 0
+    outfile.write('{')
+    for mtab in mtabs:
+        spectra = clean_metabolite(mtab.inchikey, mtab, min_npeaks)
+        for spec_id, spectrum in spectra.iteritems():
+            if n_spectra:
+                outfile.write(', ')
+            outfile.write(json.dumps(spec_id) + ': ' + json.dumps(spectrum))
+            n_spectra += 1
+        if spectra:
+            outfile.flush()
+    outfile.write('}')
+    return n_spectra
+
+def write_spectra_lines(mtabs, outfile, min_npeaks):
+    """
+    Cleans metabolites one at a time and writes the spectra that are kept to
+    a line-delimited spectra file (see src/util/clean_spectra.py).
+
+    Args:
+        mtabs: iterable of Metabolite objects with populated MS2 field
+        outfile: path of the .jsonl file to write
+        min_npeaks: spectra need more than this many peaks to be kept
+    Returns:
+        number of spectra written
+    """
+    with clean_spectra.SpectraWriter(outfile) as writer:
+        for mtab in mtabs:
+            spectra = clean_metabolite(mtab.inchikey, mtab, min_npeaks)
+            writer.writeMany(spectra)
+            if spectra:
+                writer.flush()
+        return writer.count
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('infile', help='input csv file or spectra store (to unpack)')
+    p.add_argument('outfile', help='json (or line-delimited .jsonl) file to '
+        + 'write output to')
+    p.add_argument('--npeaks', help='min number of peaks in MS2 spectrum. '
+        + '[default: %(default)s]', default=3, type=int)
+    p.add_argument('--streaming', help='filter each metabolite as soon as '
+        + 'it is read and write its spectra as they come, instead of '
+        + 'unpacking the whole input first', action='store_true')
+    args = p.parse_args()
+
+    # Read in the csv data
+    fname = args.infile
+    if clean_spectra.isSpectraLines(args.outfile):
+        write_spectra_lines(util.iterMetabolites(fname), args.outfile,
+                            args.npeaks)
+    elif args.streaming:
+        with open(args.outfile, 'w') as f:
+            stream_spectra(util.iterMetabolites(fname), f, args.npeaks)
+    else:
+        all_mtabs = util.loadMetabolites(fname)
+
+        all_spectra = {}
+        for m in all_mtabs:
+            all_spectra.update(clean_metabolite(m, all_mtabs[m], args.npeaks))
 
-with open(args.outfile, 'w') as f:
-    json.dump(all_spectra, f)
+        with open(args.outfile, 'w') as f:
+            json.dump(all_spectra, f)
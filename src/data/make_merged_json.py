@@ -2,59 +2,61 @@
 """
 Convert feature table with merged spectra into a json that can be
 parsed and run through ms2lda
+
+All spectra of a molecule are merged into one (see src/util/spectrum_merge.py).
+If there are duplicate peaks, we'll just pick the one with the highest
+intensity. With --tolerance (or --ppm), peaks that are that close are merged
+too, at their centroid. The output is keyed by inchikey, and is written
+line-delimited if it ends in .jsonl (see src/util/clean_spectra.py).
 """
 
-import pandas as pd
-import json
+import numpy as np
 import argparse
 
-# If there are duplicate peaks, we'll just pick the one with the highest intensity
-def remove_dup_mzs(df):
-    """
-    Remove duplicate mz's in df, keeping only the ones with the highest intensity.
-    """
-    return (df
-        .sort_values(by='intensity', ascending=False)
-        .drop_duplicates(subset=['inchi', 'mz'], keep='first'))
+# User-defined modules
+import os, sys
+src_dir = os.path.normpath('src/util')
+sys.path.insert(0, src_dir)
+import clean_spectra
+import spectrum_merge
+import util
 
 p = argparse.ArgumentParser()
-p.add_argument('injson', help='input json file, with each individual spectrum '
-    + ' as a separate entry.')
+p.add_argument('injson', help='input clean_spectra.jsonl (or .json) file, '
+    + 'with each individual spectrum as a separate entry.')
 p.add_argument('outjson', help='file to write json with merged spectra to')
+p.add_argument('--tolerance', help='merge peaks that are at most this many Da '
+    + 'apart. [default: %(default)s, only merge identical mz\'s]',
+    default=0., type=float)
+p.add_argument('--ppm', help='merge peaks within this many parts per million '
+    + 'instead of --tolerance', default=None, type=float)
+p.add_argument('--reduce', help='intensity of merged peaks: the max or the '
+    + 'sum of theirs. [default: %(default)s]', choices=['max', 'sum'],
+    default='max')
 args = p.parse_args()
 
-# Read in the unconcatenated data
-with open(args.injson, 'r') as f:
-    spectra = json.load(f)
-
-# Make tidy dataframe with spectra-related metadata, mz, intensity
-dflst = []
-
-spec_keys = ['inchi', 'ionization', 'kingdom', 'sub_class',
-             'class', 'parentmass']
-
-for spec_id, spectrum in spectra.iteritems():
-    # Get the spectrum-related metadata
-    spec_metadata = [spectrum[k] for k in spec_keys]
-    # Get the spectra number from the label
-    spec_metadata += [spec_id.split('_')[1].split('-')[1]]
-    # Add each mz, int pair as its own entry
-    dflst += [spec_metadata + [p[0], p[1]] for p in spectrum['peaks']]
-df = pd.DataFrame(dflst, columns=spec_keys + ['scan_id', 'mz', 'intensity'])
+# Read in the unconcatenated data, as flat peak arrays
+spec_ids, metadata, mz, intensity, offsets = util.flattenSpectra(
+    clean_spectra.iterSpectra(args.injson, arrays=True))
 
-# Remove duplicate mz's
-df = remove_dup_mzs(df)
+# Merge the spectra of each molecule, removing duplicate mz's
+inchis, first_spectrum, mz, intensity, offsets = \
+    spectrum_merge.mergeMolecules(metadata['inchi'], mz, intensity, offsets,
+                                  args.reduce, args.tolerance, args.ppm)
 
 # Now convert back to json
+peaks = np.column_stack([mz, intensity]).tolist()
 spec_dict = {}
-for g, subdf in df.groupby('inchi'):
-    spec_dict.update({g: {
-        'parentmass': subdf['parentmass'].iloc[0],
-        'kingdom': subdf['kingdom'].iloc[0],
-        'class': subdf['class'].iloc[0],
-        'sub_class': subdf['sub_class'].iloc[0],
-        'peaks': [(i, j) for i, j in zip(subdf['mz'], subdf['intensity'])]
-    }})
-
-with open(args.outjson, 'w') as f:
-    json.dump(spec_dict, f)
+for i, inchi in enumerate(inchis):
+    if offsets[i] == offsets[i + 1]:
+        continue
+    j = first_spectrum[i]
+    spec_dict[unicode(inchi)] = {
+        'parentmass': metadata['parentmass'][j],
+        'kingdom': metadata['kingdom'][j],
+        'class': metadata['class'][j],
+        'sub_class': metadata['sub_class'][j],
+        'peaks': peaks[offsets[i]:offsets[i + 1]]
+    }
+
+clean_spectra.writeSpectra(spec_dict, args.outjson)
@@ -1,95 +1,159 @@
 #!/usr/bin/env python
 """
 Make binned mz feature tables
+
+All tables (raw and integer mz x positive, negative and all_scans) are built
+from one PeakTable (see src/util/spectrum_matrix.py): the spectra are read
+and their peaks sorted and binned once, and each table is then a single scan
+over the shared arrays. The tables are written by a pool of worker
+processes.
+
+With --neutral-losses, each table also gets a block of neutral loss columns
+(parentmass - mz, binned to integers, named loss_<mass>) after its mz
+columns.
 """
+import multiprocessing
+
+import numpy as np
 import pandas as pd
-import json
-import copy
 import argparse
 import os
 
-def remove_dup_mzs(df):
-    """
-    Remove duplicate mz's in df, keeping only the ones with the highest intensity.
-    """
-    return (df
-        .sort_values(by='intensity', ascending=False)
-        .drop_duplicates(subset=['inchi', 'mz'], keep='first'))
-
-def pivot_and_add_labels(df):
+# User-defined modules
+import sys
+src_dir = os.path.normpath('src/util')
+sys.path.insert(0, src_dir)
+import feature_table
+import peak_filters
+import spectrum_matrix
+
+# Tables that get written, as (ionization, scans) x (strategy, prefix)
+IONIZATIONS = [('Positive', 'positive'), ('Negative', 'negative'),
+               (None, 'all_scans')]
+STRATEGIES = [('raw', 'raw_mz'), ('integer', 'mz_integer')]
+LABELS = ['inchi', 'kingdom', 'sub_class', 'class']
+
+def wide_table(matrix, strategy):
     """
-    Pivot a dataframe on mz and inchi (values=intensity) and add
-    taxonomy labels.
+    Convert a SpectrumMatrix into a wide dataframe, with one column per mz
+    (only those with a peak) and the taxonomy labels, as pivoting the tidy
+    peaks on inchi and mz would.
     """
-    widedf = df.pivot(index='inchi', columns='mz', values='intensity')
-    widedf = widedf.fillna(0.0)
-    widedf = pd.merge(
-        widedf,
-        df[['inchi', 'kingdom', 'sub_class', 'class']].drop_duplicates(),
-        left_index=True,
-        right_on='inchi',
-        how='left')
+    used = np.unique(matrix.matrix.indices)
+    columns = np.asarray(matrix.columns)[used]
+    if strategy == 'integer':
+        columns = columns.astype(np.int64)
+    if matrix.channels is not None:
+        names = np.array(matrix.featureNames(), dtype=object)[used]
+        losses = np.asarray(matrix.channels)[used] == 'loss'
+        columns = columns.astype(object)
+        columns[losses] = names[losses]
+    widedf = pd.DataFrame(matrix.matrix[:, used].toarray(), columns=columns)
+    for label in LABELS:
+        widedf[label] = matrix.labels[label]
     return widedf
 
-p = argparse.ArgumentParser()
-p.add_argument('infile', help='input json file with all spectra')
-p.add_argument('outdir', help='directory to save feat tables in')
-args = p.parse_args()
-
-with open(args.infile, 'r') as f:
-    all_spectra = json.load(f)
-
-# Make tidy dataframe with spectra-related metadata, mz, intensity
-dflst = []
-
-spec_keys = ['inchi', 'ionization', 'kingdom', 'sub_class',
-             'class', 'parentmass']
-
-for spec_id, spectrum in all_spectra.iteritems():
-    # Get the spectrum-related metadata
-    spec_metadata = [spectrum[k] for k in spec_keys]
-    # Get the spectra number from the label
-    spec_metadata += [spec_id.split('_')[1].split('-')[1]]
-    # Add each mz, int pair as its own entry
-    dflst += [spec_metadata + [p[0], p[1]] for p in spectrum['peaks']]
-df = pd.DataFrame(dflst, columns=spec_keys + ['scan_id', 'mz', 'intensity'])
-
-# Subset by ionization mode
-pos = df.query('ionization == "Positive"')
-neg = df.query('ionization == "Negative"')
-# and df has all of the scans, including the ones labeled N/A
+# Peak table and options shared with the worker processes, set once per
+# worker by _init_table_worker()
+_worker_table = None
+_worker_options = None
 
-# Remove duplicate mz's and merge all scans per molecule
-pos = remove_dup_mzs(pos)
-neg = remove_dup_mzs(neg)
-both = remove_dup_mzs(df)
+def _init_table_worker(table, options):
+    global _worker_table, _worker_options
+    _worker_table = table
+    _worker_options = options
 
-# Convert to wideform and save to disk
-widepos = pivot_and_add_labels(pos)
-fname = os.path.join(args.outdir, 'raw_mz.positive.txt')
-widepos.to_csv(fname, sep='\t', index=False)
-
-wideneg = pivot_and_add_labels(neg)
-fname = os.path.join(args.outdir, 'raw_mz.negative.txt')
-wideneg.to_csv(fname, sep='\t', index=False)
-
-wideboth = pivot_and_add_labels(both)
-fname = os.path.join(args.outdir, 'raw_mz.all_scans.txt')
-wideboth.to_csv(fname, sep='\t', index=False)
-
-### mz's rounded to the nearest integer
-def round_and_save(df, fname):
-    df = copy.deepcopy(df)
-    df['mz'] = df['mz'].astype(int)
-    df = remove_dup_mzs(df)
-    widedf = pivot_and_add_labels(df)
-    widedf.to_csv(fname, sep='\t', index=False)
-
-fname = os.path.join(args.outdir, 'mz_integer.positive.txt')
-round_and_save(pos, fname)
-
-fname = os.path.join(args.outdir, 'mz_integer.negative.txt')
-round_and_save(neg, fname)
-
-fname = os.path.join(args.outdir, 'mz_integer.all_scans.txt')
-round_and_save(both, fname)
+def _write_table(job):
+    """
+    Worker function: builds one table from the shared peak table and writes
+    it to disk.
+    """
+    (ionization, scans), (strategy, prefix) = job
+    outdir, fmt, tolerance, ppm, reduce, neutral_losses = _worker_options
+    params = {}
+    if strategy == 'raw':
+        # Peaks are only merged within a tolerance for the raw tables
+        params = {'tolerance': tolerance, 'tolerance_ppm': ppm,
+                  'reduce': reduce}
+    matrix = _worker_table.matrix(ionization, strategy, **params)
+    if neutral_losses:
+        losses = _worker_table.matrix(ionization, 'integer', channel='loss')
+        matrix = spectrum_matrix.concatenateChannels(
+            [('fragment', matrix), ('loss', losses)])
+    fname = os.path.join(outdir, prefix + '.' + scans + '.' + fmt)
+    if fmt == 'csr':
+        matrix.save(fname)
+    elif fmt == 'columnar':
+        feature_table.writeSpectrumMatrix(matrix, fname)
+    else:
+        wide_table(matrix, strategy).to_csv(fname, sep='\t', index=False)
+    return fname
+
+def write_tables(all_spectra, outdir, fmt='txt', tolerance=0., ppm=None,
+                 reduce='max', processes=None, neutral_losses=False):
+    """
+    Write the raw and integer mz feature tables, as wide tab-separated text
+    files, as sparse CSR matrices (see src/util/spectrum_matrix.py) or as
+    columnar float32 tables (see src/util/feature_table.py), named like the
+    text tables but with a .csr or .columnar extension.
+
+    Args:
+        all_spectra: {spec_id: spectrum} dictionary or iterable of (spec_id,
+            spectrum) pairs, e.g. from peak_filters.iterFilteredSpectra()
+        outdir: directory to save the tables in
+        fmt: 'txt', 'csr' or 'columnar'
+        tolerance, ppm, reduce: merge the peaks of each molecule that are
+            within this many Da (or ppm) into one raw mz column, keeping the
+            'max' or 'sum' of their intensities (see
+            src/util/spectrum_merge.py)
+        processes: number of worker processes [default: number of cores]
+        neutral_losses: add a block of integer neutral loss columns to each
+            table
+    """
+    table = spectrum_matrix.PeakTable(all_spectra)
+    options = (outdir, fmt, tolerance, ppm, reduce, neutral_losses)
+    jobs = [(ionization, strategy) for ionization in IONIZATIONS
+            for strategy in STRATEGIES]
+    if processes == 1:
+        _init_table_worker(table, options)
+        fnames = [_write_table(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_init_table_worker,
+                                    initargs=(table, options))
+        try:
+            fnames = pool.map(_write_table, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    return fnames
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('infile', help='input clean_spectra.jsonl (or .json) file '
+        + 'with all spectra')
+    p.add_argument('outdir', help='directory to save feat tables in')
+    p.add_argument('--format', help='output format: wide tab-separated text '
+        + 'tables, sparse CSR matrices, or compressed columnar tables that '
+        + 'load quickly for training. [default: %(default)s]',
+        choices=['txt', 'csr', 'columnar'], default='txt')
+    p.add_argument('--tolerance', help='merge peaks of a molecule that are '
+        + 'at most this many Da apart into one raw mz column. '
+        + '[default: %(default)s, only merge identical mz\'s]', default=0.,
+        type=float)
+    p.add_argument('--ppm', help='merge peaks within this many parts per '
+        + 'million instead of --tolerance', default=None, type=float)
+    p.add_argument('--reduce', help='intensity of merged peaks: the max or '
+        + 'the sum of theirs. [default: %(default)s]', choices=['max', 'sum'],
+        default='max')
+    p.add_argument('--processes', help='number of worker processes writing '
+        + 'the tables. [default: number of cores]', default=None, type=int)
+    p.add_argument('--neutral-losses', help='also bin the neutral losses '
+        + '(parentmass - mz) of the peaks to integers, as loss_<mass> '
+        + 'columns after the mz columns', action='store_true')
+    peak_filters.addFilterArguments(p)
+    args = p.parse_args()
+
+    write_tables(peak_filters.iterFilteredSpectra(
+                     args.infile, **peak_filters.filterArguments(args)),
+                 args.outdir, args.format, args.tolerance, args.ppm,
+                 args.reduce, args.processes, args.neutral_losses)
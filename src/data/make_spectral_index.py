@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+"""
+Build the spectral library index (see src/util/spectral_index.py) from
+clean_spectra.jsonl, for nearest-neighbour spectrum queries and kNN taxonomy
+prediction.
+"""
+import argparse
+
+# User-defined modules
+import os, sys
+src_dir = os.path.normpath('src/util')
+sys.path.insert(0, src_dir)
+import peak_filters
+import spectral_index
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('infile', help='input clean_spectra.jsonl (or .json) file '
+        + 'with all spectra')
+    p.add_argument('outdir', help='directory to save the index in')
+    p.add_argument('--bin-width', help='width of the m/z bins in Da. '
+        + '[default: %(default)s]', default=0.01, type=float)
+    p.add_argument('--intensity-power', help='intensities are raised to '
+        + 'this power before normalising. [default: %(default)s]',
+        default=0.5, type=float)
+    peak_filters.addFilterArguments(p)
+    args = p.parse_args()
+
+    all_spectra = dict(peak_filters.iterFilteredSpectra(
+        args.infile, **peak_filters.filterArguments(args)))
+
+    index = spectral_index.buildSpectralIndex(
+        all_spectra, bin_width=args.bin_width,
+        intensity_power=args.intensity_power)
+    index.save(args.outdir)
+    print('Indexed {} spectra in {} bins'.format(
+        len(index), index.vectors.shape[1]))
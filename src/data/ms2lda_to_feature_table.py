@@ -4,30 +4,37 @@ Convert tidy ms2lda results into wide dataframe for use with classifiers.
 """
 
 import pandas as pd
-import json
 import argparse
 
+# User-defined modules
+import os, sys
+src_dir = os.path.normpath('src/util')
+sys.path.insert(0, src_dir)
+import clean_spectra
+import feature_table
+
 p = argparse.ArgumentParser()
 p.add_argument('ms2lda_results', help='output from run_ms2lda.py')
-p.add_argument('in_json', help='path to json that was used to make ms2lda '
-    + 'results. The important thing is that the keys here match what is in '
+p.add_argument('in_json', help='path to json (or clean_spectra.jsonl) that '
+    + 'was used to make ms2lda results. The important thing is that the keys here match what is in '
     + 'the "spec" column of the ms2lda_results file, and that they have '
     + '"kingdom", "class", and "sub_class" entries.')
 p.add_argument('out_table', help='path to output feature table')
+p.add_argument('--format', help='output format: a wide tab-separated text '
+    + 'table, or a compressed columnar table (a directory, see '
+    + 'src/util/feature_table.py). [default: %(default)s]',
+    choices=['txt', 'columnar'], default='txt')
 args = p.parse_args()
 
-# Read in json with metadata
-with open(args.in_json, 'r') as f:
-    spectra = json.load(f)
-
-# Convert json to dataframe for later merging
+# Read in the spectra metadata, one spectrum at a time, and convert it to a
+# dataframe for later merging
 spec_lst = []
-for s in spectra:
+for s, spectrum in clean_spectra.iterSpectra(args.in_json):
     spec_lst.append(
         [s,
-         spectra[s]['kingdom'],
-         spectra[s]['class'],
-         spectra[s]['sub_class']]
+         spectrum['kingdom'],
+         spectrum['class'],
+         spectrum['sub_class']]
     )
 spec_df = pd.DataFrame(spec_lst,
     columns=['spec', 'kingdom', 'class', 'sub_class'])
@@ -48,4 +55,8 @@ wideres = wideres.fillna(0)
 wideres = pd.merge(spec_df, wideres, left_on='spec', right_index=True)
 
 # Write to file
-wideres.to_csv(args.out_table, sep='\t', index=False)
+if args.format == 'columnar':
+    feature_table.writeDataFrame(wideres, args.out_table,
+        ['spec', 'kingdom', 'class', 'sub_class'])
+else:
+    wideres.to_csv(args.out_table, sep='\t', index=False)
@@ -7,14 +7,14 @@ and writes them to a csv.
 import sys
 sys.path.insert(0, '/Library/Frameworks/Python.framework/Versions/2.7/lib/python2.7/site-packages')
 
-try:
-    import xml.etree.cElementTree as ET
-except ImportError:
-    import xml.etree.ElementTree as ET
 import numpy as np
 import csv
 from unidecode import unidecode
 import argparse
+import fnmatch
+import itertools
+import multiprocessing
+import zipfile
 
 # Assuming that you're calling this script from the top directory in the repo,
 # as the Makefile does, these statements add src/util to the path so we
@@ -23,18 +23,158 @@ import os
 import sys
 src_dir = os.path.normpath(os.path.join(os.getcwd(), 'src/util'))
 sys.path.insert(0, src_dir)
-from MetabolomicsObjects import Metabolite, MS2, MSPeak
+from MetabolomicsObjects import Metabolite, MS2, peakArray
+from xml_projection import Projection, Rule, iterRecords, iterRecordRange, \
+  loadOffsetIndex, UnscannableXMLError, TEXT, ID, LIST, DICT, NESTED_DICT, \
+  COLUMNS, REJECT
+from spectra_store import writeSpectraStore
+from metabolite_index import MetaboliteIndex, SpillFile, MATCH_KINDS
+
+# Features kept from the MS2 and metabolite xml files
+MS2_FEATURE_SET = set(
+  ['inchi_key', 'frequency', 'instrument_type', 'id', 'energy_field',
+   'base_peak', 'sample_mass_units', 'chromatography_type', 'searchable',
+   'sample_mass', 'derivative_mw', 'retention_time', 'updated_at',
+   'sample_assessment', 'derivative_formula', 'derivative_type',
+   'database_id', 'ref_text', 'mass_charge', 'collision_energy_voltage',
+   'sample_concentration', 'spectra_assessment', 'solvent', 'nucleus_y',
+   'ionization_mode', 'collection_date', 'nucleus',
+   'sample_temperature_units', 'sample_ph', 'spectra_id', 'c_ms_id',
+   'sample_concentration_units', 'sample_source', 'nil_classes', 'nucleus_x',
+   'database', 'notes', 'created_at', 'sample_temperature', 'ri_type',
+   'pubmed_id', 'molecule_id', 'column_type', 'retention_index',
+   'collision_energy_level', 'references', 'name', 'accession',
+   'chemical_formula', 'monoisotopic_molecular_weight', 'iupac_name',
+   'traditional_iupac', 'cas_registry', 'smiles', 'inchi', 'inchikey',
+   'taxonomy', 'biofluid_locations', 'ids', 'peak_counter', 'mono_mass',
+   'ms_ms_id', 'spectra_type'])
+
+METABOLITE_FEATURE_SET = set(['accession', 'secondary_accessions', 'name',
+                'chemical_formula',
+                'monisotopic_molecular_weight', 'iupac_name',
+                'traditional_iupac', 'cas_registry_number',
+                'smiles', 'inchi', 'inchikey',
+                'biofluid_locations', 'taxonomy'])
+
+# The only features used downstream of the parse (by clean_csv.py), plus
+# the accessions needed to match spectra to metabolites; see --core-fields
+CORE_METABOLITE_FEATURE_SET = set(['inchikey', 'monisotopic_molecular_weight',
+                                   'taxonomy', 'accession',
+                                   'secondary_accessions'])
+CORE_MS2_FEATURE_SET = set(['inchi_key', 'ionization_mode'])
 
 def parse_args():
     p = argparse.ArgumentParser()
     p.add_argument('ms2_concat', help='path to file with all MS2s '
-        + 'concatenated into one xml file.')
+        + 'concatenated into one xml file, or to a directory or zip file '
+        + '(e.g. hmdb_spectra_xml.zip) of per-spectrum xml files.')
     p.add_argument('metabolites_info', help='path to file with all '
-        + 'HMDB metabolites in one xml file.')
-    p.add_argument('out', help='path to write output csv file to.')
+        + 'HMDB metabolites in one xml file, or to the zip file it comes in '
+        + '(hmdb_metabolites.zip). Only the extracted xml file is parsed in '
+        + 'parallel.')
+    p.add_argument('out', help='path to write output csv file (or spectra '
+        + 'store directory) to.')
+    p.add_argument('--format', help='output format. "store" writes the '
+        + 'binary columnar spectra store (see src/util/spectra_store.py). '
+        + '[default: %(default)s]', choices=['csv', 'store'], default='csv')
+    p.add_argument('--core-fields', action='store_true', help='only parse '
+        + 'the fields used downstream (inchikey, parent mass, taxonomy, '
+        + 'ionization mode and peaks) and the HMDB accessions, and no other '
+        + 'IDs.')
+    p.add_argument('--unmatched', help='path of a json-lines file to write '
+        + 'the spectra without a matching metabolite to. [default: only '
+        + 'count them]', default=None)
+    p.add_argument('--processes', help='number of worker processes to use '
+        + 'when reading the metabolites xml file, and per-spectrum xml files '
+        + 'from a directory or zip file. [default: number of cores]',
+        default=None, type=int)
     return p.parse_args()
 
-def metabolitePreprocessing(xml_file, metabolite_feature_set):
+def metaboliteProjection(metabolite_feature_set, ids=True):
+    '''
+    Projection of the <metabolite> records onto the desired features. See
+    metabolitePreprocessing() for the attributes populated, and
+    src/util/xml_projection.py for how the projection is applied.
+
+    Args:
+        metabolite_feature_set: set of desired metabolite features
+        ids: also collect the IDs (features with _id in the name) in id_dict
+    Returns:
+        xml_projection.Projection creating Metabolite objects
+    '''
+    def newMetabolite():
+        metabolite = Metabolite()
+        metabolite.id_dict = dict()
+        return metabolite
+
+    def taxonomyKey(tag):
+        if tag != 'substituents' and 'parent' not in tag:
+            return tag
+        return None
+
+    def ruleFor(tag):
+        #filter out unwanted metadata
+        if not (tag in metabolite_feature_set or (ids and '_id' in tag)):
+            return None
+        #collect secondary accessions and biofluid locations in lists
+        if tag in ('secondary_accessions', 'biofluid_locations'):
+            return Rule(LIST, tag)
+        #collect all ID's in a dictionary
+        elif '_id' in tag:
+            return Rule(ID, 'id_dict', key=tag)
+        #collect taxonomy metadata in dictionary
+        elif tag == 'taxonomy':
+            return Rule(DICT, 'taxonomy_dict', key=taxonomyKey)
+        #collect miscellaneous, desireable attributes
+        elif 'inchi' in tag and 'key' in tag:
+            return Rule(TEXT, [('inchikey', None), ('inchi_key', None)])
+        return Rule(TEXT, [(tag, None)])
+
+    return Projection('metabolite', newMetabolite, ruleFor)
+
+def openXMLFile(xml_file):
+    '''
+    Opens an xml file for reading. If xml_file is a zip archive holding a
+    single xml file (e.g. hmdb_metabolites.zip), that member is opened
+    instead and decompressed as it is read, without extracting it.
+
+    Args:
+        xml_file: path to an xml file, or to a zip file of one xml file
+    Returns:
+        file object
+    '''
+    if not zipfile.is_zipfile(xml_file):
+        return open(xml_file, 'rb')
+    with zipfile.ZipFile(xml_file) as archive:
+        names = [name for name in archive.namelist()
+                 if name.lower().endswith('.xml')]
+        if len(names) != 1:
+            raise ValueError('Expected one xml file in {}, found {}'.format(
+                xml_file, len(names)))
+        # The member keeps its own handle on the zip file, so the archive
+        # itself can be closed
+        return archive.open(names[0])
+
+def iterMetabolites(xml_file, metabolite_feature_set, ids=True):
+    '''
+    Streaming version of metabolitePreprocessing(): yields one Metabolite at a
+    time, discarding the underlying xml as it goes.
+
+    Args:
+        xml_file: path to metabolite metadata xml_file (or to the zip file
+            it is packed in, see openXMLFile())
+        metabolite_feature_set: set of desired metabolite features
+        ids: also collect the IDs in id_dict
+    Yields:
+        Metabolite objects, in document order
+    '''
+    projection = metaboliteProjection(metabolite_feature_set, ids)
+    with openXMLFile(xml_file) as f:
+        for metabolite in iterRecords(f, projection,
+                                      reopen=lambda: openXMLFile(xml_file)):
+            yield metabolite
+
+def metabolitePreprocessing(xml_file, metabolite_feature_set, ids=True):
     '''
     Reads in metabolite metadata xml file and generates Metabolite objects. All
         Metabolite objects have intentionally unpopulated MS2 fields.
@@ -50,66 +190,200 @@ def metabolitePreprocessing(xml_file, metabolite_feature_set):
       - taxonomy, except substitutents, parents, and alternative parents
       - biofluid locations
       - IDs (features with _id in the name or "id" as the name)
+    Only features in metabolite_feature_set are populated; the xml of the
+    others (descriptions, pathways, proteins, ...) is skipped without being
+    parsed.
 
     Args:
-        xml_file: path to metabolite metadata xml_file
+        xml_file: path to metabolite metadata xml_file (or to the zip file
+            it is packed in, see openXMLFile())
+        ids: also collect the IDs in id_dict
     Returns:
         Populated dictionary in the format of {inchikey:Metabolite}
     '''
-    print 'Generating Metabolite XML Tree...'
-    tree = ET.parse(xml_file)
-    print 'Done. \nPreprocessing Metabolite Data...'
-    root = tree.getroot()
+    print 'Streaming Metabolite XML...'
     metabolite_dict = dict()
-    for metabolite_tag in root:
-        metabolite = Metabolite()
-        id_dict = dict()
-        #xml_object = highest level tag within <c-ms> tag
-        for xml_object in metabolite_tag:
-            clean_tag = xml_object.tag.replace('{http://www.hmdb.ca}', '')
-            #filter out unwanted metadata
-            if not (clean_tag in metabolite_feature_set or '_id' in clean_tag):
-                continue
-            #collect secondary accessions in list
-            if clean_tag == 'secondary_accessions':
-                secondary_accessions = []
-                for accessions_object in xml_object:
-                    secondary_accessions.append(accessions_object.text)
-                metabolite.secondary_accessions = secondary_accessions
-            #collect biofluid locations in list
-            elif clean_tag == 'biofluid_locations':
-                locations = []
-                for location_object in xml_object:
-                    locations.append(location_object.text)
-                metabolite.biofluid_locations = locations
-
-            #collect all ID's in a dictionary
-            elif '_id' in clean_tag:
-                id_dict[clean_tag] = xml_object.text
-
-            #collect taxonomy metadata in dictionary
-            elif clean_tag == 'taxonomy':
-                taxonomy_dict = dict()
-                for taxonomy_object in xml_object:
-                    clean_taxonomy_tag = taxonomy_object.tag.replace('{http://www.hmdb.ca}', '')
-                    if clean_taxonomy_tag != 'substituents' and 'parent' not in clean_taxonomy_tag:
-                        taxonomy_dict[clean_taxonomy_tag] = taxonomy_object.text
-                metabolite.taxonomy_dict = taxonomy_dict
-
-            #collect miscellaneous, desireable attributes
-            else:
-                if 'inchi' in clean_tag and 'key' in clean_tag:
-                    setattr(metabolite, 'inchikey', xml_object.text)
-                    setattr(metabolite, 'inchi_key', xml_object.text)
-                else:
-                    setattr(metabolite, clean_tag, xml_object.text)
+    for metabolite in iterMetabolites(xml_file, metabolite_feature_set, ids):
+        metabolite_dict[metabolite.inchikey] = metabolite
+    print 'Done.'
+    return metabolite_dict
+
+# Per-process state for the workers in iterMetabolitesParallel(), set up once
+# per worker by _initMetaboliteWorker()
+_worker_metabolite_file = None
+_worker_metabolite_projection = None
+_worker_namespaces = ''
+
+def _initMetaboliteWorker(xml_file, metabolite_feature_set, ids, namespaces):
+    global _worker_metabolite_file, _worker_metabolite_projection, \
+        _worker_namespaces
+    # Each worker seeks around its own handle on the file
+    _worker_metabolite_file = open(xml_file, 'rb')
+    _worker_metabolite_projection = metaboliteProjection(
+        metabolite_feature_set, ids)
+    _worker_namespaces = namespaces
+
+def _parseMetaboliteShard(offsets):
+    '''
+    Worker function: parses the metabolites at the given byte offsets of the
+    metabolites xml file.
+    '''
+    return list(iterRecordRange(_worker_metabolite_file, offsets,
+                                _worker_metabolite_projection,
+                                _worker_namespaces))
+
+def iterMetabolitesParallel(xml_file, metabolite_feature_set, processes=None,
+                            shard_size=500, ids=True):
+    '''
+    Parallel version of iterMetabolites(). The metabolites xml file is
+    scanned once for the byte offsets of the <metabolite> records, which are
+    saved next to it (see xml_projection.loadOffsetIndex()) and reused by
+    later runs, and shards of consecutive records are then parsed across a
+    pool of worker processes.
+
+    A zipped metabolites file can't be read at random offsets, and the
+    offsets of xml that the byte scanner can't handle (see
+    xml_projection.UnscannableXMLError) can't be found, so those are
+    streamed through iterMetabolites() instead, with a message saying so.
+    Extract a zipped file first (as the Makefile does) to parse it in
+    parallel.
+
+    Args:
+        xml_file: path to metabolite metadata xml_file
+        metabolite_feature_set: set of desired metabolite features
+        processes: number of worker processes [default: number of cores]
+        shard_size: number of metabolites handed to a worker at a time
+        ids: also collect the IDs in id_dict
+    Yields:
+        Metabolite objects, in document order
+    '''
+    if zipfile.is_zipfile(xml_file):
+        print "Can't index the zipped {}, parsing it serially".format(xml_file)
+        for metabolite in iterMetabolites(xml_file, metabolite_feature_set,
+                                          ids):
+            yield metabolite
+        return
+    try:
+        offsets, namespaces = loadOffsetIndex(xml_file, 'metabolite')
+    except UnscannableXMLError as e:
+        print "Can't index {} ({}), parsing it serially".format(xml_file, e)
+        for metabolite in iterMetabolites(xml_file, metabolite_feature_set,
+                                          ids):
+            yield metabolite
+        return
+    shards = [offsets[i:i + shard_size]
+              for i in range(0, len(offsets), shard_size)]
+    pool = multiprocessing.Pool(
+        processes, initializer=_initMetaboliteWorker,
+        initargs=(xml_file, metabolite_feature_set, ids, namespaces))
+    try:
+        # imap keeps the metabolites in document order, so that duplicate
+        # inchikeys resolve the same way as in iterMetabolites()
+        for metabolites in pool.imap(_parseMetaboliteShard, shards):
+            for metabolite in metabolites:
+                yield metabolite
+    finally:
+        pool.close()
+        pool.join()
+
+def metaboliteParallelPreprocessing(xml_file, metabolite_feature_set,
+                                    processes=None, shard_size=500, ids=True):
+    '''
+    Same as metabolitePreprocessing(), but parses the metabolites across a
+    pool of worker processes (see iterMetabolitesParallel()).
 
-        metabolite.id_dict = id_dict
+    Args:
+        xml_file: path to metabolite metadata xml_file
+        metabolite_feature_set: set of desired metabolite features
+        processes: number of worker processes [default: number of cores]
+        shard_size: number of metabolites handed to a worker at a time
+        ids: also collect the IDs in id_dict
+    Returns:
+        Populated dictionary in the format of {inchikey:Metabolite}
+    '''
+    print 'Parsing Metabolite XML in parallel...'
+    metabolite_dict = dict()
+    for metabolite in iterMetabolitesParallel(
+            xml_file, metabolite_feature_set, processes, shard_size, ids):
         metabolite_dict[metabolite.inchikey] = metabolite
     print 'Done.'
     return metabolite_dict
 
-def MS2Preprocessing(xml_file, feature_set, metabolite_dict):
+def ms2Projection(feature_set, ids=True):
+  '''
+  Projection of the <ms-ms> spectra onto the desired features. See
+  MS2Preprocessing() for the attributes populated, and
+  src/util/xml_projection.py for how the projection is applied.
+
+  Args:
+    feature_set: hash set of desired features with which to populate MS2
+      object fields (with '_' in place of '-'), or None for all features
+    ids: also collect the IDs in id_dict
+  Returns:
+    xml_projection.Projection creating MS2 objects
+  '''
+  def newMS2():
+    ms2_object = MS2()
+    ms2_object.id_dict = dict()
+    return ms2_object
+
+  def fieldName(tag):
+    return tag.replace('-', '_')
+
+  def ruleFor(tag):
+    attribute = fieldName(tag)
+    #filter out non-ms-ms data
+    if 'peaks' in tag and tag != 'ms-ms-peaks':
+      return Rule(REJECT)
+    #collect all id data in dictionary
+    if '_id' in tag or tag == 'id' or '-id' in tag:
+      if ids:
+        return Rule(ID, 'id_dict', key=attribute)
+      #the HMDB accession is still needed to match spectra to metabolites
+      if tag == 'database-id':
+        return Rule(TEXT, [(attribute, None)])
+      return None
+    #decode peak data straight into [mz, intensity] (and peak id) arrays
+    elif tag == 'ms-ms-peaks':
+      columns = [('peaks', ('mass_charge', 'intensity'), np.float64)]
+      if ids:
+        columns.append(('peak_ids', ('id',), np.int64))
+      return Rule(COLUMNS, columns, key=fieldName, empty=-1)
+    #filter out unwanted metadata
+    elif feature_set is not None and attribute not in feature_set:
+      return None
+    #collect references data in dictionary
+    elif tag == 'references':
+      return Rule(NESTED_DICT, 'references_dict', key=fieldName, empty='')
+    #collect other data attributes of interest
+    elif 'inchi' in tag and 'key' in tag:
+      return Rule(TEXT, [(attribute, ''), ('inchikey', None),
+                         ('inchi_key', None)])
+    return Rule(TEXT, [(attribute, '')])
+
+  # The per-spectrum files are small; skipping children while converting is
+  # cheaper than cutting them out of the raw bytes first
+  return Projection('ms-ms', newMS2, ruleFor, prune=False)
+
+def iterMS2s(xml_file, feature_set, ids=True):
+  '''
+  Streaming version of the parsing half of MS2Preprocessing(): yields one MS2
+  at a time, discarding the underlying xml as it goes. Non-ms-ms spectra are
+  skipped.
+
+  Args:
+    xml_file: path to (or open file object of) MS2 metadata xml file
+    feature_set: hash set of desired features with which to populate MS2
+      object fields
+    ids: also collect the IDs in id_dict
+  Yields:
+    MS2 objects, in document order
+  '''
+  for ms2_object in iterRecords(xml_file, ms2Projection(feature_set, ids)):
+    yield ms2_object
+
+def MS2Preprocessing(xml_file, feature_set, metabolite_dict, ids=True,
+                     unmatched_file=None):
   '''
   Takes in desired features and metabolite dictionary (from
   metabolitePreprocessing), reads through MS2 metadata, populates MS2 objects,
@@ -120,13 +394,15 @@ def MS2Preprocessing(xml_file, feature_set, metabolite_dict):
   Attributes populated as one of:
     MS2.attribute = value
     MS2.attribute = {key1:item1, key2:item2, ...}
-    MS2.ms_peak = [MSPeak1, MSPeak2, ...]
+    MS2.peaks = (n, 2) float64 array of [mz, intensity] rows
+    MS2.peak_ids = (n,) int64 array of the peaks' ids (-1 if missing)
 
   Attributes populated:
     -  IDs (features with _id in the name or "id" as the name)
-    -  References (anything under the references tag)
-    -  ms-ms peaks (anything under the ms-ms-peaks tag)
-    -  Other features from the feature_set input
+    -  ms-ms peaks (from the ms-ms-peaks tag; peaks without an m/z or
+       intensity are dropped). peak_ids only if ids is set.
+    -  References (anything under the references tag), and other features,
+       if they are in the feature_set input
 
   Args:
     xml_file: path to MS2 metadata xml file
@@ -134,82 +410,229 @@ def MS2Preprocessing(xml_file, feature_set, metabolite_dict):
       object fields
     metabolite_dict: dictionary formatted like: {inchikey: Metabolite}; the
       output of metabolitePreprocessing()
+    ids: also collect the IDs in id_dict
+    unmatched_file: path of a side file to write the MS2 objects without a
+      matching Metabolite to (see metabolite_index.SpillFile). If None,
+      they are only counted.
   Returns:
     Dictionary formatted like {inchikey: Metabolite} where the Metabolite
       has the MS2 field populated
-    List of MS2 objects for which the input metabolite_dict did not have a
-      matching inchikey key
+    Number of MS2 objects for which the input metabolite_dict did not have
+      a matching Metabolite
   '''
-  print 'Generating MS2 XML Tree...'
-  tree = ET.parse(xml_file)
-  print 'Done. \nPreprocessing MS2 Data...'
-  root = tree.getroot()
-  failure_list = []
-  for metabolite_analysis in root:
-    ms2_object = MS2()
-    id_dict = dict()
-    failure = False
-    for feature in metabolite_analysis:
-      #filter out non-ms-ms data
-      if 'peaks' in feature.tag and feature.tag != 'ms-ms-peaks':
-        failure = True
+  print 'Streaming MS2 XML...'
+  ms2_objects = iterMS2s(xml_file, feature_set, ids)
+  metabolite_dict, n_unmatched = matchMS2s(ms2_objects, metabolite_dict,
+                                           unmatched_file)
+  print 'Done.'
+  print 'Found', n_unmatched, 'MS2 objects without Metabolite pairs'
+  return metabolite_dict, n_unmatched
+
+def matchMS2s(ms2_objects, metabolite_dict, unmatched_file=None,
+              batch_size=1000):
+  '''
+  Attaches MS2 objects to their Metabolite in metabolite_dict, through a
+  metabolite_index.MetaboliteIndex: by inchikey, HMDB accession (primary or
+  secondary), or first inchikey block, in that order.
+
+  Args:
+    ms2_objects: iterable of MS2 objects. None entries (i.e. spectra that
+      should be ignored) are skipped.
+    metabolite_dict: dictionary formatted like: {inchikey: Metabolite}
+    unmatched_file: path of a side file to write the MS2 objects without a
+      matching Metabolite to, or None to only count them
+    batch_size: number of MS2 objects looked up at a time
+  Returns:
+    metabolite_dict, with the MS2 fields populated
+    Number of MS2 objects without a matching Metabolite
+  '''
+  index = MetaboliteIndex(metabolite_dict.itervalues())
+  spill = SpillFile(unmatched_file) if unmatched_file else None
+  counts = dict((kind, 0) for kind in MATCH_KINDS)
+  n_unmatched = 0
+  ms2_objects = (ms2_object for ms2_object in ms2_objects
+                 if ms2_object is not None)
+  try:
+    while True:
+      batch = list(itertools.islice(ms2_objects, batch_size))
+      if not batch:
         break
-      #filter out non-GC chromatagraphy data
-      #if feature.tag == 'chromatography-type' and feature.text != 'GC':
-      #  failure = True
-      #  break
-
-      #collect all id data in dictionary
-      if '_id' in feature.tag or feature.tag == 'id' or '-id' in feature.tag:
-        id_dict[feature.tag.replace('-', '_')] = feature.text
-
-      #collect references data in dictionary
-      elif feature.tag == 'references':
-        references_dict = dict()
-        for reference_tag in feature:
-          for references_feature in reference_tag:
-            if references_feature.text:
-              references_dict[references_feature.tag.replace('-', '_')] = references_feature.text
-            else:
-              references_dict[references_feature.tag.replace('-', '_')] = ''
-        ms2_object.references_dict = references_dict
-
-      #collect peak data as list of MSPeak objects
-      elif feature.tag == 'ms-ms-peaks':
-        peak_objects = []
-        for peak_object in feature:
-          ms_peak = MSPeak()
-          for peak_object_attribute in peak_object:
-            if peak_object_attribute.text:
-              setattr(ms_peak, peak_object_attribute.tag.replace('-', '_'), peak_object_attribute.text)
-            else:
-              setattr(ms_peak, peak_object_attribute.tag.replace('-', '_'), '')
-          peak_objects.append(ms_peak)
-        ms2_object.peaks = peak_objects
-
-      #collect other data attributes of interest
-      else:
-        if feature.text:
-          setattr(ms2_object, feature.tag.replace('-', '_'), feature.text)
+      for ms2_object, (key, kind) in zip(batch, index.lookupBatch(batch)):
+        #add MS2 feature to metabolite dictionary
+        if key is not None:
+          metabolite_dict[key].MS2.append(ms2_object)
+          counts[kind] += 1
         else:
-          setattr(ms2_object, feature.tag.replace('-', '_'), '')
-        if 'inchi' in feature.tag and 'key' in feature.tag:
-          setattr(ms2_object, 'inchikey', feature.text)
-          setattr(ms2_object, 'inchi_key', feature.text)
-
-    ms2_object.id_dict = id_dict
-    #check for failure i.e. this data should be ignored
-    if failure: continue
-    #add MS2 feature to metabolite dictionary
-    if metabolite_dict.get(ms2_object.inchi_key):
-      metabolite_dict[ms2_object.inchi_key].MS2.append(ms2_object)
-    else:
-      failure_list.append(ms2_object)
+          n_unmatched += 1
+          if spill is not None:
+            spill.write(ms2_object)
+  finally:
+    if spill is not None:
+      spill.close()
+  print 'Matched MS2 objects by', ', '.join(
+    '{}: {}'.format(kind, counts[kind]) for kind in MATCH_KINDS)
+  return metabolite_dict, n_unmatched
+
+def listMS2Files(ms2_source, pattern='*.xml'):
+  '''
+  Lists the per-spectrum xml files in a directory (searched recursively) or
+  in a zip archive, such as the unpacked or packed hmdb_spectra_xml.zip.
+
+  Args:
+    ms2_source: path to a directory or zip file
+    pattern: glob pattern that file names must match
+  Returns:
+    sorted list of file paths (for a directory) or member names (for a zip)
+  '''
+  if zipfile.is_zipfile(ms2_source):
+    with zipfile.ZipFile(ms2_source) as archive:
+      names = [name for name in archive.namelist()
+               if fnmatch.fnmatch(os.path.basename(name), pattern)]
+  else:
+    names = []
+    for dirpath, _, filenames in os.walk(ms2_source):
+      names += [os.path.join(dirpath, name)
+                for name in fnmatch.filter(filenames, pattern)]
+  return sorted(names)
+
+def packMS2(ms2_object):
+  '''
+  Reduces an MS2 object to a compact, cheaply pickled record: a dict of only
+  the attributes that were actually populated. The peak arrays are pickled
+  as they are.
+  '''
+  return dict((attribute, value)
+              for attribute, value in ms2_object.attributes().iteritems()
+              if value is not None)
+
+def unpackMS2(record):
+  '''
+  Rebuilds an MS2 object from a record made by packMS2().
+  '''
+  ms2_object = MS2()
+  ms2_object.update(record)
+  return ms2_object
+
+# Per-process state for the workers in MS2ParallelPreprocessing(), set up
+# once per worker by _initMS2Worker()
+_worker_archive = None
+_worker_projection = None
+
+def _initMS2Worker(zip_path, feature_set, ids):
+  global _worker_archive, _worker_projection
+  # Each worker opens its own handle so that members can be read concurrently
+  if zip_path is not None:
+    _worker_archive = zipfile.ZipFile(zip_path)
+  _worker_projection = ms2Projection(feature_set, ids)
+
+def _parseMS2File(name):
+  '''
+  Worker function: parses one per-spectrum xml file and returns the packed
+  MS2 records of the ms-ms spectra in it (i.e. an empty list for other
+  kinds of spectra).
+  '''
+  if _worker_archive is not None:
+    reopen = lambda: _worker_archive.open(name)
+  else:
+    reopen = lambda: open(name, 'rb')
+  xml_file = reopen()
+  try:
+    return [packMS2(ms2_object)
+            for ms2_object in iterRecords(xml_file, _worker_projection,
+                                          reopen=reopen)]
+  finally:
+    xml_file.close()
+
+def iterMS2FileRecords(ms2_source, names, feature_set, processes=None,
+                       chunksize=500, ids=True):
+  '''
+  Parses per-spectrum xml files across a pool of worker processes.
+
+  Args:
+    ms2_source: path to a directory or zip file of per-spectrum xml files
+    names: files to parse, as returned by listMS2Files()
+    feature_set: hash set of desired features with which to populate MS2
+      object fields
+    processes: number of worker processes [default: number of cores]
+    chunksize: number of files handed to a worker at a time
+    ids: also collect the IDs in id_dict
+  Yields:
+    (name, records) for each file, in the order of names, where records is
+      a list of packed MS2 records (see packMS2())
+  '''
+  zip_path = ms2_source if zipfile.is_zipfile(ms2_source) else None
+  pool = multiprocessing.Pool(processes, initializer=_initMS2Worker,
+                              initargs=(zip_path, feature_set, ids))
+  try:
+    # imap (rather than imap_unordered) keeps the MS2 order deterministic
+    results = pool.imap(_parseMS2File, names, chunksize=chunksize)
+    for name, records in itertools.izip(names, results):
+      yield name, records
+  finally:
+    pool.close()
+    pool.join()
+
+def MS2ParallelPreprocessing(ms2_source, feature_set, metabolite_dict,
+                             processes=None, chunksize=500, ids=True,
+                             unmatched_file=None):
+  '''
+  Same as MS2Preprocessing(), but reads the individual per-spectrum xml files
+  straight out of a directory or zip archive (e.g. hmdb_spectra_xml.zip)
+  across a pool of worker processes, so the files never need to be
+  concatenated and cleaned up into one document first.
+
+  Args:
+    ms2_source: path to a directory or zip file of per-spectrum xml files
+    feature_set: hash set of desired features with which to populate MS2
+      object fields
+    metabolite_dict: dictionary formatted like: {inchikey: Metabolite}; the
+      output of metabolitePreprocessing()
+    processes: number of worker processes [default: number of cores]
+    chunksize: number of files handed to a worker at a time
+    ids: also collect the IDs in id_dict
+    unmatched_file: path of a side file to write the MS2 objects without a
+      matching Metabolite to, or None to only count them
+  Returns:
+    Dictionary formatted like {inchikey: Metabolite} where the Metabolite
+      has the MS2 field populated
+    Number of MS2 objects for which the input metabolite_dict did not have
+      a matching Metabolite
+  '''
+  print 'Listing MS2 XML files...'
+  names = listMS2Files(ms2_source)
+  print 'Done. \nPreprocessing', len(names), 'MS2 XML files...'
+  ms2_objects = (unpackMS2(record) for _, records in iterMS2FileRecords(
+                   ms2_source, names, feature_set, processes, chunksize, ids)
+                 for record in records)
+  metabolite_dict, n_unmatched = matchMS2s(ms2_objects, metabolite_dict,
+                                           unmatched_file)
 
   print 'Done.'
-  print 'Found', len(failure_list), 'MS2 objects without Metabolite pairs'
-  return metabolite_dict, failure_list
+  print 'Found', n_unmatched, 'MS2 objects without Metabolite pairs'
+  return metabolite_dict, n_unmatched
+
 
+def peakString(ms2_object):
+  '''
+  Formats the peaks of an MS2 object for writeToCSV(), as one
+  !id=...!intensity=...!mass_charge=...!ms_ms_id=... run per peak. The id
+  and ms_ms_id (the id of the spectrum) are left empty if unknown.
+  '''
+  peaks = peakArray(ms2_object.peaks)
+  peak_ids = ms2_object.peak_ids
+  ms_ms_id = (ms2_object.id_dict or {}).get('id')
+  # repr() keeps every digit of the float m/z and intensity
+  mzs = map(repr, peaks[:, 0].tolist())
+  intensities = map(repr, peaks[:, 1].tolist())
+  if peak_ids is not None and len(peak_ids) == len(peaks):
+    ids = ['!id=' + ('' if peak_id < 0 else str(peak_id))
+           for peak_id in peak_ids.tolist()]
+  else:
+    ids = ['!id='] * len(peaks)
+  tail = '!ms_ms_id=' + (ms_ms_id or '')
+  return ''.join(peak_id + '!intensity=' + intensity + '!mass_charge=' + mz
+                 + tail for peak_id, intensity, mz in
+                 zip(ids, intensities, mzs))
 
 def writeToCSV(matched_dict, file_path):
   '''
@@ -231,8 +654,8 @@ def writeToCSV(matched_dict, file_path):
   writer = csv.writer(csv_file)
   #for each metabolite
   for metabolite in matched_dict.itervalues():
-    attributes = dir(metabolite)
-    attributes = [attribute for attribute in attributes if '__' not in attribute and 'MS2' not in attribute]
+    attributes = sorted(metabolite.attributes())
+    attributes = [attribute for attribute in attributes if 'MS2' not in attribute]
     writestring_list = [metabolite.inchikey]
     for attribute in attributes:
       value = getattr(metabolite, attribute)
@@ -266,14 +689,19 @@ def writeToCSV(matched_dict, file_path):
     ms2_object_list = metabolite.MS2
     # Write each MS2 object on a new row
     for ms2_object in ms2_object_list:
-      attributes = [attribute for attribute in dir(ms2_object)
-                    if '__' not in attribute]
+      attributes = sorted(ms2_object.attributes())
       writestring_list = ['']
       for attribute in attributes:
+        # The peak ids are written along with the peaks
+        if attribute == 'peak_ids':
+          continue
         value = getattr(ms2_object, attribute)
         writestring = str(attribute) + '='
+        #if peak array
+        if attribute == 'peaks' and value is not None:
+          writestring += peakString(ms2_object)
         #if empty field
-        if not value:
+        elif not value:
           pass
         #if field=value format
         elif type(value) == str:
@@ -292,25 +720,9 @@ def writeToCSV(matched_dict, file_path):
           writestring = writestring[:-1]
         #if field=[value, value, ...] format
         elif type(value) == list:
-          if str(value[0]) != 'MSPeak':
-            for list_item in value:
-              writestring += list_item + ','
-            writestring = writestring[:-1]
-          else:
-            ms2_attributes = [attribute for attribute
-                              in dir(value[0]) if '__' not in attribute]
-            for peak in value:
-              for ms_attribute in ms2_attributes:
-                try:
-                  ms_value = getattr(peak, ms_attribute)
-                  if not ms_value:
-                    ms_value = ''
-                except AttributeError:
-                  ms_value = ''
-                writestring += '!'
-                writestring += str(ms_attribute) + '=' + str(ms_value)
-            writestring += ','
-            writestring = writestring[:-1]
+          for list_item in value:
+            writestring += list_item + ','
+          writestring = writestring[:-1]
 
         writestring_list.append(writestring)
       writer.writerow(writestring_list)
@@ -318,39 +730,31 @@ def writeToCSV(matched_dict, file_path):
 
 if __name__ == '__main__':
   args = parse_args()
-  #######    TO GENERATE CSV    #######
-  ms2_feature_set =  set(
-    ['inchi_key', 'frequency', 'instrument_type', 'id', 'energy_field',
-     'base_peak', 'sample_mass_units', 'chromatography_type', 'searchable',
-     'sample_mass', 'derivative_mw', 'retention_time', 'updated_at',
-     'sample_assessment', 'derivative_formula', 'derivative_type',
-     'database_id', 'ref_text', 'mass_charge', 'collision_energy_voltage',
-     'sample_concentration', 'spectra_assessment', 'solvent', 'nucleus_y',
-     'ionization_mode', 'collection_date', 'nucleus',
-     'sample_temperature_units', 'sample_ph', 'spectra_id', 'c_ms_id',
-     'sample_concentration_units', 'sample_source', 'nil_classes', 'nucleus_x',
-     'database', 'notes', 'created_at', 'sample_temperature', 'ri_type',
-     'pubmed_id', 'molecule_id', 'column_type', 'retention_index',
-     'collision_energy_level', 'references', 'name', 'accession',
-     'chemical_formula', 'monoisotopic_molecular_weight', 'iupac_name',
-     'traditional_iupac', 'cas_registry', 'smiles', 'inchi', 'inchikey',
-     'taxonomy', 'biofluid_locations', 'ids', 'peak_counter', 'mono_mass',
-     'ms_ms_id', 'spectra_type'])
 
   # Set up some file paths
   ms2_xml_file = args.ms2_concat
   metabolite_xml_file = args.metabolites_info
-  metabolite_feature_set = set(['accession', 'secondary_accessions', 'name',
-                'chemical_formula',
-                'monisotopic_molecular_weight', 'iupac_name',
-                'traditional_iupac', 'cas_registry_number',
-                'smiles', 'inchi', 'inchikey',
-                'biofluid_locations', 'taxonomy'])
-
-  metabolite_dict = metabolitePreprocessing(
-    metabolite_xml_file, metabolite_feature_set)
-  matched_dict, failure_list = MS2Preprocessing(
-    ms2_xml_file, ms2_feature_set, metabolite_dict)
+  if args.core_fields:
+    metabolite_features = CORE_METABOLITE_FEATURE_SET
+    ms2_features = CORE_MS2_FEATURE_SET
+  else:
+    metabolite_features = METABOLITE_FEATURE_SET
+    ms2_features = MS2_FEATURE_SET
+  ids = not args.core_fields
+  metabolite_dict = metaboliteParallelPreprocessing(
+    metabolite_xml_file, metabolite_features, processes=args.processes,
+    ids=ids)
+  if os.path.isdir(ms2_xml_file) or zipfile.is_zipfile(ms2_xml_file):
+    matched_dict, n_unmatched = MS2ParallelPreprocessing(
+      ms2_xml_file, ms2_features, metabolite_dict,
+      processes=args.processes, ids=ids, unmatched_file=args.unmatched)
+  else:
+    matched_dict, n_unmatched = MS2Preprocessing(
+      ms2_xml_file, ms2_features, metabolite_dict, ids=ids,
+      unmatched_file=args.unmatched)
 
-  csv_file_path = args.out
-  writeToCSV(matched_dict, csv_file_path)
+  if args.format == 'store':
+    writeSpectraStore(matched_dict, args.out)
+  else:
+    csv_file_path = args.out
+    writeToCSV(matched_dict, csv_file_path)
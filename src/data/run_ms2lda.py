@@ -1,9 +1,12 @@
 #!/usr/bin/env
 """
 This script pulls the molecules from our CSV and runs them through MS2LDA.
+
+By default the spectra are decomposed locally against a motif set file (see
+src/util/motifs.py for the format), which runs offline and in parallel. With
+--remote, they are sent to the ms2lda.org batch decomposition API instead, in
+concurrent chunks that are checkpointed so that a crashed run can be resumed.
 """
-import json
-import requests
 import argparse
 import time
 import pandas as pd
@@ -13,55 +16,128 @@ import os, sys
 src_dir = os.path.normpath('src/util')
 sys.path.insert(0, src_dir)
 import util
+import motifs
+import peak_filters
+
+RESULT_COLUMNS = ['motif', 'motif_dup', 'prob', 'overlap', 'annotation']
+
+def decompose_remote(spectra, motifset='massbank_motifset', **client_args):
+    """
+    Run the spectra through the ms2lda.org batch decomposition API, in
+    concurrent chunks that are checkpointed as they finish (see
+    src/util/ms2lda_client.py).
+
+    Args:
+        spectra: {spec_id: spectrum} dictionary
+        motifset: name of the motif set on ms2lda.org
+        client_args: passed to MS2LDAClient (e.g. chunk_size, max_in_flight,
+            checkpoint_dir)
+    Returns:
+        tidy dataframe with RESULT_COLUMNS and 'spec'
+    """
+    # Imported here so that local runs don't need requests installed
+    from ms2lda_client import MS2LDAClient
+
+    ms2lda_spectra = []
+    for spec in spectra.keys():
+        ms2lda_spectra.append(
+            (spec,
+             spectra[spec]['parentmass'],
+             [tuple(p) for p in spectra[spec]['peaks']])
+        )
 
-p = argparse.ArgumentParser()
-p.add_argument('infile', help='input json file, spectra as main keys')
-p.add_argument('outfile', help='outfile')
-args = p.parse_args()
+    client = MS2LDAClient(motifset=motifset, **client_args)
+    t0 = time.time()
+    res = client.decompose(ms2lda_spectra)
+    t1 = time.time()
+    print('MS2LDA took {:.2f} s for {} spectra'.format(
+            t1 - t0, len(ms2lda_spectra)))
 
-# Read in the csv data
-with open(args.infile, 'r') as f:
-    spectra = json.load(f)
+    # Convert results into dataframe
+    reslst = []
+    for k in sorted(res):
+        tmp = pd.DataFrame(res[k], columns=RESULT_COLUMNS)
+        tmp['spec'] = k
+        reslst.append(tmp)
+    return pd.concat(reslst)
 
-ms2lda_spectra = []
-for spec in spectra.keys():
-    ms2lda_spectra.append(
-        (spec,
-         spectra[spec]['parentmass'],
-         [tuple(p) for p in spectra[spec]['peaks']])
-    )
+def decompose_local(spectra, motif_set, processes=None, batch_size=250,
+                    min_prob=0.01, min_overlap=0.0):
+    """
+    Decompose the spectra against a motif set file with the local engine in
+    src/util/motifs.py.
 
-# Run ms2lda - post request first
-ms2lda_args = {'spectra': json.dumps(ms2lda_spectra),
-              'motifset': 'massbank_motifset'}
-url = 'http://ms2lda.org/decomposition/api/batch_decompose/'
+    Returns:
+        tidy dataframe with RESULT_COLUMNS and 'spec', as decompose_remote()
+    """
+    t0 = time.time()
+    spec_ids, motif_idx, prob, overlap = motifs.decomposeSpectra(
+        spectra, motif_set, processes=processes, batch_size=batch_size,
+        min_prob=min_prob, min_overlap=min_overlap)
+    print('MS2LDA took {:.2f} s for {} spectra'.format(
+            time.time() - t0, len(spectra)))
 
-r = requests.post(url, ms2lda_args)
-t0 = time.time()
-print("Request posted at {}.".format(t0))
+    motif_names = [motif_set.motifs[k] for k in motif_idx]
+    return pd.DataFrame({
+        'motif': motif_names,
+        'motif_dup': motif_names,
+        'prob': prob,
+        'overlap': overlap,
+        'annotation': [motif_set.annotations[k] for k in motif_idx],
+        'spec': spec_ids},
+        columns=RESULT_COLUMNS + ['spec'])
 
-# Check for results
-result_id = r.json()['result_id']
-url2 = 'http://ms2lda.org/decomposition/api/batch_results/{}/'.format(result_id)
-print(url2)
-r2 = requests.get(url2)
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('infile', help='input clean_spectra.jsonl, or json file '
+        + 'with spectra as main keys')
+    p.add_argument('outfile', help='outfile')
+    p.add_argument('--motifset', help='motif set json file to decompose '
+        + 'against locally (see src/util/motifs.py for the format)')
+    p.add_argument('--remote', help='use the ms2lda.org API (with the '
+        + 'massbank_motifset) instead of decomposing locally',
+        action='store_true')
+    p.add_argument('--processes', help='number of worker processes. '
+        + '[default: number of cores]', default=None, type=int)
+    p.add_argument('--batch-size', help='number of spectra decomposed per '
+        + 'batch. [default: %(default)s]', default=250, type=int)
+    p.add_argument('--min-prob', help='only report motifs with at least this '
+        + 'probability. [default: %(default)s]', default=0.01, type=float)
+    p.add_argument('--min-overlap', help='only report motifs with at least '
+        + 'this overlap score. [default: %(default)s]', default=0.0,
+        type=float)
+    p.add_argument('--url', help='url of the MS2LDA decomposition api, for '
+        + '--remote. [default: %(default)s]',
+        default='http://ms2lda.org/decomposition/api/')
+    p.add_argument('--chunk-size', help='number of spectra per job, for '
+        + '--remote. [default: %(default)s]', default=1000, type=int)
+    p.add_argument('--max-in-flight', help='max number of jobs submitted at '
+        + 'once, for --remote. [default: %(default)s]', default=4, type=int)
+    p.add_argument('--checkpoint-dir', help='directory to checkpoint '
+        + 'finished jobs in, for --remote. Re-running with the same '
+        + 'directory resumes a crashed run.')
+    p.add_argument('--poll-interval', help='seconds between the first polls '
+        + 'of a job, for --remote. The wait grows after each poll. '
+        + '[default: %(default)s]', default=5., type=float)
+    peak_filters.addFilterArguments(p)
+    args = p.parse_args()
+    if not args.remote and args.motifset is None:
+        p.error('either --motifset or --remote is required')
 
-# Keep checking if results are back before doing anything else
-while 'status' in r2.json():
-    time.sleep(30)
-    r2 = requests.get(url2)
-t1 = time.time()
-print('MS2LDA took {:.2f} s for {} spectra'.format(
-        t1 - t0, len(ms2lda_spectra)))
+    # Read in the spectra, with their peaks filtered if asked to
+    spectra = dict(peak_filters.iterFilteredSpectra(
+        args.infile, **peak_filters.filterArguments(args)))
 
-# Convert results into dataframe
-res = r2.json()['decompositions']
-reslst = []
-for k in res:
-    tmp = pd.DataFrame(res[k],
-             columns=['motif', 'motif_dup', 'prob', 'overlap', 'annotation'])
-    tmp['spec'] = k
-    reslst.append(tmp)
+    if args.remote:
+        ldadf = decompose_remote(spectra, base_url=args.url,
+                                 chunk_size=args.chunk_size,
+                                 max_in_flight=args.max_in_flight,
+                                 checkpoint_dir=args.checkpoint_dir,
+                                 poll_interval=args.poll_interval)
+    else:
+        motif_set = motifs.loadMotifSet(args.motifset)
+        ldadf = decompose_local(spectra, motif_set, args.processes,
+                                args.batch_size, args.min_prob,
+                                args.min_overlap)
 
-ldadf = pd.concat(reslst)
-ldadf.to_csv(args.outfile, sep='\t', encoding="utf-8", index=False)
+    ldadf.to_csv(args.outfile, sep='\t', encoding="utf-8", index=False)
@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+"""
+This script incrementally updates clean_spectra.jsonl and the sparse CSR
+feature tables after a new HMDB drop, instead of re-running the whole
+parse_xml_files.py -> clean_csv.py -> make_mz_feature_tables.py chain.
+
+It records content hashes for every spectra xml file, metabolite and cleaned
+spectrum in a state directory. On each run, only the spectra files that were
+added, changed or removed are re-parsed, only the affected metabolites are
+re-cleaned, and only the molecules whose cleaned spectra actually changed are
+re-binned and patched into the existing feature tables.
+
+Spectra are matched to metabolites through metabolite_index.MetaboliteIndex,
+as in parse_xml_files.py. The match keys of every stored spectrum are kept,
+so that all of them can be re-matched against each new metabolites file:
+metabolites whose set of spectra changed that way are re-cleaned too.
+
+The state directory holds:
+    state.json          the content hashes from the last run, and the match
+                        keys and metabolite of every spectrum
+    ms2_records.db      shelve of the parsed MS2 records of each spectra
+                        xml file, so unchanged files never need re-parsing
+
+The first run (with an empty state directory) builds everything.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shelve
+import zipfile
+
+import parse_xml_files
+from clean_csv import clean_metabolite
+
+# User-defined modules
+import sys
+src_dir = os.path.normpath('src/util')
+sys.path.insert(0, src_dir)
+import clean_spectra
+import spectrum_matrix
+from metabolite_index import MetaboliteIndex, spectrumAccession
+
+# Feature tables that get patched, as (ionization, scans) x (strategy, prefix)
+# (see make_mz_feature_tables.py --format csr)
+IONIZATIONS = [('Positive', 'positive'), ('Negative', 'negative'),
+               (None, 'all_scans')]
+STRATEGIES = [('raw', 'raw_mz'), ('integer', 'mz_integer')]
+
+def hash_record(record):
+    """
+    Content hash of a json-serializable record.
+    """
+    return hashlib.sha1(json.dumps(record, sort_keys=True)).hexdigest()
+
+def fingerprint_ms2_files(ms2_source):
+    """
+    Content hash of each per-spectrum xml file. For zip files, the CRC and
+    size from the archive's directory are used, so nothing is decompressed.
+    """
+    names = parse_xml_files.listMS2Files(ms2_source)
+    if zipfile.is_zipfile(ms2_source):
+        with zipfile.ZipFile(ms2_source) as archive:
+            return dict((name, '%08x-%d' % (archive.getinfo(name).CRC,
+                                            archive.getinfo(name).file_size))
+                        for name in names)
+    fingerprints = {}
+    for name in names:
+        with open(name, 'rb') as f:
+            fingerprints[name] = hashlib.sha1(f.read()).hexdigest()
+    return fingerprints
+
+def record_keys(record):
+    """
+    Match keys (inchi_key and HMDB accession) of a packed MS2 record.
+    """
+    ms2_object = parse_xml_files.unpackMS2(record)
+    return [ms2_object.inchi_key, spectrumAccession(ms2_object)]
+
+def load_state(state_dir):
+    fname = os.path.join(state_dir, 'state.json')
+    if not os.path.isfile(fname):
+        return {'ms2_files': {}, 'file_keys': {}, 'file_targets': {},
+                'metabolites': {}, 'spectra': {}}
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+def save_state(state, state_dir):
+    fname = os.path.join(state_dir, 'state.json')
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.rename(fname + '.tmp', fname)
+
+def update_ms2_records(ms2_source, state, records_db, processes):
+    """
+    Re-parse the spectra xml files that were added or changed since the last
+    run and forget the removed ones.
+
+    Returns:
+        set of inchikeys whose spectra may have changed (the metabolites of
+        the spectra in the re-parsed files are added by resolve_targets())
+    """
+    fingerprints = fingerprint_ms2_files(ms2_source)
+    old_fingerprints = state['ms2_files']
+    changed = sorted(name for name in fingerprints
+                     if old_fingerprints.get(name) != fingerprints[name])
+    removed = sorted(name for name in old_fingerprints
+                     if name not in fingerprints)
+    print('{} spectra files added or changed, {} removed'.format(
+        len(changed), len(removed)))
+
+    affected = set()
+    for name in changed + removed:
+        affected.update(state['file_targets'].pop(name, []))
+    for name, records in parse_xml_files.iterMS2FileRecords(
+            ms2_source, changed, parse_xml_files.MS2_FEATURE_SET, processes):
+        records_db[str(name)] = records
+        state['file_keys'][name] = [record_keys(record) for record in records]
+    for name in removed:
+        del records_db[str(name)]
+        del state['file_keys'][name]
+    state['ms2_files'] = fingerprints
+    affected.discard(None)
+    return affected
+
+def update_metabolites(metabolites_xml, state, affected, processes=None):
+    """
+    Parse the metabolites xml file (in parallel), hashing each metabolite,
+    and find the ones that changed or whose spectra may have changed.
+
+    All parsed metabolites are kept, so that the ones that only turn out to
+    need re-cleaning in resolve_targets() don't have to be parsed again.
+
+    Returns:
+        {inchikey: Metabolite} of all metabolites
+        set of all inchikeys that need re-cleaning, including removed ones
+        MetaboliteIndex of all metabolites
+    """
+    old_hashes = state['metabolites']
+    new_hashes = {}
+    metabolites = {}
+    changed = set()
+    index = MetaboliteIndex()
+    for mtab in parse_xml_files.iterMetabolitesParallel(
+            metabolites_xml, parse_xml_files.METABOLITE_FEATURE_SET,
+            processes):
+        index.add(mtab)
+        record = dict((k, v) for k, v in mtab.attributes().iteritems()
+                      if k != 'MS2')
+        new_hashes[mtab.inchikey] = hash_record(record)
+        metabolites[mtab.inchikey] = mtab
+        if old_hashes.get(mtab.inchikey) != new_hashes[mtab.inchikey]:
+            changed.add(mtab.inchikey)
+    removed = set(old_hashes) - set(new_hashes)
+    print('{} metabolites added or changed, {} removed'.format(
+        len(changed), len(removed)))
+    state['metabolites'] = new_hashes
+    return metabolites, affected | changed | removed, index
+
+def resolve_targets(state, index, affected):
+    """
+    Match every stored spectrum to its metabolite with the new index, and
+    add the metabolites whose spectra changed that way to affected.
+
+    Returns:
+        the updated affected set
+    """
+    old_targets = state['file_targets']
+    new_targets = {}
+    for name, keys in state['file_keys'].iteritems():
+        targets = [index.lookup(inchikey, accession)[0]
+                   for inchikey, accession in keys]
+        if targets != old_targets.get(name):
+            affected.update(targets)
+            affected.update(old_targets.get(name, []))
+        new_targets[name] = targets
+    state['file_targets'] = new_targets
+    affected.discard(None)
+    return affected
+
+def attach_ms2s(metabolites, state, records_db):
+    """
+    Rebuild the MS2 lists of the metabolites from the stored MS2 records, in
+    the same (sorted file name) order as a full parse_xml_files.py run.
+    """
+    files_by_inchikey = {}
+    for name, targets in state['file_targets'].iteritems():
+        for inchikey in set(targets) & set(metabolites):
+            files_by_inchikey.setdefault(inchikey, []).append(name)
+    for inchikey, mtab in metabolites.iteritems():
+        mtab.MS2 = [parse_xml_files.unpackMS2(record)
+                    for name in sorted(files_by_inchikey.get(inchikey, []))
+                    for record, target in zip(records_db[str(name)],
+                                              state['file_targets'][name])
+                    if target == inchikey]
+
+def update_clean_spectra(clean_json, metabolites, affected, state, npeaks):
+    """
+    Re-clean the affected metabolites and patch clean_spectra.jsonl (or
+    .json).
+
+    Returns:
+        the patched {spec_id: spectrum} dictionary
+        set of inchikeys whose cleaned spectra changed
+    """
+    all_spectra = {}
+    if os.path.isfile(clean_json):
+        all_spectra = clean_spectra.loadSpectra(clean_json)
+    for spec_id in [s for s in all_spectra
+                    if all_spectra[s]['inchi'] in affected]:
+        del all_spectra[spec_id]
+    for inchikey in affected & set(metabolites):
+        all_spectra.update(
+            clean_metabolite(inchikey, metabolites[inchikey], npeaks))
+
+    old_hashes = state['spectra']
+    new_hashes = {}
+    changed = set()
+    for spec_id, spectrum in all_spectra.iteritems():
+        if spectrum['inchi'] in affected:
+            new_hashes[spec_id] = hash_record(spectrum)
+            if old_hashes.get(spec_id) != new_hashes[spec_id]:
+                changed.add(spectrum['inchi'])
+        else:
+            new_hashes[spec_id] = old_hashes[spec_id]
+    for spec_id in set(old_hashes) - set(new_hashes):
+        changed.add(spec_id.split('_')[0])
+    state['spectra'] = new_hashes
+    print('{} molecules with changed spectra'.format(len(changed)))
+
+    clean_spectra.writeSpectra(all_spectra, clean_json)
+    return all_spectra, changed
+
+def update_feature_tables(feature_dir, all_spectra, changed):
+    """
+    Patch the rows of the changed molecules in the CSR feature tables, or
+    build the tables from scratch if they don't exist yet. Patched tables keep
+    all of their columns, so columns whose peaks were all removed stay in the
+    table (empty) until it is rebuilt.
+    """
+    changed_spectra = dict((spec_id, spectrum)
+                           for spec_id, spectrum in all_spectra.iteritems()
+                           if spectrum['inchi'] in changed)
+    # Peaks are sorted and binned once for all of the tables
+    tables = {}
+    def peak_table(name, spectra):
+        if name not in tables:
+            tables[name] = spectrum_matrix.PeakTable(spectra)
+        return tables[name]
+    for ionization, scans in IONIZATIONS:
+        max_mz = max([peak[0] for spectrum in changed_spectra.itervalues()
+                      if ionization in (None, spectrum['ionization'])
+                      for peak in spectrum['peaks']] or [0.])
+        for strategy, prefix in STRATEGIES:
+            fname = os.path.join(feature_dir, prefix + '.' + scans + '.csr')
+            if spectrum_matrix.isSpectrumMatrix(fname):
+                if not changed:
+                    continue
+                # Load into memory, since the files get overwritten
+                matrix = spectrum_matrix.loadSpectrumMatrix(
+                    fname, mmap_mode=None)
+                params = {}
+                if strategy == 'integer':
+                    # Bin the new rows up to the largest m/z of either
+                    # matrix, rather than the data-dependent default
+                    params['max_mz'] = max(max_mz, matrix.columns.max()
+                                           if len(matrix.columns) else 0.)
+                update = peak_table('changed', changed_spectra).matrix(
+                    ionization, strategy, **params)
+                matrix = matrix.patch(update, drop=changed)
+            else:
+                matrix = peak_table('all', all_spectra).matrix(
+                    ionization, strategy)
+            matrix.save(fname)
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('ms2_source', help='directory or zip file (e.g. '
+        + 'hmdb_spectra_xml.zip) of per-spectrum xml files')
+    p.add_argument('metabolites_xml', help='path to file with all HMDB '
+        + 'metabolites in one xml file, or to hmdb_metabolites.zip (only the '
+        + 'extracted xml file is parsed in parallel)')
+    p.add_argument('state_dir', help='directory with the content hashes and '
+        + 'parsed records from previous runs')
+    p.add_argument('clean_json', help='clean_spectra.jsonl (or .json) to '
+        + 'update')
+    p.add_argument('feature_dir', help='directory with the CSR feature '
+        + 'tables to patch. Only the tables written by '
+        + 'make_mz_feature_tables.py --format csr (*.csr) are patched in '
+        + 'place; text and columnar tables must be rebuilt from the updated '
+        + 'clean_json')
+    p.add_argument('--npeaks', help='min number of peaks in MS2 spectrum. '
+        + '[default: %(default)s]', default=3, type=int)
+    p.add_argument('--processes', help='number of worker processes used to '
+        + 'parse the spectra files and the metabolites xml file. [default: '
+        + 'number of cores]', default=None, type=int)
+    args = p.parse_args()
+
+    if not os.path.isdir(args.state_dir):
+        os.makedirs(args.state_dir)
+    records_db = shelve.open(
+        os.path.join(args.state_dir, 'ms2_records.db'), protocol=2)
+    try:
+        state = load_state(args.state_dir)
+        affected = update_ms2_records(
+            args.ms2_source, state, records_db, args.processes)
+        metabolites, affected, index = update_metabolites(
+            args.metabolites_xml, state, affected, args.processes)
+        affected = resolve_targets(state, index, affected)
+        metabolites = dict((inchikey, metabolites[inchikey])
+                           for inchikey in affected
+                           if inchikey in metabolites)
+        attach_ms2s(metabolites, state, records_db)
+        all_spectra, changed = update_clean_spectra(
+            args.clean_json, metabolites, affected, state, args.npeaks)
+        update_feature_tables(args.feature_dir, all_spectra, changed)
+    finally:
+        records_db.close()
+    # Only record the new state once all outputs have been written
+    save_state(state, args.state_dir)
@@ -11,118 +11,9 @@ sys.path.append('/Library/Frameworks/Python.framework/Versions/2.7/lib/python2.7
 from unidecode import unidecode
 
 
-class MS2:
-    '''
-    A container for all MS2 metadata. Final MS2 objects may have empty
-    or additional fields, depending on any anomalies in the data.
-    '''
-    def __init__(self):
-        self.peak_counter = None
-        self.mono_mass = None
-        self.spectra_type = None
-        self.inchi_key = None
-        self.frequency = None
-        self.instrument_type = None
-        self.energy_field = None
-        self.base_peak = None
-        self.sample_mass_units = None
-        self.chromatography_type = None
-        self.searchable = None
-        self.sample_mass = None
-        self.derivative_mw = None
-        self.retention_time = None
-        self.updated_at = None
-        self.sample_assessment = None
-        self.derivative_formula = None
-        self.derivative_type = None
-        self.database_id = None
-        self.ref_text = None
-        self.mass_charge = None
-        self.collision_energy_voltage = None
-        self.sample_concentration = None
-        self.spectra_assessment = None
-        self.solvent = None
-        self.nucleus_y = None
-        self.ionization_mode = None
-        self.collection_date = None
-        self.nucleus = None
-        self.sample_temperature_units = None
-        self.sample_ph = None
-        self.spectra_id = None
-        self.c_ms_id = None
-        self.sample_concentration_units = None
-        self.sample_source = None
-        self.nil_classes = None
-        self.nucleus_x = None
-        self.database = None
-        self.notes = None
-        self.created_at = None
-        self.sample_temperature = None
-        self.ri_type = None
-        self.pubmed_id = None
-        self.molecule_id = None
-        self.column_type = None
-        self.retention_index = None
-        self.collision_energy_level = None
-        self.references = None
-        self.name = None
-        self.accession = None
-        self.chemical_formula = None
-        self.monoisotopic_molecular_weight = None
-        self.iupac_name = None
-        self.traditional_iupac = None
-        self.cas_registry = None
-        self.smiles = None
-        self.inchi = None
-        self.inchikey = None
-        self.taxonomy = None
-        self.biofluid_locations = None
-        self.id_dict = None
-        self.peaks = None
-
-    def __str__(self):
-        return 'MS2'
-
-
-class MSPeak:
-    '''
-    Container for data about an ms-ms peak. Final MSPeak objects may have
-    empty or additional fields, depending on any anomalies in the data.
-    '''
-    def __init__(self):
-        self.id = None
-        self.ms_ms_id = None
-        self.intensity = None
-        self.mass_charge = None
-
-    def __str__(self):
-        return 'MSPeak'
-
-
-class Metabolite:
-    '''
-    Container for metadata about a metabolite. Final Metabolite objects may have
-    empty or additional fields, depending on any anomalies in the data.
-    '''
-    def __init__(self):
-        self.accession = None
-        self.secondary_accessions = None
-        self.name = None
-        self.chemical_formula = None
-        self.monisotopic_molecular_weight = None
-        self.iupac_name = None
-        self.traditional_iupac = None
-        self.cas_registry = None
-        self.smiles = None
-        self.inchi = None
-        self.inchikey = None
-        self.biofluid_locations = None
-        self.id_dict = None
-        self.taxonomy_dict = None
-        self.MS2 = []
-
-    def __str__(self):
-        return 'Metabolite'
+# The record classes are shared with the rest of the pipeline, in src/util
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../util'))
+from MetabolomicsObjects import Metabolite, MS2, MSPeak
 
 
 def findAllTags(xml_file):
@@ -352,8 +243,8 @@ def writeToCSV(matched_dict, file_path):
   writer = csv.writer(csv_file)
   #for each metabolite
   for metabolite in matched_dict.itervalues():
-    attributes = dir(metabolite)
-    attributes = [attribute for attribute in attributes if '__' not in attribute and 'MS2' not in attribute]
+    attributes = sorted(metabolite.attributes())
+    attributes = [attribute for attribute in attributes if 'MS2' not in attribute]
     writestring_list = [metabolite.inchikey]
     for attribute in attributes:
       value = getattr(metabolite, attribute)
@@ -387,8 +278,9 @@ def writeToCSV(matched_dict, file_path):
     ms2_object_list = metabolite.MS2
     #for MS2 object
     for ms2_object in ms2_object_list:
-      attributes = dir(ms2_object)
-      attributes = [attribute for attribute in attributes if '__' not in attribute]
+      # peak_ids is only populated by parse_xml_files.py's peak arrays
+      attributes = sorted(attribute for attribute in ms2_object.attributes()
+                          if attribute != 'peak_ids')
       writestring_list = ['']
       for attribute in attributes:
         value = getattr(ms2_object, attribute)
@@ -418,15 +310,17 @@ def writeToCSV(matched_dict, file_path):
               writestring += list_item + ','
             writestring = writestring[:-1]
           else:
-            ms2_attributes = [attribute for attribute in dir(value[0]) if '__' not in attribute]
+            ms2_attributes = sorted(value[0].attributes())
             for peak in value:
               for ms_attribute in ms2_attributes:
                 try:
                   ms_value = getattr(peak, ms_attribute)
-                  if not ms_value:
+                  if ms_value is None:
                     ms_value = ''
                 except AttributeError:
                   ms_value = ''
+                if isinstance(ms_value, float):
+                  ms_value = repr(ms_value)
                 writestring += '!'
                 writestring += str(ms_attribute) + '=' + str(ms_value)
             writestring += ','
@@ -585,8 +479,8 @@ def testMetabolitePreprocessing(testingCSV=False):
 
 
 def compareMetabolites(correct_metabolite, generated_metabolite):
-    test_attributes = [attribute for attribute in dir(generated_metabolite) if '__' not in attribute]
-    correct_attributes = [attribute for attribute in dir(correct_metabolite) if '__' not in attribute]
+    test_attributes = sorted(generated_metabolite.attributes())
+    correct_attributes = sorted(correct_metabolite.attributes())
     success = True
     try:
         assert set(test_attributes) == set(correct_attributes)
@@ -629,10 +523,13 @@ def compareMS2(ms2_1, ms2_2):
     '''
     if type(ms2_1) != type(ms2_2):
         return False
-    if (set(dir(ms2_1)) != set(dir(ms2_2))):
+    if type(ms2_1) == list:
+        return len(ms2_1) == len(ms2_2) and all(
+            compareMS2(item_1, item_2) for item_1, item_2 in zip(ms2_1, ms2_2))
+    if set(ms2_1.attributes()) != set(ms2_2.attributes()):
         return False
     try:
-        attributes = [attribute for attribute in dir(ms2_1) if '__' not in attribute]
+        attributes = sorted(ms2_1.attributes())
         for attribute in attributes:
             if getattr(ms2_1, attribute) or getattr(ms2_2, attribute):
                 if getattr(ms2_1, attribute) != getattr(ms2_2, attribute):
@@ -718,8 +615,8 @@ def testMS2Preprocessing():
         for ms2_index in xrange(len(correct_ms2_list)):
             correct_ms2 = correct_ms2_list[ms2_index]
             generated_ms2 = generated_ms2_list[ms2_index]
-            correct_attributes = [attribute for attribute in dir(correct_ms2) if '__' not in attribute]
-            generated_attributes = [attribute for attribute in dir(generated_ms2) if '__' not in attribute]
+            correct_attributes = sorted(correct_ms2.attributes())
+            generated_attributes = sorted(generated_ms2.attributes())
             try:
                 assert set(correct_attributes) == set(generated_attributes)
             except AssertionError:
@@ -47,8 +47,12 @@ import seaborn as sns
 
 class StatsMaker:
   def __init__(self):
+    # Prefer the spectra store, which loads much faster than the csv
     csv_path = os.getcwd() + '/../../data/clean/metabolites_and_spectra.csv'
-    self.metabolite_dict = util.unpackCSV(csv_path)
+    store_path = os.getcwd() + '/../../data/clean/metabolites_and_spectra.store'
+    if os.path.isdir(store_path):
+      csv_path = store_path
+    self.metabolite_dict = util.loadMetabolites(csv_path)
     self.kingdom_ionization_dict = dict()
     self.sub_class_ionization_dict = dict()
     self.super_class_ionization_dict = dict()
@@ -108,7 +112,7 @@ class StatsMaker:
       self.updateIonization(metabolite.taxonomy_dict, metabolite.MS2)
       self.ms2_per_molecule.append(len(metabolite.MS2))
       for ms2 in metabolite.MS2:
-        if ms2.peaks:
+        if ms2.peaks is not None:
           self.peaks_per_ms2.append(len(ms2.peaks))
         else:
           self.peaks_per_ms2.append(0)
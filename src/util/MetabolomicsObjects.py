@@ -2,116 +2,192 @@
 """
 This file contains class definitions for various objects used in metabolomics
 data processing.
+
+The objects are slotted records: their known fields live in __slots__ rather
+than in a per-instance __dict__, and the fields that only ever take a handful
+of values (ionization mode, instrument type, ...) are interned, so that every
+record shares one copy of each value. Fields outside of the known ones can
+still be set, and go into a __dict__ that is only created when needed. Use
+attributes() rather than vars() or dir() to list a record's fields.
+
+MS2 peaks are held as one float64 (n, 2) array of [mz, intensity] rows per
+spectrum (see peakArray()), decoded straight from the xml by the parser. The
+HMDB ids of the peaks, where known, are in a matching (n,) int64 peak_ids
+array.
 """
+import numpy as np
+
+# Fields with few distinct values across HMDB, whose values are interned
+CATEGORICAL_FIELDS = frozenset(
+    ['spectra_type', 'instrument_type', 'ionization_mode',
+     'chromatography_type', 'collision_energy_level', 'energy_field',
+     'sample_mass_units', 'sample_concentration_units',
+     'sample_temperature_units', 'searchable', 'frequency', 'nucleus',
+     'database', 'derivative_type', 'ri_type', 'column_type'])
+
+# Dictionary fields whose values are interned (e.g. 'kingdom': 'Organic
+# compounds')
+CATEGORICAL_DICT_FIELDS = frozenset(['taxonomy_dict'])
+
+_interned = dict()
+
+def internValue(value):
+    '''
+    Returns the shared copy of a string value. Non-string values are returned
+    unchanged.
+    '''
+    if not isinstance(value, basestring):
+        return value
+    return _interned.setdefault(value, value)
+
+def peakArray(peaks):
+    '''
+    Converts peaks to a float64 (n, 2) array of [mz, intensity] rows.
+
+    Args:
+        peaks: list of MSPeak objects, sequence of (mz, intensity) pairs, or
+            an (n, 2) array. MSPeaks missing either value are dropped.
+    Returns:
+        (n, 2) float64 array
+    '''
+    if isinstance(peaks, np.ndarray):
+        return peaks.astype(np.float64, copy=False).reshape(-1, 2)
+    rows = []
+    for peak in peaks or []:
+        if isinstance(peak, MSPeak):
+            if peak.mass_charge in (None, '') or peak.intensity in (None, ''):
+                continue
+            peak = (peak.mass_charge, peak.intensity)
+        rows.append(peak)
+    return np.array(rows, dtype=np.float64).reshape(-1, 2)
+
+
+class Record(object):
+    '''
+    Base class for the slotted records. Subclasses list their fields in
+    __slots__; they are all initialised to None.
+    '''
+    # _has_extras is set once a field outside of __slots__ goes into the
+    # __dict__, since just reading __dict__ creates it
+    __slots__ = ('__dict__', '_has_extras')
+
+    def __init__(self):
+        for field in self._fields():
+            object.__setattr__(self, field, None)
+
+    @classmethod
+    def _fields(cls):
+        fields = cls.__dict__.get('_field_names')
+        if fields is None:
+            fields = []
+            for klass in reversed(cls.__mro__):
+                fields += [field for field in klass.__dict__.get('__slots__', ())
+                           if field not in Record.__slots__]
+            cls._field_names = tuple(fields)
+            cls._field_set = frozenset(fields)
+        return cls._field_names
+
+    def __setattr__(self, name, value):
+        if name in CATEGORICAL_FIELDS:
+            value = internValue(value)
+        elif name in CATEGORICAL_DICT_FIELDS and isinstance(value, dict):
+            for key, item in value.iteritems():
+                value[key] = internValue(item)
+        self._setField(name, value)
+
+    def _setField(self, name, value):
+        self._fields()
+        if name not in type(self)._field_set:
+            object.__setattr__(self, '_has_extras', True)
+        object.__setattr__(self, name, value)
+
+    def attributes(self):
+        '''
+        Returns a {field: value} dictionary of all of the record's fields,
+        the known ones as well as any additional ones that were set.
+        '''
+        fields = dict((field, getattr(self, field, None))
+                      for field in self._fields())
+        if getattr(self, '_has_extras', False):
+            fields.update(vars(self))
+        return fields
+
+    def update(self, fields):
+        '''
+        Sets the record's fields from a {field: value} dictionary.
+        '''
+        for field, value in fields.iteritems():
+            setattr(self, field, value)
 
-class MS2:
+    def __getstate__(self):
+        return self.attributes()
+
+    def __setstate__(self, state):
+        self.update(state)
+
+
+class MS2(Record):
     '''
     A container for all MS2 metadata. Final MS2 objects may have empty
     or additional fields, depending on any anomalies in the data.
     '''
-    def __init__(self):
-        self.peak_counter = None
-        self.mono_mass = None
-        self.spectra_type = None
-        self.inchi_key = None
-        self.frequency = None
-        self.instrument_type = None
-        self.energy_field = None
-        self.base_peak = None
-        self.sample_mass_units = None
-        self.chromatography_type = None
-        self.searchable = None
-        self.sample_mass = None
-        self.derivative_mw = None
-        self.retention_time = None
-        self.updated_at = None
-        self.sample_assessment = None
-        self.derivative_formula = None
-        self.derivative_type = None
-        self.database_id = None
-        self.ref_text = None
-        self.mass_charge = None
-        self.collision_energy_voltage = None
-        self.sample_concentration = None
-        self.spectra_assessment = None
-        self.solvent = None
-        self.nucleus_y = None
-        self.ionization_mode = None
-        self.collection_date = None
-        self.nucleus = None
-        self.sample_temperature_units = None
-        self.sample_ph = None
-        self.spectra_id = None
-        self.c_ms_id = None
-        self.sample_concentration_units = None
-        self.sample_source = None
-        self.nil_classes = None
-        self.nucleus_x = None
-        self.database = None
-        self.notes = None
-        self.created_at = None
-        self.sample_temperature = None
-        self.ri_type = None
-        self.pubmed_id = None
-        self.molecule_id = None
-        self.column_type = None
-        self.retention_index = None
-        self.collision_energy_level = None
-        self.references = None
-        self.name = None
-        self.accession = None
-        self.chemical_formula = None
-        self.monoisotopic_molecular_weight = None
-        self.iupac_name = None
-        self.traditional_iupac = None
-        self.cas_registry = None
-        self.smiles = None
-        self.inchi = None
-        self.inchikey = None
-        self.taxonomy = None
-        self.biofluid_locations = None
-        self.id_dict = None
-        self.peaks = None
+    __slots__ = (
+        'peak_counter', 'mono_mass', 'spectra_type', 'inchi_key', 'frequency',
+        'instrument_type', 'energy_field', 'base_peak', 'sample_mass_units',
+        'chromatography_type', 'searchable', 'sample_mass', 'derivative_mw',
+        'retention_time', 'updated_at', 'sample_assessment',
+        'derivative_formula', 'derivative_type', 'database_id', 'ref_text',
+        'mass_charge', 'collision_energy_voltage', 'sample_concentration',
+        'spectra_assessment', 'solvent', 'nucleus_y', 'ionization_mode',
+        'collection_date', 'nucleus', 'sample_temperature_units', 'sample_ph',
+        'spectra_id', 'c_ms_id', 'sample_concentration_units',
+        'sample_source', 'nil_classes', 'nucleus_x', 'database', 'notes',
+        'created_at', 'sample_temperature', 'ri_type', 'pubmed_id',
+        'molecule_id', 'column_type', 'retention_index',
+        'collision_energy_level', 'references', 'name', 'accession',
+        'chemical_formula', 'monoisotopic_molecular_weight', 'iupac_name',
+        'traditional_iupac', 'cas_registry', 'smiles', 'inchi', 'inchikey',
+        'taxonomy', 'biofluid_locations', 'id_dict', 'peaks', 'peak_ids')
 
     def __str__(self):
         return 'MS2'
 
 
-class MSPeak:
+class MSPeak(Record):
     '''
     Container for data about an ms-ms peak. Final MSPeak objects may have
     empty or additional fields, depending on any anomalies in the data.
+    The mass_charge and intensity are stored as floats.
     '''
-    def __init__(self):
-        self.id = None
-        self.ms_ms_id = None
-        self.intensity = None
-        self.mass_charge = None
+    __slots__ = ('id', 'ms_ms_id', 'intensity', 'mass_charge')
+
+    def __setattr__(self, name, value):
+        if name in ('intensity', 'mass_charge') \
+                and isinstance(value, basestring) and value:
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        self._setField(name, value)
 
     def __str__(self):
         return 'MSPeak'
 
 
-class Metabolite:
+class Metabolite(Record):
     '''
     Container for metadata about a metabolite. Final Metabolite objects may have
     empty or additional fields, depending on any anomalies in the data.
     '''
+    __slots__ = (
+        'accession', 'secondary_accessions', 'name', 'chemical_formula',
+        'monisotopic_molecular_weight', 'iupac_name', 'traditional_iupac',
+        'cas_registry', 'smiles', 'inchi', 'inchikey', 'inchi_key',
+        'biofluid_locations',
+        'id_dict', 'taxonomy_dict', 'MS2')
+
     def __init__(self):
-        self.accession = None
-        self.secondary_accessions = None
-        self.name = None
-        self.chemical_formula = None
-        self.monisotopic_molecular_weight = None
-        self.iupac_name = None
-        self.traditional_iupac = None
-        self.cas_registry = None
-        self.smiles = None
-        self.inchi = None
-        self.inchikey = None
-        self.biofluid_locations = None
-        self.id_dict = None
-        self.taxonomy_dict = None
+        Record.__init__(self)
         self.MS2 = []
 
     def __str__(self):
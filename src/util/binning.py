@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""
+This file contains the vectorized m/z binning engine. All of the binning
+strategies explored in the bin_mzs notebook reduce to a sorted array of bin
+edges; peaks are assigned to bins with a single searchsorted over the flat
+peak array, and intensities are then reduced (max or sum) per row and bin.
+
+Bin i covers [edges[i], edges[i + 1]); peaks outside of
+[edges[0], edges[-1]) are dropped.
+"""
+import numpy as np
+import scipy.sparse
+
+DEFAULT_MAX_MZ = 2000.
+
+def integerEdges(mz=None, max_mz=None):
+    '''
+    Edges for one bin per integer m/z, i.e. the same as truncating m/z values
+    to integers. The upper limit is the largest finite m/z in mz, if given
+    (NaN and inf values are out of range, as in assignBins()).
+    '''
+    if max_mz is None:
+        finite = np.asarray(mz)[np.isfinite(mz)] if mz is not None else []
+        max_mz = finite.max() if len(finite) else DEFAULT_MAX_MZ
+    return np.arange(0., np.floor(max_mz) + 2.)
+
+def equalWidthEdges(n_bins, min_mz=0., max_mz=DEFAULT_MAX_MZ):
+    '''
+    Edges for n_bins bins of equal width between min_mz and max_mz.
+    '''
+    return np.linspace(min_mz, max_mz, n_bins + 1)
+
+def quantileEdges(mz, n_bins):
+    '''
+    Edges such that each bin holds roughly the same number of peaks in mz.
+    '''
+    edges = np.unique(np.percentile(mz, np.linspace(0., 100., n_bins + 1)))
+    # Make the last edge inclusive of the largest peak
+    edges[-1] = np.nextafter(edges[-1], np.inf)
+    return edges
+
+def ppmEdges(ppm, min_mz=1., max_mz=DEFAULT_MAX_MZ):
+    '''
+    Edges for bins whose width is a fixed mass accuracy, in parts per
+    million, of their m/z (so bins get wider as m/z increases).
+    '''
+    ratio = np.log1p(ppm * 1e-6)
+    n_bins = int(np.ceil(np.log(max_mz / min_mz) / ratio))
+    return min_mz * np.exp(ratio * np.arange(n_bins + 1))
+
+def logEdges(n_bins, min_mz=1., max_mz=DEFAULT_MAX_MZ):
+    '''
+    Edges for n_bins log-spaced bins between min_mz and max_mz.
+    '''
+    return np.logspace(np.log10(min_mz), np.log10(max_mz), n_bins + 1)
+
+BIN_STRATEGIES = {
+    'integer': integerEdges,
+    'width': equalWidthEdges,
+    'quantile': quantileEdges,
+    'ppm': ppmEdges,
+    'log': logEdges,
+}
+
+def makeEdges(strategy, mz=None, **params):
+    '''
+    Computes the bin edges for one of BIN_STRATEGIES.
+
+    Args:
+        strategy: 'integer', 'width', 'quantile', 'ppm' or 'log'
+        mz: flat array of all m/z values, needed by the data-dependent
+            strategies ('integer' and 'quantile')
+        params: passed to the strategy's edge function, e.g. n_bins=2000 for
+            'width' or ppm=10 for 'ppm'
+    Returns:
+        sorted (n_bins + 1,) float64 array of bin edges
+    '''
+    if strategy not in BIN_STRATEGIES:
+        raise ValueError('Unknown binning strategy: ' + str(strategy))
+    if strategy == 'integer':
+        return integerEdges(mz, **params)
+    if strategy == 'quantile':
+        return quantileEdges(mz, **params)
+    return BIN_STRATEGIES[strategy](**params)
+
+def _isEvenlySpaced(values):
+    steps = np.diff(values)
+    return len(steps) > 0 and np.allclose(steps, steps[0], rtol=1e-9, atol=0)
+
+def _searchBins(mz, edges):
+    '''
+    Bin index of every value in mz by binary search, or -1 for values outside
+    of the edges (and NaN).
+    '''
+    bins = np.searchsorted(edges, mz, side='right') - 1
+    bins[(bins < 0) | (bins >= len(edges) - 1)] = -1
+    return bins
+
+def assignBins(mz, edges):
+    '''
+    Returns the bin index of every value in mz, or -1 for values outside of
+    the edges (and NaN). The result is the same as a binary search over the
+    edges, which is what is done for uneven bins.
+    '''
+    mz = np.asarray(mz, dtype=np.float64)
+    n_bins = len(edges) - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if _isEvenlySpaced(edges):
+            # Linear (integer, equal-width) bins: compute the index directly,
+            # which is much faster than a binary search over unsorted values
+            bins = np.floor((mz - edges[0]) / (edges[1] - edges[0]))
+        elif edges[0] > 0 and _isEvenlySpaced(np.log(edges)):
+            # Geometric (ppm, log-spaced) bins are linear in log(m/z)
+            log_edges = np.log(edges)
+            bins = np.floor((np.log(mz) - log_edges[0])
+                            / (log_edges[1] - log_edges[0]))
+        else:
+            return _searchBins(mz, edges)
+        bins = np.clip(np.nan_to_num(bins), 0, n_bins - 1).astype(np.int64)
+        # Fix up values that floating point error put next to their true
+        # bin, so that edges[bins] <= mz < edges[bins + 1]
+        bins -= mz < edges[bins]
+        bins += mz >= edges[bins + 1]
+        outside = ~np.isfinite(mz) | (mz < edges[0]) | (mz >= edges[-1])
+    bins[outside] = -1
+    return bins
+
+def testAssignBins():
+    '''
+    Tests assignBins() against a binary search over the edges, for every
+    strategy in BIN_STRATEGIES, with values on and around the edges, outside
+    of them, and NaN.
+
+    Returns:
+        Boolean indicating equality
+    '''
+    rng = np.random.RandomState(0)
+    mz = np.concatenate([rng.uniform(0., 2100., 10000),
+                         [0., 1., 1000., 1999.999, 2000., 2000.5, -1.,
+                          np.nan, np.inf, -np.inf]])
+    all_edges = [integerEdges(mz),
+                 integerEdges(max_mz=2000.),
+                 equalWidthEdges(2000),
+                 equalWidthEdges(7, 3., 1000.),
+                 quantileEdges(mz[np.isfinite(mz)], 100),
+                 ppmEdges(10.),
+                 ppmEdges(50., 50., 2000.),
+                 logEdges(1000),
+                 logEdges(3, 10., 2000.)]
+    success = True
+    for edges in all_edges:
+        values = np.concatenate([mz, edges, np.nextafter(edges, -np.inf),
+                                 np.nextafter(edges, np.inf)])
+        if not np.array_equal(assignBins(values, edges),
+                              _searchBins(values, edges)):
+            success = False
+    return success
+
+def integerBins(mz):
+    '''
+    Fast path for integer binning: returns the integer m/z of each peak.
+    '''
+    return np.floor(mz).astype(np.int64)
+
+def neutralLosses(mz, offsets, parentmass):
+    '''
+    Neutral loss (parentmass - m/z) of every peak of flat peak arrays, in one
+    array operation. Peaks at or above their parentmass, and the peaks of
+    spectra without one, get a loss of -1, which is outside of every bin.
+
+    Args:
+        mz: (n_peaks,) float array
+        offsets: (n_spectra + 1,) int array; the peaks of spectrum i are
+            mz[offsets[i]:offsets[i + 1]]
+        parentmass: (n_spectra,) parentmass of each spectrum (None if
+            missing)
+    Returns:
+        (n_peaks,) float64 array
+    '''
+    parentmass = np.array(parentmass, dtype=np.float64).reshape(-1)
+    losses = np.repeat(parentmass, np.diff(offsets)) - mz
+    with np.errstate(invalid='ignore'):
+        losses[~(losses > 0)] = -1.
+    return losses
+
+def reducePeaks(rows, cols, values, shape, reduce='max'):
+    '''
+    Builds a CSR matrix from (row, col, value) triplets, combining the values
+    of duplicated (row, col) entries with a segmented max or sum.
+
+    Args:
+        rows, cols: integer arrays with the row and column of each value
+        values: array of values (e.g. intensities)
+        shape: (n_rows, n_cols) of the output matrix
+        reduce: 'max' or 'sum'
+    Returns:
+        scipy.sparse.csr_matrix
+    '''
+    if reduce == 'max':
+        reducer = np.maximum
+    elif reduce == 'sum':
+        reducer = np.add
+    else:
+        raise ValueError('Unknown reduction: ' + str(reduce))
+    # Sort on a single linear key rather than lexsorting rows and cols. Peaks
+    # are often already sorted (spectrum by spectrum, in m/z order), in which
+    # case the sort can be skipped
+    keys = np.asarray(rows, dtype=np.int64) * shape[1] + cols
+    if np.any(keys[1:] < keys[:-1]):
+        order = np.argsort(keys)
+        keys, values = keys[order], values[order]
+    if len(keys):
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        values = reducer.reduceat(values, starts)
+        keys = keys[starts]
+    rows, cols = np.divmod(keys, shape[1])
+    # The entries are sorted by row then column, so the CSR arrays can be
+    # built directly
+    indptr = np.searchsorted(rows, np.arange(shape[0] + 1))
+    return scipy.sparse.csr_matrix((values, cols, indptr), shape=shape)
+
+def binPeaks(rows, mz, intensity, edges, n_rows, reduce='max'):
+    '''
+    Bins peaks and reduces them per (row, bin). Rows can be spectra, or
+    molecules to merge all of their spectra.
+
+    Args:
+        rows: (n_peaks,) integer array with the output row of each peak
+        mz, intensity: (n_peaks,) float arrays
+        edges: bin edges, e.g. from makeEdges()
+        n_rows: number of output rows
+        reduce: 'max' or 'sum'
+    Returns:
+        (n_rows, n_bins) scipy.sparse.csr_matrix
+    '''
+    bins = assignBins(mz, edges)
+    keep = bins >= 0
+    return reducePeaks(rows[keep], bins[keep], intensity[keep],
+                       (n_rows, len(edges) - 1), reduce)
+
+def binSpectra(mz, intensity, offsets, edges, reduce='max'):
+    '''
+    Bins flat peak arrays spectrum by spectrum (the peaks of spectrum i are
+    mz[offsets[i]:offsets[i + 1]]).
+
+    Returns:
+        (n_spectra, n_bins) scipy.sparse.csr_matrix
+    '''
+    n_spectra = len(offsets) - 1
+    rows = np.repeat(np.arange(n_spectra), np.diff(offsets))
+    return binPeaks(rows, mz, intensity, edges, n_spectra, reduce)
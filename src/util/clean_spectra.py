@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+"""
+This file contains the reader and writer for clean_spectra.jsonl, the
+line-delimited replacement for the clean_spectra.json written by
+clean_csv.py.
+
+clean_spectra.json is one json object keyed by spectrum id, which has to be
+read whole before any of it can be used. clean_spectra.jsonl holds one
+spectrum per line instead, with its peaks as flat m/z and intensity lists:
+
+    {"spec_id": "<inchikey>_MS2-<i>_<ionization>", "inchi": str,
+     "parentmass": float, "kingdom": str, "class": str, "sub_class": str,
+     "ionization": str, "mz": [float, ...], "intensity": [float, ...]}
+
+so that it can be appended to, and read one spectrum at a time with
+iterSpectra(). iterSpectra() and loadSpectra() also read the old .json
+files (whole), so that the scripts that use them take either format.
+"""
+import json
+
+import numpy as np
+
+METADATA_KEYS = ('inchi', 'parentmass', 'kingdom', 'class', 'sub_class',
+                 'ionization')
+
+
+def isSpectraLines(path):
+    '''
+    Returns True if path is (to be) a line-delimited spectra file, i.e. ends
+    in .jsonl.
+    '''
+    return path.endswith('.jsonl')
+
+
+def _toRecord(spec_id, spectrum):
+    record = dict((k, spectrum[k]) for k in METADATA_KEYS if k in spectrum)
+    record['spec_id'] = spec_id
+    peaks = np.asarray(spectrum['peaks'], dtype=np.float64).reshape(-1, 2)
+    record['mz'] = peaks[:, 0].tolist()
+    record['intensity'] = peaks[:, 1].tolist()
+    return record
+
+
+def _fromRecord(record, arrays):
+    spec_id = record.pop('spec_id')
+    mz = record.pop('mz')
+    intensity = record.pop('intensity')
+    if arrays:
+        record['peaks'] = np.column_stack(
+            [np.array(mz, dtype=np.float64),
+             np.array(intensity, dtype=np.float64)]).reshape(-1, 2)
+    else:
+        record['peaks'] = [list(peak) for peak in zip(mz, intensity)]
+    return spec_id, record
+
+
+class SpectraWriter:
+    '''
+    Writes spectra to a line-delimited spectra file as they come.
+
+    Args:
+        path: file to write to
+        append: append to the file instead of overwriting it
+    '''
+    def __init__(self, path, append=False):
+        self.path = path
+        self.count = 0
+        self._file = open(path, 'a' if append else 'w')
+
+    def write(self, spec_id, spectrum):
+        '''
+        Writes one spectrum, a dict as in clean_spectra.json (with its peaks
+        as [mz, intensity] pairs or an (n, 2) array).
+        '''
+        self._file.write(json.dumps(_toRecord(spec_id, spectrum),
+                                    separators=(',', ':')))
+        self._file.write('\n')
+        self.count += 1
+
+    def writeMany(self, spectra):
+        '''
+        Writes a {spec_id: spectrum} dictionary of spectra.
+        '''
+        for spec_id, spectrum in spectra.iteritems():
+            self.write(spec_id, spectrum)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def writeSpectra(spectra, path):
+    '''
+    Writes a {spec_id: spectrum} dictionary to path, line-delimited if path
+    ends in .jsonl (see isSpectraLines()), and as one json object otherwise.
+    '''
+    if isSpectraLines(path):
+        with SpectraWriter(path) as writer:
+            for spec_id in sorted(spectra):
+                writer.write(spec_id, spectra[spec_id])
+    else:
+        # json.dumps() uses the C encoder, which json.dump() doesn't
+        with open(path, 'w') as f:
+            f.write(json.dumps(spectra))
+
+
+def _keep(spectrum, ionization, taxonomy):
+    if ionization is not None and spectrum.get('ionization') != ionization:
+        return False
+    if taxonomy:
+        for level, value in taxonomy.iteritems():
+            if spectrum.get(level) != value:
+                return False
+    return True
+
+
+def iterSpectra(path, ionization=None, taxonomy=None, arrays=False):
+    '''
+    Reads the spectra of a line-delimited spectra file one at a time. Old
+    .json files are read whole, and then yielded one at a time.
+
+    Args:
+        path: clean_spectra.jsonl (or .json) file
+        ionization: if given, only yield spectra with this ionization mode
+        taxonomy: if given, {level: value} dict (e.g. {'kingdom': 'Organic
+            compounds'}); only yield spectra with these labels
+        arrays: give the peaks as (n, 2) float64 arrays rather than lists of
+            [mz, intensity] pairs
+    Yields:
+        (spec_id, spectrum) pairs, spectrum as in clean_spectra.json
+    '''
+    with open(path, 'r') as f:
+        if not isSpectraLines(path):
+            spectra = json.load(f)
+            for spec_id in sorted(spectra):
+                spectrum = spectra[spec_id]
+                if _keep(spectrum, ionization, taxonomy):
+                    if arrays:
+                        spectrum['peaks'] = np.asarray(
+                            spectrum['peaks'],
+                            dtype=np.float64).reshape(-1, 2)
+                    yield spec_id, spectrum
+            return
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if _keep(record, ionization, taxonomy):
+                yield _fromRecord(record, arrays)
+
+
+def loadSpectra(path, **filters):
+    '''
+    Reads a spectra file (.jsonl or .json) into a {spec_id: spectrum}
+    dictionary. Takes the same filters as iterSpectra().
+    '''
+    return dict(iterSpectra(path, **filters))
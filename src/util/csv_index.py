@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+"""
+This file contains the byte-offset index for random access into
+metabolites_and_spectra.csv (see writeToCSV() in src/data/parse_xml_files.py).
+
+In the csv, every metabolite row is followed by the rows of its MS2 spectra,
+so each metabolite is one contiguous byte range of the file. The index maps
+each metabolite's inchikey (the first cell of its row) to that range, so that
+a metabolite can be read with one seek and one read instead of unpacking the
+whole csv with unpackCSV().
+
+The index is saved next to the csv, as <csv>.index.npz:
+
+    keys      (n,) sorted inchikeys
+    starts    (n,) int64 offset of each metabolite's row
+    stops     (n,) int64 offset just past its last MS2 row
+    size      size of the csv when it was indexed
+    mtime     modification time of the csv when it was indexed
+
+and is rebuilt whenever the csv's size or modification time change.
+"""
+import csv
+import os
+
+import numpy as np
+
+from util import iterCSVRows
+
+
+def indexPath(csv_path):
+    '''
+    Path of the index saved next to a csv.
+    '''
+    return csv_path + '.index.npz'
+
+
+def _iterRowOffsets(f):
+    '''
+    Reads the rows of a csv opened in binary mode, along with the byte offset
+    of the start of each row and of the end of the row. Rows may span several
+    lines (quoted newlines).
+
+    Yields:
+        (row, start, stop)
+    '''
+    position = [0]
+
+    def lines():
+        for line in f:
+            position[0] += len(line)
+            yield line
+
+    start = 0
+    for row in csv.reader(lines()):
+        yield row, start, position[0]
+        start = position[0]
+
+
+def buildIndex(csv_path):
+    '''
+    Scans a csv for the byte range of every metabolite.
+
+    Returns:
+        (keys, starts, stops) arrays, sorted by key. If an inchikey occurs
+        more than once, its last occurrence is kept, as in unpackCSV().
+    '''
+    ranges = dict()
+    key = None
+    with open(csv_path, 'rb') as f:
+        for row, start, stop in _iterRowOffsets(f):
+            if not row:
+                continue
+            if row[0]:
+                key = row[0]
+                ranges[key] = [start, stop]
+            elif key is not None:
+                ranges[key][1] = stop
+    keys = sorted(ranges)
+    starts = np.array([ranges[k][0] for k in keys], dtype=np.int64)
+    stops = np.array([ranges[k][1] for k in keys], dtype=np.int64)
+    return np.array(keys, dtype=str), starts, stops
+
+
+def loadIndex(csv_path):
+    '''
+    Returns the index of a csv (see buildIndex()). The index is saved next to
+    the csv (see indexPath()), and read back from there as long as the csv's
+    size and modification time are unchanged, so that the csv is only
+    scanned once.
+    '''
+    fname = indexPath(csv_path)
+    stat = os.stat(csv_path)
+    if os.path.isfile(fname):
+        index = np.load(fname)
+        if index['size'] == stat.st_size and index['mtime'] == stat.st_mtime:
+            return index['keys'], index['starts'], index['stops']
+    keys, starts, stops = buildIndex(csv_path)
+    try:
+        with open(fname + '.tmp', 'wb') as f:
+            np.savez(f, keys=keys, starts=starts, stops=stops,
+                     size=stat.st_size, mtime=stat.st_mtime)
+        os.rename(fname + '.tmp', fname)
+    except (IOError, OSError):
+        # e.g. a read-only data directory; the index is only a cache
+        pass
+    return keys, starts, stops
+
+
+class CSVIndex:
+    '''
+    Random access to the metabolites of a csv written by writeToCSV(). The
+    metabolites are only read and unpacked when asked for.
+
+    Args:
+        csv_path: path to the csv
+    '''
+    def __init__(self, csv_path):
+        self.csv_path = csv_path
+        self.keys, self.starts, self.stops = loadIndex(csv_path)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, inchikey):
+        return self._position(inchikey) is not None
+
+    def __getitem__(self, inchikey):
+        metabolite = self.get(inchikey)
+        if metabolite is None:
+            raise KeyError(inchikey)
+        return metabolite
+
+    def _position(self, inchikey):
+        if isinstance(inchikey, unicode):
+            inchikey = inchikey.encode('utf-8')
+        if not inchikey or not len(self.keys):
+            return None
+        i = int(np.searchsorted(self.keys, inchikey))
+        if i < len(self.keys) and self.keys[i] == inchikey:
+            return i
+        return None
+
+    def _read(self, f, i):
+        f.seek(int(self.starts[i]))
+        data = f.read(int(self.stops[i] - self.starts[i]))
+        for metabolite in iterCSVRows(csv.reader(data.splitlines(True))):
+            return metabolite
+
+    def get(self, inchikey, default=None):
+        '''
+        Reads one metabolite, w/populated MS2.
+
+        Returns:
+            Metabolite, or default if the inchikey is not in the csv
+        '''
+        i = self._position(inchikey)
+        if i is None:
+            return default
+        with open(self.csv_path, 'rb') as f:
+            return self._read(f, i)
+
+    def iterMetabolites(self, inchikeys=None):
+        '''
+        Reads metabolites one at a time, in file order, so that the file is
+        read front to back.
+
+        Args:
+            inchikeys: inchikeys of the metabolites to read; those not in the
+                csv are skipped [default: all of them]
+        Yields:
+            Metabolite objects w/populated MS2
+        '''
+        if inchikeys is None:
+            positions = range(len(self.keys))
+        else:
+            positions = [self._position(inchikey) for inchikey in inchikeys]
+            positions = set(i for i in positions if i is not None)
+        positions = sorted(positions, key=lambda i: self.starts[i])
+        with open(self.csv_path, 'rb') as f:
+            for i in positions:
+                yield self._read(f, i)
+
+    def getMany(self, inchikeys):
+        '''
+        Reads several metabolites (see iterMetabolites()).
+
+        Returns:
+            {inchikey:Metabolite} dictionary of those found in the csv
+        '''
+        return dict((metabolite.inchikey, metabolite)
+                    for metabolite in self.iterMetabolites(inchikeys))
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+"""
+This file contains the reader and writer for columnar feature tables, the
+binary replacement for the wide tab-separated feature tables (raw_mz.*.txt,
+mz_integer.*.txt, ms2lda_feature_table*.txt).
+
+A columnar feature table is a directory with a schema.json and compressed
+.npz files:
+
+    schema.json        version, number of rows, the label and feature column
+                       names, the numeric value of each feature column (e.g.
+                       its m/z bin, if it has one), and the row groups
+    labels.npz         one (n_rows,) unicode array per label column
+    rows.<i>.npz       row group i: its feature values as float32 column
+                       chunks c0, c1, ... of up to column_chunk columns each
+
+Rows are sorted by their taxonomy labels and cut into row groups, and the
+schema lists the distinct taxonomy labels in each row group, so that
+loadFeatureTable() can skip the row groups without any of the wanted labels.
+Column chunks are stored (and decompressed) separately, so that only the
+chunks holding the wanted columns are read.
+"""
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+SCHEMA_FILE = 'schema.json'
+FEATURE_TABLE_VERSION = 1
+ROW_GROUP_SIZE = 1024
+COLUMN_CHUNK_SIZE = 512
+# Labels that rows are sorted by and that row groups keep statistics on
+TAXONOMY_LABELS = ['kingdom', 'class', 'sub_class']
+
+
+def isFeatureTable(path):
+    '''
+    Returns True if path is a columnar feature table directory.
+    '''
+    return os.path.isfile(os.path.join(path, SCHEMA_FILE))
+
+
+def readSchema(path):
+    '''
+    Reads the schema.json of a columnar feature table.
+    '''
+    with open(os.path.join(path, SCHEMA_FILE), 'r') as f:
+        schema = json.load(f)
+    if schema['version'] != FEATURE_TABLE_VERSION:
+        raise ValueError('Unsupported feature table version: '
+                         + str(schema['version']))
+    return schema
+
+
+def _labelArray(values):
+    return np.array([u'' if v is None else unicode(v) for v in values],
+                    dtype=np.unicode_)
+
+
+def _block(features, rows, start, stop):
+    '''
+    Dense float32 values of features[rows, start:stop].
+    '''
+    if scipy.sparse.issparse(features):
+        return features[:, start:stop].toarray().astype(np.float32)
+    return np.asarray(features[rows, start:stop], dtype=np.float32)
+
+
+def writeFeatureTable(path, features, feature_columns, labels,
+                      feature_values=None, row_group_size=ROW_GROUP_SIZE,
+                      column_chunk=COLUMN_CHUNK_SIZE):
+    '''
+    Writes a columnar feature table.
+
+    Args:
+        path: directory to write to (created if needed)
+        features: (n_rows, n_features) array or scipy.sparse matrix
+        feature_columns: (n_features,) names of the feature columns
+        labels: list of (label column name, (n_rows,) values) pairs, in
+            column order
+        feature_values: (n_features,) numeric value of each feature column,
+            e.g. its m/z bin; allows selecting columns by value range
+        row_group_size: number of rows per row group
+        column_chunk: number of columns per stored column chunk
+    '''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    n_rows, n_features = features.shape
+    label_arrays = [(name, _labelArray(values)) for name, values in labels]
+    label_dict = dict(label_arrays)
+    sort_keys = [label_dict[label] for label in reversed(TAXONOMY_LABELS)
+                 if label in label_dict]
+    order = np.lexsort(sort_keys) if sort_keys else np.arange(n_rows)
+    if scipy.sparse.issparse(features):
+        features = features.tocsr()
+
+    row_groups = []
+    for i, start in enumerate(xrange(0, max(n_rows, 1), row_group_size)):
+        rows = order[start:start + row_group_size]
+        if scipy.sparse.issparse(features):
+            group = features[rows].tocsc()
+        else:
+            group = features
+        chunks = dict(('c%d' % j, _block(group, rows, low,
+                                         low + column_chunk))
+                      for j, low in enumerate(xrange(0, n_features,
+                                                     column_chunk)))
+        np.savez_compressed(os.path.join(path, 'rows.%d.npz' % i), **chunks)
+        stats = dict((label, sorted(set(label_dict[label][rows])))
+                     for label in TAXONOMY_LABELS if label in label_dict)
+        row_groups.append({'n_rows': len(rows), 'labels': stats})
+
+    np.savez_compressed(os.path.join(path, 'labels.npz'),
+                        **dict((name, values[order])
+                               for name, values in label_arrays))
+    if feature_values is not None:
+        feature_values = [float(v) for v in feature_values]
+    schema = {'version': FEATURE_TABLE_VERSION,
+              'n_rows': n_rows,
+              'label_columns': [name for name, values in label_arrays],
+              'feature_columns': [unicode(c) for c in feature_columns],
+              'feature_values': feature_values,
+              'column_chunk': column_chunk,
+              'row_groups': row_groups}
+    with open(os.path.join(path, SCHEMA_FILE), 'w') as f:
+        json.dump(schema, f)
+
+
+def writeSpectrumMatrix(matrix, path, **options):
+    '''
+    Writes a SpectrumMatrix (see spectrum_matrix.py) as a columnar feature
+    table, with only the columns that have a peak, as in the wide text
+    tables. Takes the options of writeFeatureTable().
+    '''
+    used = np.unique(matrix.matrix.indices)
+    names = np.array(matrix.featureNames(), dtype=object)[used]
+    labels = [(label, matrix.labels[label])
+              for label in ['inchi'] + TAXONOMY_LABELS]
+    writeFeatureTable(path, matrix.matrix.tocsr()[:, used], names, labels,
+                      feature_values=np.asarray(matrix.columns)[used],
+                      **options)
+
+
+def writeDataFrame(df, path, label_columns, **options):
+    '''
+    Writes a wide dataframe as a columnar feature table: label_columns are
+    stored as labels, and all other columns as float32 features. Takes the
+    options of writeFeatureTable().
+    '''
+    feature_columns = [c for c in df.columns if c not in label_columns]
+    labels = [(label, df[label].values) for label in label_columns]
+    writeFeatureTable(path, df[feature_columns].values, feature_columns,
+                      labels, **options)
+
+
+class FeatureTable:
+    '''
+    The rows and columns read from a columnar feature table.
+
+    Attributes:
+        X: (n_rows, n_features) float32 array
+        feature_columns: (n_features,) names of the feature columns
+        feature_values: (n_features,) float64 value of each feature column,
+            or None if the table has none
+        labels: {label: (n_rows,) unicode array} for each label column
+        label_columns: names of the label columns, in column order
+    '''
+    def __init__(self, X, feature_columns, feature_values, labels,
+                 label_columns):
+        self.X = X
+        self.feature_columns = feature_columns
+        self.feature_values = feature_values
+        self.labels = labels
+        self.label_columns = label_columns
+
+    @property
+    def shape(self):
+        return self.X.shape
+
+    def toDataFrame(self):
+        '''
+        Returns the table as a wide dataframe: the feature columns followed
+        by the label columns.
+        '''
+        df = pd.DataFrame(self.X, columns=self.feature_columns)
+        for label in self.label_columns:
+            df[label] = self.labels[label]
+        return df
+
+
+def _selectColumns(schema, columns, column_range):
+    names = schema['feature_columns']
+    keep = np.arange(len(names))
+    if columns is not None:
+        positions = dict((name, j) for j, name in enumerate(names))
+        keep = np.array([positions[unicode(c)] for c in columns],
+                        dtype=np.int64)
+    if column_range is not None:
+        low, high = column_range
+        if schema['feature_values'] is not None:
+            values = np.array(schema['feature_values'])[keep]
+            keep = keep[(values >= low) & (values <= high)]
+        else:
+            # Names of the first and last column, as with df.loc[:, low:high]
+            first = names.index(unicode(low))
+            last = names.index(unicode(high))
+            keep = keep[(keep >= first) & (keep <= last)]
+    return keep
+
+
+def _wantedGroup(group, where):
+    for label, values in where.iteritems():
+        stats = group['labels'].get(label)
+        if stats is not None and not set(stats) & values:
+            return False
+    return True
+
+
+def loadFeatureTable(path, columns=None, column_range=None, where=None):
+    '''
+    Reads a columnar feature table, only decompressing the row groups and
+    column chunks that are asked for.
+
+    Args:
+        path: directory written by writeFeatureTable()
+        columns: names of the feature columns to read [default: all]
+        column_range: (low, high) to only read the feature columns with a
+            value between low and high (inclusive) if the table has
+            feature values, or else the columns from the one named low to
+            the one named high, as df.loc[:, low:high] would
+        where: {label: value or list of values} to only read the rows with
+            these labels, e.g. {'kingdom': 'Organic compounds'}
+    Returns:
+        FeatureTable, with the rows in stored order (sorted by taxonomy)
+    '''
+    schema = readSchema(path)
+    keep = _selectColumns(schema, columns, column_range)
+    chunk = schema['column_chunk']
+    where = dict((label, set([unicode(values)])
+                  if isinstance(values, basestring)
+                  else set(unicode(v) for v in values))
+                 for label, values in (where or {}).iteritems())
+
+    all_labels = np.load(os.path.join(path, 'labels.npz'))
+    all_labels = dict((label, all_labels[label])
+                      for label in schema['label_columns'])
+    blocks = []
+    selected = []
+    start = 0
+    for i, group in enumerate(schema['row_groups']):
+        stop = start + group['n_rows']
+        if not group['n_rows'] or not _wantedGroup(group, where):
+            start = stop
+            continue
+        mask = np.ones(group['n_rows'], dtype=bool)
+        for label, values in where.iteritems():
+            mask &= np.in1d(all_labels[label][start:stop], list(values))
+        rows = np.flatnonzero(mask)
+        if len(rows):
+            data = np.load(os.path.join(path, 'rows.%d.npz' % i))
+            block = np.empty((len(rows), len(keep)), dtype=np.float32)
+            chunk_of = keep // chunk
+            for c in np.unique(chunk_of):
+                in_chunk = np.flatnonzero(chunk_of == c)
+                values = data['c%d' % c][rows]
+                block[:, in_chunk] = values[:, keep[in_chunk] - c * chunk]
+            blocks.append(block)
+            selected.append(start + rows)
+        start = stop
+
+    if blocks:
+        X = np.concatenate(blocks)
+        selected = np.concatenate(selected)
+    else:
+        X = np.empty((0, len(keep)), dtype=np.float32)
+        selected = np.empty(0, dtype=np.int64)
+    labels = dict((label, values[selected])
+                  for label, values in all_labels.iteritems())
+    feature_values = schema['feature_values']
+    if feature_values is not None:
+        feature_values = np.array(feature_values, dtype=np.float64)[keep]
+    names = schema['feature_columns']
+    return FeatureTable(X, [names[j] for j in keep], feature_values, labels,
+                        schema['label_columns'])
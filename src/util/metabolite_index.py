@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+This file contains the join index used to match MS2 spectra to their HMDB
+metabolites (see matchMS2s() in src/data/parse_xml_files.py), and the side
+file that spectra without a match are written to.
+
+A spectrum is matched to a metabolite by the first of these that succeeds:
+
+    inchikey             the spectrum's inchi_key, as is and then
+                         normalised (upper case, without an 'InChIKey='
+                         prefix)
+    accession            the spectrum's HMDB database id, against the
+                         metabolites' accessions. Old 5-digit accessions
+                         (HMDB00001) are padded to the current 7 digits.
+    secondary_accession  the same, against the metabolites'
+                         secondary_accessions
+    inchikey_block       the first (connectivity) block of the inchikey, if
+                         only one metabolite has it
+
+Spectra without a match are streamed to a side file, one json record per
+line, instead of being kept in memory.
+"""
+import json
+import re
+
+import numpy as np
+
+from MetabolomicsObjects import MS2
+
+_HMDB_ACCESSION = re.compile(r'HMDB0*(\d+)$')
+
+# Names of the ways a spectrum can be matched, in order of precedence
+MATCH_KINDS = ('inchikey', 'accession', 'secondary_accession',
+               'inchikey_block')
+
+
+def normalizeInchikey(inchikey):
+    '''
+    Upper cases an inchikey and strips any 'InChIKey=' prefix. Returns None
+    for empty values.
+    '''
+    if not inchikey:
+        return None
+    inchikey = inchikey.strip().upper()
+    if inchikey.startswith('INCHIKEY='):
+        inchikey = inchikey[len('INCHIKEY='):]
+    return inchikey or None
+
+
+def normalizeAccession(accession):
+    '''
+    Normalises an HMDB accession to the current 7-digit form (HMDB00001 ->
+    HMDB0000001). Other ids are upper cased. Returns None for empty values.
+    '''
+    if not accession:
+        return None
+    accession = accession.strip().upper()
+    match = _HMDB_ACCESSION.match(accession)
+    if match:
+        return 'HMDB%07d' % int(match.group(1))
+    return accession or None
+
+
+def spectrumAccession(ms2_object):
+    '''
+    The HMDB database id of a spectrum: its database_id (or id_dict entry),
+    or else the database id of its HMDB reference.
+    '''
+    id_dict = ms2_object.id_dict or {}
+    accession = id_dict.get('database_id') or ms2_object.database_id
+    if not accession:
+        references = getattr(ms2_object, 'references_dict', None) or {}
+        if references.get('database') == 'HMDB':
+            accession = references.get('database_id')
+    return accession or None
+
+
+class MetaboliteIndex:
+    '''
+    Hash-join index from the spectra's keys to the metabolites. See the
+    module docstring for the keys.
+
+    Args:
+        metabolites: iterable of Metabolite objects to index; more can be
+            added with add()
+    '''
+    def __init__(self, metabolites=()):
+        self.by_inchikey = dict()
+        self.by_accession = dict()
+        self.by_secondary_accession = dict()
+        # First inchikey block to the metabolite's inchikey, or None if the
+        # block is shared by several metabolites
+        self.by_block = dict()
+        for metabolite in metabolites:
+            self.add(metabolite)
+
+    def add(self, metabolite):
+        '''
+        Indexes one metabolite under its inchikey, accessions and inchikey
+        block. Lookups return the metabolite's inchikey, i.e. its key in the
+        {inchikey: Metabolite} dictionaries.
+        '''
+        key = metabolite.inchikey
+        if key is None:
+            return
+        self.by_inchikey[key] = key
+        inchikey = normalizeInchikey(key)
+        if inchikey is not None:
+            self.by_inchikey.setdefault(inchikey, key)
+            block = inchikey.split('-', 1)[0]
+            if self.by_block.get(block, key) != key:
+                self.by_block[block] = None
+            else:
+                self.by_block[block] = key
+        accession = normalizeAccession(metabolite.accession)
+        if accession is not None:
+            self.by_accession[accession] = key
+        for secondary in metabolite.secondary_accessions or []:
+            secondary = normalizeAccession(secondary)
+            if secondary is not None:
+                self.by_secondary_accession.setdefault(secondary, key)
+
+    def lookup(self, inchikey, accession=None):
+        '''
+        Finds the metabolite of a spectrum.
+
+        Args:
+            inchikey: the spectrum's inchi_key
+            accession: the spectrum's HMDB database id (see
+                spectrumAccession())
+        Returns:
+            (metabolite inchikey, kind of match in MATCH_KINDS), or
+            (None, None) if there is no match
+        '''
+        if inchikey is not None:
+            key = self.by_inchikey.get(inchikey)
+            if key is None:
+                inchikey = normalizeInchikey(inchikey)
+                key = self.by_inchikey.get(inchikey)
+            if key is not None:
+                return key, 'inchikey'
+        accession = normalizeAccession(accession)
+        if accession is not None:
+            key = self.by_accession.get(accession)
+            if key is not None:
+                return key, 'accession'
+            key = self.by_secondary_accession.get(accession)
+            if key is not None:
+                return key, 'secondary_accession'
+        if inchikey is not None:
+            key = self.by_block.get(inchikey.split('-', 1)[0])
+            if key is not None:
+                return key, 'inchikey_block'
+        return None, None
+
+    def lookupBatch(self, ms2_objects):
+        '''
+        Finds the metabolites of a batch of spectra (see lookup()).
+
+        Returns:
+            list of (metabolite inchikey, kind of match) pairs, one per
+            spectrum
+        '''
+        return [self.lookup(ms2_object.inchi_key,
+                            spectrumAccession(ms2_object))
+                for ms2_object in ms2_objects]
+
+
+def _jsonValue(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+
+class SpillFile:
+    '''
+    Writes MS2 objects to a json-lines side file as they come, so that they
+    need not be held in memory. Read them back with iterSpillFile().
+
+    Args:
+        path: file to write to (overwritten)
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._file = open(path, 'w')
+
+    def write(self, ms2_object):
+        record = dict((attribute, _jsonValue(value)) for attribute, value
+                      in ms2_object.attributes().iteritems()
+                      if value is not None
+                      and not (isinstance(value, basestring) and not value))
+        self._file.write(json.dumps(record, separators=(',', ':')))
+        self._file.write('\n')
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iterSpillFile(path):
+    '''
+    Reads back the MS2 objects written to a SpillFile, with their peaks as
+    (n, 2) arrays.
+    '''
+    with open(path, 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            ms2_object = MS2()
+            ms2_object.update(dict((str(attribute), value) for attribute,
+                                   value in record.iteritems()))
+            if ms2_object.peaks is not None:
+                ms2_object.peaks = np.array(
+                    ms2_object.peaks, dtype=np.float64).reshape(-1, 2)
+            if ms2_object.peak_ids is not None:
+                ms2_object.peak_ids = np.array(ms2_object.peak_ids,
+                                               dtype=np.int64)
+            yield ms2_object
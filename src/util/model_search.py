@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+"""
+This file contains the hyperparameter search engine used by the Trainer in
+data/analysis/classification_results/classification.py, in place of one
+GridSearchCV per model.
+
+All (task, candidate params, fold) cells of all search tasks, e.g. every
+feature table x taxonomy level x model, are fitted through one process pool.
+Each cell's scores are cached on disk, keyed by a hash of the task's data,
+folds and split seed, the estimator and its params, and the number of
+training samples, so re-running a sweep skips every cell that already
+finished.
+
+With successive halving, each task starts all of its candidates on a small
+subsample of every training fold, keeps the best 1/eta of them, and
+multiplies the number of training samples by eta, until the last candidates
+are fitted on the full folds. Bad candidates (and the expensive ones, like
+the 5000-tree forests) are only ever fitted on small subsamples.
+"""
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+from sklearn.base import clone
+from sklearn.model_selection import ParameterGrid
+
+
+class SearchTask:
+    '''
+    One hyperparameter search: an estimator, its param grid, and the data
+    and cross-validation folds to score the candidates on.
+
+    Args:
+        name: unique name of the task, e.g. 'binned/class/SVM'
+        estimator: unfitted sklearn estimator; candidates are clones of it
+            with the grid params set
+        param_grid: dict of param name to list of values, as for GridSearchCV
+        X: feature matrix (dense array, DataFrame or scipy.sparse matrix)
+        Y: labels
+        cv: sklearn splitter (e.g. StratifiedShuffleSplit) or list of
+            (train, test) index arrays. Splitters should have a fixed
+            random_state, so that cached cells can be reused.
+        seed: random_state the data split and cv were drawn with, if any;
+            part of the cache key
+    '''
+    def __init__(self, name, estimator, param_grid, X, Y, cv, seed=None):
+        self.name = name
+        self.seed = seed
+        self.estimator = estimator
+        self.candidates = list(ParameterGrid(param_grid))
+        if isinstance(X, pd.DataFrame):
+            X = X.values
+        self.X = X.tocsr() if scipy.sparse.issparse(X) else np.asarray(X)
+        self.Y = np.asarray(Y).ravel()
+        if hasattr(cv, 'split'):
+            cv = list(cv.split(self.X, self.Y))
+        self.folds = [(np.asarray(train), np.asarray(test))
+                      for train, test in cv]
+        self.data_hash = self._hashData()
+
+    def _hashData(self):
+        h = hashlib.sha1()
+        if scipy.sparse.issparse(self.X):
+            arrays = [self.X.data, self.X.indices, self.X.indptr,
+                      np.array(self.X.shape)]
+        else:
+            arrays = [np.ascontiguousarray(self.X), np.array(self.X.shape)]
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            if array.dtype == object:
+                # The bytes of an object array are pointers
+                h.update(json.dumps([unicode(v) for v in array.ravel()]))
+            else:
+                h.update(array.view(np.uint8))
+        h.update(json.dumps([unicode(y) for y in self.Y]))
+        h.update(json.dumps(self.seed))
+        for train, test in self.folds:
+            h.update(train.astype(np.int64).tobytes())
+            h.update(test.astype(np.int64).tobytes())
+        return h.hexdigest()
+
+    def cellKey(self, params, fold, n_train):
+        '''
+        Cache key of one (candidate, fold, number of training samples) cell.
+        '''
+        estimator = clone(self.estimator).set_params(**params)
+        description = json.dumps(
+            [self.data_hash, type(estimator).__name__,
+             sorted((k, repr(v)) for k, v in estimator.get_params().items()),
+             fold, n_train])
+        return hashlib.sha1(description).hexdigest()
+
+
+class SearchResult:
+    '''
+    Outcome of one SearchTask.
+
+    Attributes:
+        best_params: params of the best candidate in the last round
+        best_score: its mean test score over the folds
+        cv_results: DataFrame with one row per (round, candidate), with the
+            params, number of training samples and mean/std train and test
+            scores
+    '''
+    def __init__(self, best_params, best_score, cv_results):
+        self.best_params = best_params
+        self.best_score = best_score
+        self.cv_results = cv_results
+
+
+# Search tasks shared with the worker processes, set once per worker by
+# _initSearchWorker()
+_worker_tasks = None
+
+def _initSearchWorker(tasks):
+    global _worker_tasks
+    _worker_tasks = tasks
+
+def _fitCell(job):
+    '''
+    Worker function: fits one candidate on (the first n_train samples of)
+    one training fold and scores it.
+    '''
+    name, candidate, fold, n_train = job
+    task = _worker_tasks[name]
+    train, test = task.folds[fold]
+    train = train[:n_train]
+    estimator = clone(task.estimator).set_params(**task.candidates[candidate])
+    t0 = time.time()
+    try:
+        estimator.fit(task.X[train], task.Y[train])
+        test_score = estimator.score(task.X[test], task.Y[test])
+        train_score = estimator.score(task.X[train], task.Y[train])
+    except ValueError:
+        # e.g. a subsample with a single class; ranks the candidate last
+        test_score = train_score = float('nan')
+    return {'test_score': test_score, 'train_score': train_score,
+            'fit_time': time.time() - t0}
+
+def _roundSizes(task, eta, min_resources, halving):
+    '''
+    Number of training samples in each round of a task's search.
+    '''
+    n_train = min(len(train) for train, _ in task.folds)
+    if not halving or len(task.candidates) == 1:
+        return [n_train]
+    n_rounds = int(math.ceil(math.log(len(task.candidates), eta))) + 1
+    sizes = [int(n_train / eta ** (n_rounds - 1 - r)) for r in range(n_rounds)]
+    return sorted(set(min(max(size, min_resources), n_train)
+                      for size in sizes))
+
+def _readCache(cache_dir, key):
+    if cache_dir is None:
+        return None
+    fname = os.path.join(cache_dir, key + '.json')
+    if not os.path.isfile(fname):
+        return None
+    with open(fname, 'r') as f:
+        return json.load(f)
+
+def _writeCache(cache_dir, key, result):
+    if cache_dir is None:
+        return
+    fname = os.path.join(cache_dir, key + '.json')
+    with open(fname + '.tmp', 'w') as f:
+        json.dump(result, f)
+    os.rename(fname + '.tmp', fname)
+
+def searchAll(tasks, processes=None, cache_dir=None, halving=True, eta=3,
+              min_resources=50):
+    '''
+    Runs the hyperparameter searches of all tasks through one process pool.
+
+    Args:
+        tasks: list of SearchTasks
+        processes: number of worker processes [default: number of cores]
+        cache_dir: directory to cache the cell scores in. If None, nothing is
+            cached.
+        halving: use successive halving; otherwise every candidate is
+            fitted on the full folds, like GridSearchCV
+        eta: with halving, the fraction (1/eta) of candidates kept, and the
+            factor the number of training samples grows by, each round
+        min_resources: with halving, the smallest number of training samples
+            a candidate is fitted on
+    Returns:
+        {task name: SearchResult}
+    '''
+    if cache_dir is not None and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    by_name = dict((task.name, task) for task in tasks)
+    sizes = dict((task.name, _roundSizes(task, eta, min_resources, halving))
+                 for task in tasks)
+    alive = dict((task.name, range(len(task.candidates))) for task in tasks)
+    rows = dict((task.name, []) for task in tasks)
+
+    pool = multiprocessing.Pool(processes, initializer=_initSearchWorker,
+                                initargs=(by_name,))
+    try:
+        n_rounds = max(len(s) for s in sizes.values()) if tasks else 0
+        for r in range(n_rounds):
+            # Tasks with fewer rounds finish early
+            active = [task for task in tasks if r < len(sizes[task.name])]
+            jobs = [(task.name, candidate, fold, sizes[task.name][r])
+                    for task in active
+                    for candidate in alive[task.name]
+                    for fold in range(len(task.folds))]
+            keys = [by_name[name].cellKey(by_name[name].candidates[c], fold, n)
+                    for name, c, fold, n in jobs]
+            results = [_readCache(cache_dir, key) for key in keys]
+            todo = [i for i, result in enumerate(results) if result is None]
+            print('Search round {}: {} cells, {} cached'.format(
+                r + 1, len(jobs), len(jobs) - len(todo)))
+            fitted = pool.imap(_fitCell, [jobs[i] for i in todo])
+            for i, result in itertools.izip(todo, fitted):
+                _writeCache(cache_dir, keys[i], result)
+                results[i] = result
+
+            scores = dict()
+            for (name, candidate, fold, n_train), result in zip(jobs, results):
+                scores.setdefault((name, candidate), []).append(result)
+            for task in active:
+                n_train = sizes[task.name][r]
+                means = []
+                for candidate in alive[task.name]:
+                    cells = scores[(task.name, candidate)]
+                    test = [c['test_score'] for c in cells]
+                    train = [c['train_score'] for c in cells]
+                    row = {'iter': r, 'n_resources': n_train,
+                           'params': task.candidates[candidate],
+                           'mean_test_score': np.mean(test),
+                           'std_test_score': np.std(test),
+                           'mean_train_score': np.mean(train),
+                           'std_train_score': np.std(train),
+                           'mean_fit_time': np.mean(
+                               [c['fit_time'] for c in cells])}
+                    for param, value in task.candidates[candidate].items():
+                        row['param_' + param] = value
+                    rows[task.name].append(row)
+                    means.append(row['mean_test_score'])
+                # Keep the best 1/eta candidates (failed fits rank last)
+                means = np.array(means)
+                means[np.isnan(means)] = -np.inf
+                order = np.argsort(-means, kind='mergesort')
+                n_keep = (int(math.ceil(len(order) / float(eta)))
+                          if r < len(sizes[task.name]) - 1 else 1)
+                alive[task.name] = [alive[task.name][i]
+                                    for i in order[:n_keep]]
+    finally:
+        pool.close()
+        pool.join()
+
+    search_results = dict()
+    for task in tasks:
+        cv_results = pd.DataFrame(rows[task.name])
+        best = task.candidates[alive[task.name][0]]
+        last = cv_results[cv_results['iter'] == cv_results['iter'].max()]
+        best_score = last['mean_test_score'].max()
+        cv_results['rank_test_score'] = (
+            cv_results.groupby('iter')['mean_test_score']
+            .rank(ascending=False, method='min'))
+        search_results[task.name] = SearchResult(best, best_score, cv_results)
+    return search_results
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""
+This file contains the local MS2LDA motif decomposition engine. It fits the
+motif proportions of each spectrum against a fixed, pre-learned motif set
+(e.g. the massbank_motifset that ms2lda.org decomposes against), which is
+what the ms2lda.org batch_decompose API does, but offline.
+
+A motif set is a json file:
+
+    {"name": "massbank_motifset",
+     "tolerance": 0.005,
+     "alpha": 0.1,
+     "motifs": {"motif_0": {"fragment_53.0390": 0.12,
+                            "loss_18.0106": 0.05, ...}, ...},
+     "annotations": {"motif_0": "Water loss", ...}}
+
+Features are MS2LDA words: fragment_<m/z> for fragment peaks and loss_<m/z>
+for neutral losses from the parent mass. "tolerance" (the m/z tolerance in
+Da for matching peaks to features), "alpha" (the Dirichlet prior on motif
+proportions, one value or one per motif) and "annotations" are optional.
+
+Each spectrum is turned into word counts, with intensities scaled so that the
+base peak counts for intensity_scale words, and the motif proportions are
+fitted with the variational LDA E-step with the motifs held fixed. Spectra
+are decomposed in batches of sparse word count matrices, so each iteration is
+a couple of matrix products per batch, and batches run in parallel.
+
+For each spectrum and motif, this computes:
+    prob: the motif's share of the spectrum (theta)
+    overlap: sum over the spectrum's words of phi * beta, i.e. how much of
+        the motif is explained by the spectrum
+"""
+import json
+import multiprocessing
+
+import numpy as np
+import scipy.sparse
+from scipy.special import digamma
+
+import util
+
+DEFAULT_TOLERANCE = 0.005
+DEFAULT_ALPHA = 0.1
+
+
+class MotifSet:
+    '''
+    A fixed set of MS2LDA motifs.
+
+    Attributes:
+        name: name of the motif set
+        motifs: list of motif names
+        annotations: list with the annotation of each motif ('' if none)
+        features: list of feature (word) names
+        feature_mz: (n_features,) float64 array with the m/z of each feature
+        is_loss: (n_features,) bool array, True for loss features
+        beta: (n_motifs, n_features) scipy.sparse.csc_matrix; row k is the
+            word distribution of motif k
+        alpha: (n_motifs,) float64 array, Dirichlet prior
+        tolerance: m/z tolerance in Da for matching peaks to features
+    '''
+    def __init__(self, motifs, annotations=None, alpha=DEFAULT_ALPHA,
+                 tolerance=DEFAULT_TOLERANCE, name=None):
+        annotations = annotations or {}
+        self.name = name
+        self.motifs = sorted(motifs)
+        self.annotations = [annotations.get(m) or '' for m in self.motifs]
+        self.features = sorted(set().union(*motifs.values()))
+        feature_index = dict((f, j) for j, f in enumerate(self.features))
+        self.feature_mz = np.array([float(f.split('_', 1)[1])
+                                    for f in self.features])
+        self.is_loss = np.array([f.startswith('loss') for f in self.features],
+                                dtype=bool)
+        rows = []
+        cols = []
+        values = []
+        for k, motif in enumerate(self.motifs):
+            for feature, prob in motifs[motif].items():
+                rows.append(k)
+                cols.append(feature_index[feature])
+                values.append(float(prob))
+        beta = scipy.sparse.csr_matrix(
+            (values, (rows, cols)), shape=(len(self.motifs), len(self.features)))
+        # Motif sets are often truncated to their most probable words, so
+        # renormalize each motif to a distribution
+        totals = np.asarray(beta.sum(axis=1)).ravel()
+        totals[totals == 0] = 1.
+        self.beta = scipy.sparse.diags(1. / totals).dot(beta).tocsc()
+        if isinstance(alpha, dict):
+            alpha = [alpha.get(m, DEFAULT_ALPHA) for m in self.motifs]
+        self.alpha = np.broadcast_to(
+            np.asarray(alpha, dtype=np.float64), (len(self.motifs),)).copy()
+        self.tolerance = tolerance
+
+        # Sorted fragment and loss m/z's, for matching peaks to words
+        self._lookup = dict()
+        for kind, mask in [('fragment', ~self.is_loss), ('loss', self.is_loss)]:
+            words = np.flatnonzero(mask)
+            order = np.argsort(self.feature_mz[words])
+            self._lookup[kind] = (self.feature_mz[words][order], words[order])
+
+    def __len__(self):
+        return len(self.motifs)
+
+    def matchWords(self, values, kind):
+        '''
+        Returns the index of the nearest fragment or loss feature to each
+        m/z in values, or -1 if none is within the tolerance.
+        '''
+        feature_mz, words = self._lookup[kind]
+        matches = np.full(len(values), -1, dtype=np.int64)
+        if len(feature_mz) == 0:
+            return matches
+        # The nearest feature is either side of the insertion point
+        right = np.minimum(np.searchsorted(feature_mz, values),
+                           len(feature_mz) - 1)
+        left = np.maximum(right - 1, 0)
+        nearest = np.where(np.abs(values - feature_mz[left])
+                           <= np.abs(values - feature_mz[right]), left, right)
+        found = np.abs(values - feature_mz[nearest]) <= self.tolerance
+        matches[found] = words[nearest[found]]
+        return matches
+
+def loadMotifSet(path):
+    '''
+    Reads a motif set json file (see the top of this file for the format).
+    '''
+    with open(path, 'r') as f:
+        motif_set = json.load(f)
+    return MotifSet(motif_set['motifs'],
+                    annotations=motif_set.get('annotations'),
+                    alpha=motif_set.get('alpha', DEFAULT_ALPHA),
+                    tolerance=motif_set.get('tolerance', DEFAULT_TOLERANCE),
+                    name=motif_set.get('name'))
+
+def wordCounts(motif_set, mz, intensity, offsets, parentmass,
+               intensity_scale=1000.):
+    '''
+    Converts flat peak arrays into an MS2LDA word count matrix. Each peak
+    counts for its fragment word and for its neutral loss word, with
+    intensities scaled so that the base peak of each spectrum counts for
+    intensity_scale words.
+
+    Args:
+        motif_set: MotifSet
+        mz, intensity, offsets: flat peak arrays, as util.flattenSpectra()
+            returns
+        parentmass: (n_spectra,) float array
+    Returns:
+        (n_spectra, n_features) scipy.sparse.csr_matrix
+    '''
+    n_spectra = len(offsets) - 1
+    rows = np.repeat(np.arange(n_spectra), np.diff(offsets))
+    base_peak = np.zeros(n_spectra)
+    np.maximum.at(base_peak, rows, intensity)
+    base_peak[base_peak == 0] = 1.
+    counts = intensity_scale * intensity / base_peak[rows]
+
+    losses = np.asarray(parentmass, dtype=np.float64)[rows] - mz
+    fragment_words = motif_set.matchWords(mz, 'fragment')
+    loss_words = motif_set.matchWords(losses, 'loss')
+    loss_words[losses <= 0] = -1
+    words = np.concatenate([fragment_words, loss_words])
+    keep = words >= 0
+    # Duplicate (spectrum, word) entries are summed
+    return scipy.sparse.csr_matrix(
+        (np.tile(counts, 2)[keep], (np.tile(rows, 2)[keep], words[keep])),
+        shape=(n_spectra, len(motif_set.features)))
+
+def decomposeCounts(counts, beta, alpha, max_iter=100, tol=1e-4):
+    '''
+    Fits the motif proportions of a batch of spectra with the motifs held
+    fixed (the variational E-step of LDA), on a batch's word counts.
+
+    Args:
+        counts: (n_spectra, n_words) scipy.sparse.csr_matrix of word counts
+        beta: (n_motifs, n_words) dense array of motif word distributions,
+            restricted to the same words as counts
+        alpha: (n_motifs,) Dirichlet prior
+        max_iter: maximum number of iterations
+        tol: stop when the mean absolute change in gamma is below tol
+    Returns:
+        prob: (n_spectra, n_motifs) array of motif proportions
+        overlap: (n_spectra, n_motifs) array of overlap scores
+    '''
+    counts = counts.tocsr()
+    n_spectra = counts.shape[0]
+    nz_rows = np.repeat(np.arange(n_spectra), np.diff(counts.indptr))
+    gamma = alpha + np.asarray(counts.sum(axis=1)) / float(len(alpha))
+    weights = counts.copy()
+    for _ in xrange(max_iter):
+        expected = np.exp(digamma(gamma)
+                          - digamma(gamma.sum(axis=1))[:, np.newaxis])
+        # phi_{d,w,k} = expected_{d,k} beta_{k,w} / norm_{d,w}, only needed
+        # on the words each spectrum has
+        norm = expected.dot(beta)[nz_rows, counts.indices]
+        weights.data = counts.data / norm
+        new_gamma = alpha + expected * weights.dot(beta.T)
+        change = np.abs(new_gamma - gamma).mean()
+        gamma = new_gamma
+        if change < tol:
+            break
+    expected = np.exp(digamma(gamma) - digamma(gamma.sum(axis=1))[:, np.newaxis])
+    norm = expected.dot(beta)[nz_rows, counts.indices]
+    weights.data = 1. / norm
+    overlap = expected * weights.dot((beta ** 2).T)
+    prob = gamma / gamma.sum(axis=1)[:, np.newaxis]
+    return prob, overlap
+
+# Motif set shared with the worker processes, set once per worker by
+# _initDecompositionWorker()
+_worker_motif_set = None
+_worker_options = None
+
+def _initDecompositionWorker(motif_set, options):
+    global _worker_motif_set, _worker_options
+    _worker_motif_set = motif_set
+    _worker_options = options
+
+def _decomposeBatch(counts):
+    '''
+    Worker function: decomposes one batch of spectra and returns the
+    (spectrum, motif, prob, overlap) arrays of the results that pass the
+    thresholds.
+    '''
+    motif_set = _worker_motif_set
+    min_prob, min_overlap, max_iter = _worker_options
+    # Only the words that occur in the batch are needed
+    words = np.unique(counts.indices)
+    counts = counts[:, words]
+    beta = motif_set.beta[:, words].toarray()
+    prob, overlap = decomposeCounts(counts, beta, motif_set.alpha, max_iter)
+    has_words = np.diff(counts.indptr) > 0
+    passed = ((prob >= min_prob) & (overlap >= min_overlap)
+              & has_words[:, np.newaxis])
+    spectra, motifs = np.nonzero(passed)
+    return spectra, motifs, prob[passed], overlap[passed]
+
+def decomposeSpectra(spectra, motif_set, processes=None, batch_size=250,
+                     min_prob=0.01, min_overlap=0., max_iter=100,
+                     intensity_scale=1000.):
+    '''
+    Decomposes spectra against a motif set, in parallel batches.
+
+    Args:
+        spectra: {spec_id: spectrum} dictionary, as written by clean_csv.py
+            (or make_merged_json.py)
+        motif_set: MotifSet, e.g. from loadMotifSet()
+        processes: number of worker processes [default: number of cores]
+        batch_size: number of spectra per batch
+        min_prob, min_overlap: only report the motifs of a spectrum that
+            pass both thresholds
+        max_iter: maximum number of iterations per batch
+        intensity_scale: word count of the base peak of each spectrum
+    Returns:
+        spec_ids: list of the spectrum id of each result
+        motifs: (n_results,) int array, index into motif_set.motifs
+        prob, overlap: (n_results,) float arrays
+    '''
+    spec_ids, metadata, mz, intensity, offsets = util.flattenSpectra(spectra)
+    counts = wordCounts(motif_set, mz, intensity, offsets,
+                        metadata['parentmass'], intensity_scale)
+    starts = range(0, len(spec_ids), batch_size)
+    batches = [counts[start:start + batch_size] for start in starts]
+    options = (min_prob, min_overlap, max_iter)
+
+    if processes == 1:
+        _initDecompositionWorker(motif_set, options)
+        results = [_decomposeBatch(batch) for batch in batches]
+    else:
+        pool = multiprocessing.Pool(processes,
+                                    initializer=_initDecompositionWorker,
+                                    initargs=(motif_set, options))
+        try:
+            results = pool.map(_decomposeBatch, batches, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Batch-relative spectrum indices back to spectrum ids
+    results = [(start + rows, motifs, prob, overlap) for start,
+               (rows, motifs, prob, overlap) in zip(starts, results)]
+    rows, motifs, prob, overlap = [
+        np.concatenate([r[i] for r in results]) if results else np.zeros(0)
+        for i in range(4)]
+    return ([spec_ids[i] for i in rows.astype(np.int64)],
+            motifs.astype(np.int64), prob, overlap)
+
+def testDecomposeMergedSpectra():
+    '''
+    Tests decomposeSpectra() on merged spectra, as written by
+    make_merged_json.py (without 'inchi' or 'ionization'), against the same
+    spectra with those keys.
+
+    Returns:
+        Boolean indicating equality
+    '''
+    motif_set = MotifSet({'motif_0': {'fragment_53.0390': 0.5,
+                                      'loss_18.0106': 0.5},
+                          'motif_1': {'fragment_81.0700': 1.}})
+    merged = {'AAAAAAAAAAAAAA-BBBBBBBBBB-C': {
+                  'parentmass': 100., 'kingdom': 'Organic compounds',
+                  'class': None, 'sub_class': None,
+                  'peaks': [[53.039, 10.], [81.9894, 50.]]},
+              'DDDDDDDDDDDDDD-EEEEEEEEEE-F': {
+                  'parentmass': 120., 'kingdom': 'Organic compounds',
+                  'class': None, 'sub_class': None,
+                  'peaks': [[81.07, 100.]]}}
+    full = dict((inchi, dict(spectrum, inchi=inchi, ionization='Positive'))
+                for inchi, spectrum in merged.iteritems())
+    results = decomposeSpectra(merged, motif_set, processes=1)
+    expected = decomposeSpectra(full, motif_set, processes=1)
+    return (len(results[0]) > 0 and results[0] == expected[0]
+            and all(np.array_equal(a, b)
+                    for a, b in zip(results[1:], expected[1:])))
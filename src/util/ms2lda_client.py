@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""
+This file contains a client for the ms2lda.org batch decomposition API that
+splits the spectra into chunks, keeps a bounded number of chunk jobs in
+flight at once, and checkpoints each finished chunk to disk, so that a
+crashed run can be resumed without resubmitting the finished chunks.
+
+Each chunk is checkpointed in checkpoint_dir as:
+
+    chunk-<key>.pending.json    the result_id of a submitted chunk, so that
+                                a resumed run polls it instead of
+                                resubmitting it
+    chunk-<key>.json            the decompositions of a finished chunk
+
+where key is a hash of the motif set and the chunk's spectrum ids, so that
+checkpoints are only reused for the exact same chunk.
+
+See ms2lda_stub_server.py for a local stand-in for the API.
+"""
+import hashlib
+import json
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+import requests
+
+DEFAULT_URL = 'http://ms2lda.org/decomposition/api/'
+
+
+class MS2LDAClient:
+    '''
+    Concurrent, resumable client for the MS2LDA batch decomposition API.
+
+    Args:
+        base_url: url of the decomposition api, with batch_decompose/ and
+            batch_results/<id>/ under it
+        motifset: name of the motif set to decompose against
+        chunk_size: number of spectra per submitted job
+        max_in_flight: maximum number of jobs submitted at once
+        checkpoint_dir: directory for the chunk checkpoints. If None,
+            nothing is saved and runs can't be resumed.
+        poll_interval: seconds to wait before first polling a job; the wait
+            grows by backoff after every poll, up to max_poll_interval
+        retries: number of times to retry a failed request, with the same
+            growing wait in between
+        timeout: timeout in seconds of each http request
+    '''
+    def __init__(self, base_url=DEFAULT_URL, motifset='massbank_motifset',
+                 chunk_size=1000, max_in_flight=4, checkpoint_dir=None,
+                 poll_interval=5., max_poll_interval=120., backoff=1.5,
+                 retries=5, timeout=60.):
+        self.base_url = base_url.rstrip('/') + '/'
+        self.motifset = motifset
+        self.chunk_size = chunk_size
+        self.max_in_flight = max_in_flight
+        self.checkpoint_dir = checkpoint_dir
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff = backoff
+        self.retries = retries
+        self.timeout = timeout
+
+    def _waits(self):
+        '''
+        Generates the backoff waits: poll_interval, then growing by backoff
+        up to max_poll_interval.
+        '''
+        wait = self.poll_interval
+        while True:
+            yield wait
+            wait = min(wait * self.backoff, self.max_poll_interval)
+
+    def _request(self, method, url, **kwargs):
+        '''
+        Makes an http request and returns the decoded json, retrying on
+        connection errors and server errors.
+        '''
+        waits = self._waits()
+        for attempt in xrange(self.retries + 1):
+            try:
+                r = requests.request(method, url, timeout=self.timeout,
+                                     **kwargs)
+                if r.status_code < 500:
+                    r.raise_for_status()
+                    return r.json()
+                error = requests.HTTPError(
+                    '{} error for {}'.format(r.status_code, url))
+            except (requests.ConnectionError, requests.Timeout,
+                    ValueError) as e:
+                error = e
+            if attempt < self.retries:
+                time.sleep(next(waits))
+        raise error
+
+    def _checkpoint(self, key, suffix):
+        return os.path.join(self.checkpoint_dir,
+                            'chunk-' + key + suffix + '.json')
+
+    def _readCheckpoint(self, key, suffix):
+        if self.checkpoint_dir is None:
+            return None
+        fname = self._checkpoint(key, suffix)
+        if not os.path.isfile(fname):
+            return None
+        with open(fname, 'r') as f:
+            return json.load(f)
+
+    def _writeCheckpoint(self, key, suffix, obj):
+        if self.checkpoint_dir is None:
+            return
+        fname = self._checkpoint(key, suffix)
+        # Write then rename, so that a crash never leaves a partial file
+        with open(fname + '.tmp', 'w') as f:
+            json.dump(obj, f)
+        os.rename(fname + '.tmp', fname)
+
+    def chunkKey(self, chunk):
+        '''
+        Returns the checkpoint key of a chunk of (spec, parentmass, peaks)
+        tuples.
+        '''
+        ids = json.dumps([self.motifset] + [spectrum[0] for spectrum in chunk])
+        return hashlib.sha1(ids).hexdigest()
+
+    def decomposeChunk(self, chunk):
+        '''
+        Submits one chunk (or picks up its checkpoint) and polls until its
+        decompositions are back.
+
+        Returns:
+            {spec: [[motif, motif_dup, prob, overlap, annotation], ...]}
+        '''
+        key = self.chunkKey(chunk)
+        done = self._readCheckpoint(key, '')
+        if done is not None:
+            return done
+
+        pending = self._readCheckpoint(key, '.pending')
+        if pending is None:
+            response = self._request(
+                'post', self.base_url + 'batch_decompose/',
+                data={'spectra': json.dumps(chunk),
+                      'motifset': self.motifset})
+            pending = {'result_id': response['result_id']}
+            self._writeCheckpoint(key, '.pending', pending)
+
+        url = self.base_url + 'batch_results/{}/'.format(pending['result_id'])
+        waits = self._waits()
+        result = self._request('get', url)
+        while 'status' in result:
+            time.sleep(next(waits))
+            result = self._request('get', url)
+
+        decompositions = result['decompositions']
+        self._writeCheckpoint(key, '', decompositions)
+        if self.checkpoint_dir is not None:
+            os.remove(self._checkpoint(key, '.pending'))
+        return decompositions
+
+    def decompose(self, ms2lda_spectra):
+        '''
+        Decomposes all spectra, in chunks of chunk_size with at most
+        max_in_flight chunks submitted at once.
+
+        Args:
+            ms2lda_spectra: list of (spec, parentmass, [(mz, intensity),
+                ...]) tuples
+        Returns:
+            {spec: [[motif, motif_dup, prob, overlap, annotation], ...]} for
+            all spectra
+        '''
+        if self.checkpoint_dir is not None and \
+                not os.path.isdir(self.checkpoint_dir):
+            os.makedirs(self.checkpoint_dir)
+        # Sort, so that a resumed run makes the same chunks
+        ms2lda_spectra = sorted(ms2lda_spectra, key=lambda s: s[0])
+        chunks = [ms2lda_spectra[i:i + self.chunk_size]
+                  for i in xrange(0, len(ms2lda_spectra), self.chunk_size)]
+
+        decompositions = {}
+        t0 = time.time()
+        pool = ThreadPool(self.max_in_flight)
+        try:
+            for i, result in enumerate(
+                    pool.imap_unordered(self.decomposeChunk, chunks)):
+                decompositions.update(result)
+                print('{} of {} chunks done after {:.2f} s'.format(
+                    i + 1, len(chunks), time.time() - t0))
+        finally:
+            pool.close()
+            pool.join()
+        return decompositions
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+This file contains a local stand-in for the ms2lda.org batch decomposition
+API, for testing ms2lda_client.py without the live service. It serves
+
+    POST <prefix>batch_decompose/       form fields 'spectra' (json list of
+                                        (spec, parentmass, peaks)) and
+                                        'motifset'; returns {'result_id'}
+    GET  <prefix>batch_results/<id>/    {'status': ...} until the job is
+                                        done, then {'decompositions': ...}
+
+with prefix /decomposition/api/, as ms2lda.org does. Jobs finish after a
+fixed delay. If a motif set file is given, the spectra are decomposed with
+the local engine in motifs.py; otherwise every spectrum gets one dummy
+motif. Requests can be made to fail at random, to test retries.
+
+    python src/util/ms2lda_stub_server.py --port 8000 --delay 2
+
+then run, e.g.:
+
+    python src/data/run_ms2lda.py clean_spectra.json out.txt --remote \
+        --url http://localhost:8000/decomposition/api/
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import urlparse
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import motifs
+
+PREFIX = '/decomposition/api/'
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    '''
+    Threaded http server holding the stub's jobs.
+
+    Args:
+        address: (host, port) to listen on
+        motif_set: MotifSet to decompose with, or None for dummy results
+        delay: seconds until a submitted job is done
+        fail_rate: probability that any request fails with a 503
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, motif_set=None, delay=1., fail_rate=0.):
+        HTTPServer.__init__(self, address, StubHandler)
+        self.motif_set = motif_set
+        self.delay = delay
+        self.fail_rate = fail_rate
+        self.jobs = {}
+        self.n_submitted = 0
+        self.lock = threading.Lock()
+
+    def submit(self, ms2lda_spectra):
+        with self.lock:
+            self.n_submitted += 1
+            result_id = self.n_submitted
+            self.jobs[result_id] = (time.time() + self.delay, ms2lda_spectra)
+        return result_id
+
+    def decompose(self, ms2lda_spectra):
+        '''
+        Returns the decompositions of a job's spectra, in the api's format.
+        '''
+        if self.motif_set is None:
+            return dict((spec[0], [['motif_0', 'motif_0', 1.0, 1.0, None]])
+                        for spec in ms2lda_spectra)
+        # decomposeSpectra() expects clean_spectra.json style spectra
+        spectra = dict((spec, {'parentmass': parentmass, 'peaks': peaks,
+                               'inchi': None, 'ionization': None,
+                               'kingdom': None, 'class': None,
+                               'sub_class': None})
+                       for spec, parentmass, peaks in ms2lda_spectra)
+        spec_ids, motif_idx, prob, overlap = motifs.decomposeSpectra(
+            spectra, self.motif_set, processes=1)
+        decompositions = dict((spec[0], []) for spec in ms2lda_spectra)
+        for spec, k, p, o in zip(spec_ids, motif_idx, prob, overlap):
+            motif = self.motif_set.motifs[k]
+            decompositions[spec].append(
+                [motif, motif, p, o, self.motif_set.annotations[k] or None])
+        return decompositions
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def _reply(self, code, obj):
+        body = json.dumps(obj)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _failed(self):
+        if random.random() < self.server.fail_rate:
+            self._reply(503, {'error': 'simulated failure'})
+            return True
+        return False
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length', 0))
+        form = urlparse.parse_qs(self.rfile.read(length))
+        if self.path != PREFIX + 'batch_decompose/' or 'spectra' not in form:
+            return self._reply(404, {'error': 'not found'})
+        if self._failed():
+            return
+        result_id = self.server.submit(json.loads(form['spectra'][0]))
+        self._reply(200, {'result_id': result_id})
+
+    def do_GET(self):
+        parts = self.path[len(PREFIX):].strip('/').split('/')
+        if not self.path.startswith(PREFIX) or len(parts) != 2 \
+                or parts[0] != 'batch_results' or not parts[1].isdigit() \
+                or int(parts[1]) not in self.server.jobs:
+            return self._reply(404, {'error': 'not found'})
+        if self._failed():
+            return
+        ready_at, ms2lda_spectra = self.server.jobs[int(parts[1])]
+        if time.time() < ready_at:
+            return self._reply(200, {'status': 'running'})
+        self._reply(200, {'decompositions':
+                          self.server.decompose(ms2lda_spectra)})
+
+    def log_message(self, format, *args):
+        pass
+
+if __name__ == '__main__':
+    p = argparse.ArgumentParser()
+    p.add_argument('--port', default=8000, type=int)
+    p.add_argument('--motifset', help='motif set json file to decompose '
+        + 'against (see motifs.py). [default: dummy results]')
+    p.add_argument('--delay', help='seconds until a job is done. '
+        + '[default: %(default)s]', default=1., type=float)
+    p.add_argument('--fail-rate', help='fraction of requests that fail. '
+        + '[default: %(default)s]', default=0., type=float)
+    args = p.parse_args()
+
+    motif_set = None
+    if args.motifset:
+        motif_set = motifs.loadMotifSet(args.motifset)
+    server = StubServer(('localhost', args.port), motif_set, args.delay,
+                        args.fail_rate)
+    print('Serving on port {}'.format(args.port))
+    server.serve_forever()
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+This file contains the vectorized peak preprocessing stage: intensity
+normalisation and noise filtering over the flat peak arrays from
+util.flattenSpectra(), applied before the spectra are binned (see
+spectrum_matrix.py), indexed (see spectral_index.py) or decomposed (see
+motifs.py).
+
+filterPeaks() applies, in order:
+
+    precursor_window    drop the peaks within this many Da of the spectrum's
+                        parentmass
+    min_relative        drop the peaks below this fraction of the spectrum's
+                        most intense (remaining) peak
+    top_k               keep only the k most intense peaks of each spectrum
+    base_peak           divide intensities by the spectrum's most intense
+                        peak, so that the base peak is 1
+    transform           'sqrt' or 'log' (log(1 + intensity)) of intensities
+
+Each step is a segmented operation over all peaks at once. Peaks stay in
+their original (m/z) order.
+
+loadFilteredPeaks() caches the filtered peaks of a spectra file per
+parameter set, next to the file, so that every stage run with the same
+filters reads them back instead of filtering again.
+"""
+import json
+import os
+
+import numpy as np
+
+import clean_spectra
+import util
+
+TRANSFORMS = {'sqrt': np.sqrt, 'log': np.log1p}
+FILTER_DEFAULTS = {'precursor_window': None, 'min_relative': 0.,
+                   'top_k': None, 'base_peak': False, 'transform': None}
+CACHE_VERSION = 1
+
+
+def _segmentMax(values, offsets):
+    '''
+    Max of each segment values[offsets[i]:offsets[i + 1]], 0 for empty ones.
+    '''
+    n_segments = len(offsets) - 1
+    maxima = np.zeros(n_segments)
+    nonempty = np.flatnonzero(np.diff(offsets) > 0)
+    if len(nonempty):
+        maxima[nonempty] = np.maximum.reduceat(values, offsets[nonempty])
+    return maxima
+
+
+def _compress(mz, intensity, rows, keep, n_spectra):
+    '''
+    Drops the peaks where keep is False, and returns the new offsets.
+    '''
+    offsets = np.zeros(n_spectra + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows[keep], minlength=n_spectra), out=offsets[1:])
+    return mz[keep], intensity[keep], rows[keep], offsets
+
+
+def filterPeaks(mz, intensity, offsets, parentmass=None,
+                precursor_window=None, min_relative=0., top_k=None,
+                base_peak=False, transform=None):
+    '''
+    Filters and normalises flat peak arrays spectrum by spectrum (see the
+    module docstring for the steps).
+
+    Args:
+        mz, intensity: (n_peaks,) float64 arrays of all peaks, spectrum by
+            spectrum
+        offsets: (n_spectra + 1,) int64 array; the peaks of spectrum i are
+            mz[offsets[i]:offsets[i + 1]]
+        parentmass: (n_spectra,) parentmass of each spectrum, needed for
+            precursor_window
+        precursor_window: drop peaks within this many Da of the parentmass
+        min_relative: drop peaks below this fraction of the base peak
+        top_k: keep at most this many peaks per spectrum
+        base_peak: scale each spectrum's base peak to an intensity of 1
+        transform: None, 'sqrt' or 'log'
+    Returns:
+        mz, intensity, offsets of the remaining peaks. Spectra left without
+        peaks are kept, with none.
+    '''
+    if transform is not None and transform not in TRANSFORMS:
+        raise ValueError('Unknown intensity transform: ' + str(transform))
+    mz = np.asarray(mz, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_spectra = len(offsets) - 1
+    rows = np.repeat(np.arange(n_spectra), np.diff(offsets))
+
+    if precursor_window is not None:
+        if parentmass is None:
+            raise ValueError('precursor_window needs the parentmasses')
+        parentmass = np.asarray(parentmass, dtype=np.float64)
+        keep = np.abs(mz - parentmass[rows]) > precursor_window
+        mz, intensity, rows, offsets = _compress(mz, intensity, rows, keep,
+                                                 n_spectra)
+
+    if min_relative:
+        floor = min_relative * _segmentMax(intensity, offsets)
+        keep = intensity >= floor[rows]
+        mz, intensity, rows, offsets = _compress(mz, intensity, rows, keep,
+                                                 n_spectra)
+
+    if top_k is not None:
+        # Rank of each peak within its spectrum, most intense first (ties
+        # go to the lower m/z)
+        order = np.lexsort((-intensity, rows))
+        ranks = np.empty(len(order), dtype=np.int64)
+        ranks[order] = np.arange(len(order)) - offsets[rows[order]]
+        keep = ranks < top_k
+        mz, intensity, rows, offsets = _compress(mz, intensity, rows, keep,
+                                                 n_spectra)
+
+    if base_peak:
+        maxima = _segmentMax(intensity, offsets)
+        maxima[maxima == 0] = 1.
+        intensity = intensity / maxima[rows]
+
+    if transform is not None:
+        intensity = TRANSFORMS[transform](intensity)
+    return mz, intensity, offsets
+
+
+def filterKey(**filters):
+    '''
+    Short name of a set of filter parameters, used to name its cache file.
+    Parameters left at their defaults are not part of the name.
+    '''
+    parts = []
+    for name in sorted(FILTER_DEFAULTS):
+        value = filters.get(name, FILTER_DEFAULTS[name])
+        if value != FILTER_DEFAULTS[name]:
+            parts.append(name + '=' + str(value))
+    return ','.join(parts)
+
+
+def cachePath(path, **filters):
+    '''
+    Path of the cache of a spectra file's peaks after a set of filters.
+    '''
+    return path + '.peaks.' + filterKey(**filters) + '.npz'
+
+
+def _filterFile(path, filters):
+    spec_ids, metadata, mz, intensity, offsets = util.flattenSpectra(
+        clean_spectra.iterSpectra(path, arrays=True))
+    mz, intensity, offsets = filterPeaks(
+        mz, intensity, offsets, metadata['parentmass'], **filters)
+    return spec_ids, metadata, mz, intensity, offsets
+
+
+def loadFilteredPeaks(path, **filters):
+    '''
+    Reads a spectra file (.jsonl or .json) into flat peak arrays, as
+    util.flattenSpectra() would, and filters them with filterPeaks(). The
+    filtered arrays are cached next to the file (see cachePath()), and read
+    back from there as long as the file's size and modification time are
+    unchanged.
+
+    Args:
+        path: clean_spectra.jsonl (or .json) file
+        filters: parameters of filterPeaks()
+    Returns:
+        spec_ids, metadata, mz, intensity, offsets as util.flattenSpectra()
+    '''
+    unknown = set(filters) - set(FILTER_DEFAULTS)
+    if unknown:
+        raise ValueError('Unknown peak filters: ' + ', '.join(sorted(unknown)))
+    fname = cachePath(path, **filters)
+    stat = os.stat(path)
+    if os.path.isfile(fname):
+        cache = np.load(fname)
+        if cache['version'] == CACHE_VERSION \
+                and cache['size'] == stat.st_size \
+                and cache['mtime'] == stat.st_mtime:
+            metadata = json.loads(cache['metadata'].tostring())
+            return (metadata.pop('spec_ids'), metadata, cache['mz'],
+                    cache['intensity'], cache['offsets'])
+    spec_ids, metadata, mz, intensity, offsets = _filterFile(path, filters)
+    stored = dict(metadata, spec_ids=spec_ids)
+    try:
+        with open(fname + '.tmp', 'wb') as f:
+            np.savez(f, mz=mz, intensity=intensity, offsets=offsets,
+                     metadata=np.frombuffer(json.dumps(stored), np.uint8),
+                     version=CACHE_VERSION, size=stat.st_size,
+                     mtime=stat.st_mtime)
+        os.rename(fname + '.tmp', fname)
+    except (IOError, OSError):
+        # e.g. a read-only data directory; the filtered peaks are only a
+        # cache
+        pass
+    return spec_ids, metadata, mz, intensity, offsets
+
+
+def iterFilteredSpectra(path, **filters):
+    '''
+    Reads the spectra of a spectra file with their peaks filtered (see
+    loadFilteredPeaks()). Without any filters, this is
+    clean_spectra.iterSpectra(path, arrays=True).
+
+    Yields:
+        (spec_id, spectrum) pairs, with the peaks as (n, 2) float64 arrays
+    '''
+    if not filterKey(**filters):
+        for spec_id, spectrum in clean_spectra.iterSpectra(path, arrays=True):
+            yield spec_id, spectrum
+        return
+    spec_ids, metadata, mz, intensity, offsets = loadFilteredPeaks(
+        path, **filters)
+    peaks = np.column_stack([mz, intensity])
+    keys = sorted(metadata)
+    for i, spec_id in enumerate(spec_ids):
+        spectrum = dict((k, metadata[k][i]) for k in keys)
+        spectrum['peaks'] = peaks[offsets[i]:offsets[i + 1]]
+        yield spec_id, spectrum
+
+
+def addFilterArguments(parser):
+    '''
+    Adds the filterPeaks() parameters to an argparse parser, as
+    --precursor-window, --min-relative, --top-k, --base-peak and
+    --transform. Read them back with filterArguments().
+    '''
+    group = parser.add_argument_group(
+        'peak filters', 'normalise and filter the peaks of each spectrum '
+        + 'first (cached next to the input file, per set of filters)')
+    group.add_argument('--precursor-window', help='drop peaks within this '
+        + 'many Da of the parentmass', default=None, type=float)
+    group.add_argument('--min-relative', help='drop peaks below this '
+        + 'fraction of the base peak', default=0., type=float)
+    group.add_argument('--top-k', help='keep at most this many of the most '
+        + 'intense peaks per spectrum', default=None, type=int)
+    group.add_argument('--base-peak', help='scale intensities so that the '
+        + 'base peak is 1', action='store_true')
+    group.add_argument('--transform', help='transform the intensities',
+        choices=sorted(TRANSFORMS), default=None)
+
+
+def filterArguments(args):
+    '''
+    Returns the filterPeaks() parameters from arguments parsed with a parser
+    set up by addFilterArguments().
+    '''
+    return dict((name, getattr(args, name)) for name in FILTER_DEFAULTS)
@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+"""
+This file contains the reader and writer for the spectra store, the binary
+columnar replacement for metabolites_and_spectra.csv.
+
+A spectra store is a directory of .npy arrays (so that everything can be
+memory mapped) plus a schema.json:
+
+    schema.json                metadata column names and store sizes
+    metabolites.offsets.npy    (n_columns, n_metabolites + 1) int64 offsets
+    metabolites.strings.npy    utf-8 bytes of every metabolite metadata value
+    metabolites.present.npy    (n_columns, ceil(n_metabolites / 8)) bits,
+                               set where a metabolite has a value (which may
+                               be an empty string)
+    spectra.offsets.npy        (n_columns, n_spectra + 1) int64 offsets
+    spectra.strings.npy        utf-8 bytes of every MS2 metadata value
+    spectra.present.npy        the same bits for the spectra
+    parentmass.npy             (n_metabolites,) float64 monoisotopic weight
+    spectrum_metabolite.npy    (n_spectra,) int64 row of each spectrum's
+                               metabolite in the metabolite table
+    peak_offsets.npy           (n_spectra + 1,) int64; the peaks of spectrum
+                               i are mz[peak_offsets[i]:peak_offsets[i + 1]]
+    mz.npy, intensity.npy      (n_peaks,) float64 flat peak arrays
+    peak_ids.npy               (n_peaks,) int64 HMDB peak ids (-1 if
+                               missing); only if the spectra had any
+
+Metadata is stored one column per attribute. Dictionary attributes (e.g.
+taxonomy_dict) are flattened into one column per key, named attribute.key,
+and list attributes (e.g. secondary_accessions) are joined with commas, as
+they are in the csv. Empty scalar and dictionary values are read back as
+empty strings, as they are from the csv; unset ones are read back as None.
+"""
+import json
+import os
+
+import numpy as np
+
+from MetabolomicsObjects import Metabolite, MS2, peakArray
+
+SCHEMA_FILE = 'schema.json'
+STORE_VERSION = 1
+
+def isSpectraStore(path):
+    '''
+    Returns True if path is a spectra store directory.
+    '''
+    return os.path.isfile(os.path.join(path, SCHEMA_FILE))
+
+def _toText(value):
+    if isinstance(value, unicode):
+        return value
+    return str(value).decode('utf-8')
+
+def _flattenAttributes(obj, skip):
+    '''
+    Flattens an object's populated attributes into a {column: text} dict, and
+    returns the names of the list-valued columns alongside it.
+    '''
+    row = dict()
+    list_columns = set()
+    for attribute, value in obj.attributes().iteritems():
+        if attribute in skip or value is None:
+            continue
+        if isinstance(value, dict):
+            # Empty dictionary values are read back from the csv as empty
+            # strings, so they are kept as such
+            for key, item in value.iteritems():
+                row[attribute + '.' + key] = _toText(item) if item else u''
+        elif isinstance(value, list):
+            row[attribute] = u','.join(_toText(item) for item in value if item)
+            list_columns.add(attribute)
+        else:
+            # Empty strings are kept, as the csv keeps them
+            row[attribute] = _toText(value)
+    return row, list_columns
+
+def _peakArrays(ms2_object):
+    '''
+    Returns the mz, intensity and peak id arrays of an MS2 object. The peak
+    ids are -1 if unknown.
+    '''
+    peaks = peakArray(ms2_object.peaks)
+    peak_ids = ms2_object.peak_ids
+    if peak_ids is None or len(peak_ids) != len(peaks):
+        peak_ids = np.full(len(peaks), -1, dtype=np.int64)
+    return peaks[:, 0], peaks[:, 1], peak_ids
+
+def _writeStringTable(path, name, rows, columns):
+    '''
+    Writes a list of {column: text} dicts as one utf-8 byte blob plus an
+    (n_columns, n_rows + 1) array of offsets into it, and the bits of the
+    cells that have a value (so that empty strings can be told from missing
+    values).
+    '''
+    offsets = np.zeros((len(columns), len(rows) + 1), dtype=np.int64)
+    present = np.zeros((len(columns), len(rows)), dtype=bool)
+    chunks = []
+    position = 0
+    for j, column in enumerate(columns):
+        offsets[j, 0] = position
+        for i, row in enumerate(rows):
+            value = row.get(column)
+            if value is not None:
+                present[j, i] = True
+                encoded = value.encode('utf-8')
+                chunks.append(encoded)
+                position += len(encoded)
+            offsets[j, i + 1] = position
+    blob = np.frombuffer(b''.join(chunks), dtype=np.uint8)
+    np.save(os.path.join(path, name + '.offsets.npy'), offsets)
+    np.save(os.path.join(path, name + '.strings.npy'), blob)
+    np.save(os.path.join(path, name + '.present.npy'),
+            np.packbits(present, axis=1))
+
+def writeSpectraStore(matched_dict, path):
+    '''
+    Takes in output from MS2Preprocessing() and writes it as a spectra store.
+
+    Args:
+        matched_dict: dictionary in the form of: {inchikey: Metabolite}, where
+            Metabolite object has a populated MS2 field. This is the output of
+            MS2Preprocessing().
+        path: directory to write the store to (created if needed)
+    '''
+    print('Writing spectra store...')
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    metabolite_rows = []
+    spectrum_rows = []
+    list_columns = set()
+    parentmass = []
+    spectrum_metabolite = []
+    peak_offsets = [0]
+    mz = []
+    intensity = []
+    peak_ids = []
+    has_peak_ids = False
+    n_peaks = 0
+    for metabolite in matched_dict.itervalues():
+        row, lists = _flattenAttributes(metabolite, skip=('MS2',))
+        list_columns |= lists
+        weight = row.get('monisotopic_molecular_weight')
+        parentmass.append(float(weight) if weight else np.nan)
+        metabolite_index = len(metabolite_rows)
+        metabolite_rows.append(row)
+        for ms2_object in metabolite.MS2:
+            row, lists = _flattenAttributes(ms2_object,
+                                            skip=('peaks', 'peak_ids'))
+            list_columns |= lists
+            spectrum_rows.append(row)
+            spectrum_metabolite.append(metabolite_index)
+            mzs, intensities, ids = _peakArrays(ms2_object)
+            mz.append(mzs)
+            intensity.append(intensities)
+            peak_ids.append(ids)
+            has_peak_ids |= ms2_object.peak_ids is not None
+            n_peaks += len(mzs)
+            peak_offsets.append(n_peaks)
+
+    metabolite_columns = sorted(set().union(*metabolite_rows))
+    spectrum_columns = sorted(set().union(*spectrum_rows))
+    _writeStringTable(path, 'metabolites', metabolite_rows, metabolite_columns)
+    _writeStringTable(path, 'spectra', spectrum_rows, spectrum_columns)
+    arrays = [('parentmass', np.array(parentmass, dtype=np.float64)),
+              ('spectrum_metabolite', np.array(spectrum_metabolite,
+                                               dtype=np.int64)),
+              ('peak_offsets', np.array(peak_offsets, dtype=np.int64)),
+              ('mz', np.concatenate(mz or [np.zeros(0)])),
+              ('intensity', np.concatenate(intensity or [np.zeros(0)]))]
+    if has_peak_ids:
+        arrays.append(('peak_ids', np.concatenate(peak_ids)))
+    for name, array in arrays:
+        np.save(os.path.join(path, name + '.npy'), array)
+
+    schema = {'version': STORE_VERSION,
+              'n_metabolites': len(metabolite_rows),
+              'n_spectra': len(spectrum_rows),
+              'n_peaks': n_peaks,
+              'peak_ids': has_peak_ids,
+              'metabolite_columns': metabolite_columns,
+              'spectrum_columns': spectrum_columns,
+              'list_columns': sorted(list_columns)}
+    with open(os.path.join(path, SCHEMA_FILE), 'w') as f:
+        json.dump(schema, f, indent=1)
+    print('Done.')
+
+def loadArray(path, name, mmap_mode='r'):
+    '''
+    Loads path/name.npy, memory mapped if possible.
+    '''
+    fname = os.path.join(path, name + '.npy')
+    try:
+        return np.load(fname, mmap_mode=mmap_mode)
+    except ValueError:
+        # Empty arrays can't be memory mapped
+        return np.load(fname)
+
+
+class StringTable:
+    '''
+    Read-only view of a string table written by _writeStringTable().
+    '''
+    def __init__(self, path, name, columns, n_rows, mmap_mode='r'):
+        self.columns = columns
+        self.n_rows = n_rows
+        self._column_index = dict((c, j) for j, c in enumerate(columns))
+        self.offsets = loadArray(path, name + '.offsets', mmap_mode)
+        self._blob = loadArray(path, name + '.strings', mmap_mode)
+        self._present = loadArray(path, name + '.present', mmap_mode)
+        self._bytes = None
+
+    def __len__(self):
+        return self.n_rows
+
+    def column(self, name):
+        '''
+        Returns all values in a column as a list of unicode strings (or None
+        for missing values). Unknown columns are all None.
+        '''
+        if name not in self._column_index:
+            return [None] * len(self)
+        if self._bytes is None:
+            self._bytes = self._blob.tobytes()
+        data = self._bytes
+        j = self._column_index[name]
+        bounds = self.offsets[j].tolist()
+        present = np.unpackbits(self._present[j])[:len(self)].tolist()
+        return [data[start:end].decode('utf-8') if has_value else None
+                for start, end, has_value
+                in zip(bounds[:-1], bounds[1:], present)]
+
+
+class SpectraStore:
+    '''
+    Memory-mapped reader for a spectra store written by writeSpectraStore().
+
+    Attributes:
+        metabolites, spectra: StringTables with the metadata columns
+        parentmass: (n_metabolites,) float64 array
+        spectrum_metabolite: (n_spectra,) int64 array
+        peak_offsets: (n_spectra + 1,) int64 array
+        mz, intensity: (n_peaks,) float64 arrays
+        peak_ids: (n_peaks,) int64 array, or None if the store has no peak
+            ids
+    '''
+    def __init__(self, path, mmap_mode='r'):
+        with open(os.path.join(path, SCHEMA_FILE), 'r') as f:
+            self.schema = json.load(f)
+        if self.schema['version'] != STORE_VERSION:
+            raise ValueError('Unsupported spectra store version: '
+                             + str(self.schema['version']))
+        self.path = path
+        self.metabolites = StringTable(
+            path, 'metabolites', self.schema['metabolite_columns'],
+            self.schema['n_metabolites'], mmap_mode)
+        self.spectra = StringTable(
+            path, 'spectra', self.schema['spectrum_columns'],
+            self.schema['n_spectra'], mmap_mode)
+        for name in ('parentmass', 'spectrum_metabolite', 'peak_offsets',
+                     'mz', 'intensity'):
+            setattr(self, name, loadArray(path, name, mmap_mode))
+        self.peak_ids = loadArray(path, 'peak_ids', mmap_mode) \
+            if self.schema.get('peak_ids') else None
+        self.n_metabolites = self.schema['n_metabolites']
+        self.n_spectra = self.schema['n_spectra']
+
+    def peaks(self, i):
+        '''
+        Returns the (mz, intensity) arrays of spectrum i.
+        '''
+        start, end = self.peak_offsets[i], self.peak_offsets[i + 1]
+        return self.mz[start:end], self.intensity[start:end]
+
+    def _populate(self, objects, table):
+        list_columns = set(self.schema['list_columns'])
+        for column in table.columns:
+            values = table.column(column)
+            if '.' in column:
+                attribute, key = column.split('.', 1)
+                for obj, value in zip(objects, values):
+                    if value is None:
+                        continue
+                    if getattr(obj, attribute, None) is None:
+                        setattr(obj, attribute, dict())
+                    getattr(obj, attribute)[key] = value
+            elif column in list_columns:
+                for obj, value in zip(objects, values):
+                    if value:
+                        setattr(obj, column, value.split(','))
+            else:
+                for obj, value in zip(objects, values):
+                    if value is not None:
+                        setattr(obj, column, value)
+
+    def toMetaboliteDict(self):
+        '''
+        Rebuilds the {inchikey: Metabolite} dictionary, with MS2 peaks as
+        (n, 2) arrays of [mz, intensity] rows (and peak_ids, if stored), as
+        util.unpackCSV() returns. The peak arrays are views into one array
+        holding all of the peaks.
+        '''
+        metabolites = [Metabolite() for _ in xrange(self.n_metabolites)]
+        self._populate(metabolites, self.metabolites)
+
+        ms2_objects = [MS2() for _ in xrange(self.n_spectra)]
+        self._populate(ms2_objects, self.spectra)
+        offsets = self.peak_offsets.tolist()
+        peaks = np.column_stack([self.mz, self.intensity])
+        owners = self.spectrum_metabolite.tolist()
+        for i, ms2_object in enumerate(ms2_objects):
+            ms2_object.peaks = peaks[offsets[i]:offsets[i + 1]]
+            if self.peak_ids is not None:
+                ms2_object.peak_ids = self.peak_ids[offsets[i]:offsets[i + 1]]
+            metabolites[owners[i]].MS2.append(ms2_object)
+
+        metabolite_dict = dict()
+        for metabolite in metabolites:
+            metabolite.inchi_key = metabolite.inchikey
+            metabolite_dict[metabolite.inchikey] = metabolite
+        return metabolite_dict
+
+def unpackStore(path):
+    '''
+    Reads a spectra store, generates {inchikey:Metabolite} dictionary
+    w/populated MS2. Equivalent to util.unpackCSV() for the csv format.
+    '''
+    return SpectraStore(path).toMetaboliteDict()
@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+"""
+This file contains the spectral library index, for finding the reference
+spectra most similar to a query spectrum, and a k-nearest-neighbour
+taxonomy predictor built on it.
+
+The index holds every spectrum from clean_spectra.json as a unit-normalised
+binned vector, with rows sorted by parentmass, so that:
+
+    - a precursor window is a contiguous range of rows, found with a
+      binary search over the sorted parent masses
+    - the transposed (CSC) copy of the vectors is an inverted index from
+      fragment bin to the spectra with a peak in it
+
+A cosine query only visits the postings of the query's own bins within the
+precursor window; spectra that share fewer than min_shared_peaks bins with
+the query are never scored. A modified cosine query also matches peaks
+shifted by the parent mass difference; it bounds each candidate's score with
+one vectorized pass and only runs the exact (greedy peak matching) score on
+candidates whose bound can still make the top k.
+
+A saved index is a directory of .npy arrays (see SpectralIndex.save()).
+"""
+import os
+
+import numpy as np
+import scipy.sparse
+
+import binning
+import util
+from spectra_store import loadArray
+
+LABEL_COLUMNS = ['spec_id', 'inchi', 'kingdom', 'class', 'sub_class']
+INDEX_ARRAYS = ['data', 'indices', 'indptr', 'parentmass', 'edges',
+                'intensity_power']
+
+
+class SpectralIndex:
+    '''
+    Binned spectral library with a precursor-mass range index and an
+    inverted index over fragment bins.
+
+    Attributes:
+        vectors: (n_spectra, n_bins) CSR matrix of unit-normalised binned
+            spectra, rows sorted by parentmass
+        inverted: the same matrix in CSC form (bin -> spectra postings)
+        parentmass: (n_spectra,) sorted float64 array
+        edges: bin edges, equally spaced
+        labels: {label: (n_spectra,) array} for each of LABEL_COLUMNS
+        intensity_power: intensities are raised to this power before
+            normalising (0.5, the default, is the usual square root)
+    '''
+    def __init__(self, vectors, parentmass, edges, labels,
+                 intensity_power=0.5):
+        self.vectors = vectors.tocsr()
+        self.inverted = self.vectors.tocsc()
+        self.parentmass = parentmass
+        self.edges = edges
+        self.bin_width = edges[1] - edges[0]
+        self.labels = labels
+        self.intensity_power = intensity_power
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def queryVector(self, peaks):
+        '''
+        Bins and normalises a query spectrum's peaks like the library's.
+
+        Returns:
+            sorted bin indices and their values
+        '''
+        peaks = np.asarray(peaks, dtype=np.float64).reshape(-1, 2)
+        # A binary search over the edges is cheaper than building a sparse
+        # matrix for a single spectrum, and assigns the same bins
+        bins = np.searchsorted(self.edges, peaks[:, 0], side='right') - 1
+        inside = (bins >= 0) & (bins < len(self.edges) - 1)
+        bins, inverse = np.unique(bins[inside], return_inverse=True)
+        values = np.bincount(inverse, peaks[inside, 1] ** self.intensity_power,
+                             minlength=len(bins))
+        norm = np.sqrt(np.dot(values, values))
+        return bins.astype(np.int64), values / norm if norm > 0 else values
+
+    def window(self, parentmass, tolerance):
+        '''
+        Returns the [start, end) rows whose parentmass is within tolerance
+        of parentmass (all rows if tolerance is None).
+        '''
+        if tolerance is None or parentmass is None:
+            return 0, len(self)
+        return (np.searchsorted(self.parentmass, parentmass - tolerance),
+                np.searchsorted(self.parentmass, parentmass + tolerance,
+                                side='right'))
+
+    def _postings(self, bins, values, start, end):
+        '''
+        Returns the (row, query value, library value) of every posting of
+        the query bins within rows [start, end).
+        '''
+        inverted = self.inverted
+        bounds = inverted.indptr
+        rows = []
+        query_values = []
+        library_values = []
+        for b, value in zip(bins, values):
+            if b >= inverted.shape[1]:
+                continue
+            column = slice(bounds[b], bounds[b + 1])
+            column_rows = inverted.indices[column]
+            # Postings are sorted by row, i.e. by parentmass
+            lo, hi = np.searchsorted(column_rows, [start, end])
+            rows.append(column_rows[lo:hi])
+            library_values.append(inverted.data[column][lo:hi])
+            query_values.append(np.repeat(value, hi - lo))
+        if not rows:
+            return np.zeros(0, np.int64), np.zeros(0), np.zeros(0)
+        return (np.concatenate(rows), np.concatenate(query_values),
+                np.concatenate(library_values))
+
+    def _exclude(self, rows, exclude_inchi):
+        if exclude_inchi is None:
+            return rows
+        return rows[self.labels['inchi'][rows] != exclude_inchi]
+
+    def _topK(self, rows, scores, k):
+        if len(rows) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            rows, scores = rows[best], scores[best]
+        order = np.lexsort((rows, -scores))
+        return rows[order], scores[order]
+
+    def cosine(self, peaks, parentmass=None, k=10, tolerance=None,
+               min_shared_peaks=1, exclude_inchi=None):
+        '''
+        Finds the k library spectra with the highest binned cosine
+        similarity to a query spectrum.
+
+        Args:
+            peaks: query peaks, as [(mz, intensity), ...]
+            parentmass: query parentmass, needed if tolerance is given
+            k: number of neighbours to return
+            tolerance: only consider library spectra whose parentmass is
+                within this many Da of the query's
+            min_shared_peaks: only score spectra that share at least this
+                many bins with the query
+            exclude_inchi: skip spectra of this molecule (e.g. to evaluate
+                the predictor on library spectra)
+        Returns:
+            rows: (<= k,) int array of library rows, best first
+            scores: (<= k,) float array of cosine scores
+        '''
+        bins, values = self.queryVector(peaks)
+        start, end = self.window(parentmass, tolerance)
+        rows, query_values, library_values = self._postings(
+            bins, values, start, end)
+        candidates, rows = np.unique(rows, return_inverse=True)
+        scores = np.bincount(rows, query_values * library_values,
+                             minlength=len(candidates))
+        shared = np.bincount(rows, minlength=len(candidates))
+        keep = shared >= min_shared_peaks
+        candidates, scores = candidates[keep], scores[keep]
+        if exclude_inchi is not None:
+            keep = self.labels['inchi'][candidates] != exclude_inchi
+            candidates, scores = candidates[keep], scores[keep]
+        return self._topK(candidates, scores, k)
+
+    def modifiedCosine(self, peaks, parentmass, k=10, tolerance=None,
+                       min_shared_peaks=1, exclude_inchi=None):
+        '''
+        Finds the k library spectra with the highest modified cosine
+        similarity to a query spectrum: peaks match either at the same bin,
+        or shifted by the difference in parentmass (so that fragments that
+        keep the modified part of the molecule still match). Each peak
+        matches at most one peak, picked greedily by the largest product.
+
+        Args:
+            the same as cosine(), but parentmass is required
+        Returns:
+            rows: (<= k,) int array of library rows, best first
+            scores: (<= k,) float array of modified cosine scores
+        '''
+        bins, values = self.queryVector(peaks)
+        start, end = self.window(parentmass, tolerance)
+        candidates = self._exclude(np.arange(start, end), exclude_inchi)
+        if len(candidates) == 0 or len(bins) == 0:
+            return np.zeros(0, np.int64), np.zeros(0)
+
+        # Dense lookup of the query's value at each bin
+        query = np.zeros(max(bins.max() + 1, self.vectors.shape[1]))
+        query[bins] = values
+        shifts = np.rint((parentmass - self.parentmass[candidates])
+                         / self.bin_width).astype(np.int64)
+
+        # Upper bound on each candidate's score: the plain and the shifted
+        # dot products, counting peaks that match both ways twice
+        sub = self.vectors[candidates]
+        peak_rows = np.repeat(np.arange(len(candidates)), np.diff(sub.indptr))
+        direct = query[sub.indices] * sub.data
+        shifted_bins = sub.indices + shifts[peak_rows]
+        inside = (shifted_bins >= 0) & (shifted_bins < len(query))
+        shifted = np.zeros(len(shifted_bins))
+        shifted[inside] = query[shifted_bins[inside]] * sub.data[inside]
+        bounds = np.bincount(peak_rows, direct + shifted,
+                             minlength=len(candidates))
+        shared = np.bincount(peak_rows, (direct > 0) | (shifted > 0),
+                             minlength=len(candidates))
+        possible = np.flatnonzero((shared >= min_shared_peaks) & (bounds > 0))
+
+        # Exact scores in order of decreasing bound, until no remaining
+        # bound can beat the k-th best score
+        possible = possible[np.argsort(-bounds[possible], kind='mergesort')]
+        rows = []
+        scores = []
+        kth_best = 0.
+        for i in possible:
+            if len(scores) >= k and bounds[i] <= kth_best:
+                break
+            row_peaks = slice(sub.indptr[i], sub.indptr[i + 1])
+            rows.append(candidates[i])
+            scores.append(_greedyMatch(bins, values, sub.indices[row_peaks],
+                                       sub.data[row_peaks], shifts[i]))
+            if len(scores) >= k:
+                kth_best = np.sort(scores)[-k]
+        return self._topK(np.array(rows, dtype=np.int64), np.array(scores), k)
+
+    def save(self, path):
+        '''
+        Writes the index to a directory of .npy arrays.
+        '''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        arrays = {'data': self.vectors.data,
+                  'indices': self.vectors.indices,
+                  'indptr': self.vectors.indptr,
+                  'parentmass': self.parentmass,
+                  'edges': self.edges,
+                  'intensity_power': np.array(self.intensity_power)}
+        for label in LABEL_COLUMNS:
+            arrays[label] = np.array([u'' if v is None else v
+                                      for v in self.labels[label]],
+                                     dtype=np.unicode_)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+
+def _normalisedVectors(mz, intensity, offsets, edges, intensity_power):
+    '''
+    Bins flat peak arrays and scales each spectrum's vector to unit length.
+    '''
+    vectors = binning.binSpectra(mz, intensity ** intensity_power, offsets,
+                                 edges, reduce='sum')
+    norms = np.sqrt(np.asarray(vectors.multiply(vectors).sum(axis=1))).ravel()
+    norms[norms == 0] = 1.
+    return scipy.sparse.diags(1. / norms).dot(vectors).tocsr()
+
+def _greedyMatch(query_bins, query_values, library_bins, library_values,
+                 shift):
+    '''
+    Modified cosine of two normalised binned spectra: pairs peaks at the
+    same bin or at bins shifted by shift, then greedily keeps the largest
+    products, using each peak at most once.
+    '''
+    pairs = []
+    for offset in set([0, shift]):
+        # Query bin b matches library bin b - offset
+        common, q, l = np.intersect1d(query_bins, library_bins + offset,
+                                      return_indices=True)
+        pairs.append((q, l, query_values[q] * library_values[l]))
+    q = np.concatenate([p[0] for p in pairs])
+    l = np.concatenate([p[1] for p in pairs])
+    products = np.concatenate([p[2] for p in pairs])
+    used_query = set()
+    used_library = set()
+    score = 0.
+    for i in np.argsort(-products, kind='mergesort'):
+        if q[i] in used_query or l[i] in used_library:
+            continue
+        used_query.add(q[i])
+        used_library.add(l[i])
+        score += products[i]
+    return score
+
+def buildSpectralIndex(spectra, bin_width=0.01, max_mz=None,
+                       intensity_power=0.5):
+    '''
+    Builds a SpectralIndex from the spectra in clean_spectra.json.
+
+    Args:
+        spectra: {spec_id: spectrum} dictionary, as written by clean_csv.py
+        bin_width: width of the m/z bins in Da
+        max_mz: upper limit of the bins [default: largest m/z in spectra]
+        intensity_power: intensities are raised to this power before
+            normalising
+    '''
+    spec_ids, metadata, mz, intensity, offsets = util.flattenSpectra(spectra)
+    if max_mz is None:
+        max_mz = mz.max() if len(mz) else binning.DEFAULT_MAX_MZ
+    n_bins = int(np.floor(max_mz / bin_width)) + 1
+    edges = binning.equalWidthEdges(n_bins, 0., n_bins * bin_width)
+    vectors = _normalisedVectors(mz, intensity, offsets, edges,
+                                 intensity_power)
+
+    parentmass = np.array(metadata['parentmass'], dtype=np.float64)
+    order = np.argsort(parentmass, kind='mergesort')
+    labels = {'spec_id': np.array(spec_ids, dtype=object)[order]}
+    for label in LABEL_COLUMNS[1:]:
+        labels[label] = np.array(metadata[label], dtype=object)[order]
+    return SpectralIndex(vectors[order], parentmass[order], edges, labels,
+                         intensity_power)
+
+def loadSpectralIndex(path, mmap_mode='r'):
+    '''
+    Loads an index written by SpectralIndex.save().
+    '''
+    arrays = dict((name, loadArray(path, name, mmap_mode))
+                  for name in INDEX_ARRAYS)
+    n_bins = len(arrays['edges']) - 1
+    vectors = scipy.sparse.csr_matrix(
+        (arrays['data'], arrays['indices'], arrays['indptr']),
+        shape=(len(arrays['parentmass']), n_bins))
+    labels = dict((label, np.load(os.path.join(path, label + '.npy'))
+                   .astype(object)) for label in LABEL_COLUMNS)
+    return SpectralIndex(vectors, np.asarray(arrays['parentmass']),
+                         np.asarray(arrays['edges']), labels,
+                         float(arrays['intensity_power']))
+
+
+class KNNTaxonomyPredictor:
+    '''
+    Predicts a spectrum's taxonomy by a similarity-weighted vote of its k
+    nearest library spectra.
+
+    Args:
+        index: SpectralIndex
+        level: 'kingdom', 'class' or 'sub_class'
+        k: number of neighbours
+        method: 'cosine' or 'modified_cosine'
+        query_args: passed to the query (e.g. tolerance, min_shared_peaks)
+    '''
+    def __init__(self, index, level='class', k=5, method='cosine',
+                 **query_args):
+        self.index = index
+        self.level = level
+        self.k = k
+        self.method = method
+        self.query_args = query_args
+
+    def neighbours(self, spectrum, exclude_inchi=None):
+        '''
+        Returns the (rows, scores) of the k nearest library spectra.
+        '''
+        query = (self.index.modifiedCosine if self.method == 'modified_cosine'
+                 else self.index.cosine)
+        return query(spectrum['peaks'], spectrum.get('parentmass'), k=self.k,
+                     exclude_inchi=exclude_inchi, **self.query_args)
+
+    def predict(self, spectrum, exclude_inchi=None):
+        '''
+        Args:
+            spectrum: dict with 'peaks' and 'parentmass', as in
+                clean_spectra.json
+            exclude_inchi: ignore library spectra of this molecule
+        Returns:
+            predicted label (None if no neighbours were found, or none of
+            them has a label) and its share of the vote
+        '''
+        rows, scores = self.neighbours(spectrum, exclude_inchi)
+        votes = dict()
+        for label, score in zip(self.index.labels[self.level][rows], scores):
+            if label:
+                votes[label] = votes.get(label, 0.) + score
+        if not votes:
+            return None, 0.
+        best = max(sorted(votes), key=votes.get)
+        return best, votes[best] / sum(votes.values())
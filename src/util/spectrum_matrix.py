@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+"""
+This file contains the builder and loader for sparse spectrum matrices: one
+row per molecule (inchikey), one column per m/z bin, with the highest
+intensity peak in each bin as the value. They hold the same data as the wide
+feature tables that make_mz_feature_tables.py writes, but stored as a CSR
+matrix, so memory scales with the number of peaks instead of with
+molecules x bins.
+
+A saved matrix is a directory of .npy arrays that can be memory mapped:
+
+    data.npy, indices.npy, indptr.npy    the CSR arrays
+    shape.npy                            (n_rows, n_columns)
+    columns.npy                          (n_columns,) float64 bin labels
+    inchi.npy, kingdom.npy, class.npy,   (n_rows,) row labels
+    sub_class.npy
+    channels.npy                         (n_columns,) channel of each column
+                                         ('fragment' or 'loss'); only for
+                                         matrices that mix both
+
+Besides fragment m/z, PeakTable can bin the neutral losses of the peaks
+(parentmass - m/z) into a second block of columns, that concatenateChannels()
+joins with the fragment columns.
+"""
+import os
+
+import numpy as np
+import scipy.sparse
+
+import binning
+import spectrum_merge
+import util
+from spectra_store import loadArray
+
+LABEL_COLUMNS = ['inchi', 'kingdom', 'class', 'sub_class']
+MATRIX_ARRAYS = ['data', 'indices', 'indptr', 'shape', 'columns']
+CHANNELS = ['fragment', 'loss']
+
+
+class SpectrumMatrix:
+    '''
+    A CSR molecule x m/z bin matrix with its row labels.
+
+    Attributes:
+        matrix: scipy.sparse.csr_matrix of intensities
+        columns: (n_columns,) float64 array with the m/z bin of each column
+        labels: {label: (n_rows,) array} for each of LABEL_COLUMNS
+        channels: (n_columns,) array with the channel (see CHANNELS) of each
+            column, or None if all columns are fragment m/z's
+    '''
+    def __init__(self, matrix, columns, labels, channels=None):
+        self.matrix = matrix
+        self.columns = columns
+        self.labels = labels
+        self.channels = channels
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def featureNames(self):
+        '''
+        Returns the column labels as strings, as they appear in the header of
+        the equivalent wide feature table. Neutral loss columns are prefixed
+        with 'loss_'.
+        '''
+        names = [str(int(c)) if c == int(c) else repr(c)
+                 for c in self.columns]
+        if self.channels is not None:
+            names = [name if channel == 'fragment' else channel + '_' + name
+                     for name, channel in zip(names, self.channels)]
+        return names
+
+    def selectColumns(self, low, high):
+        '''
+        Returns a new SpectrumMatrix with only the columns whose bin label is
+        between low and high (inclusive).
+        '''
+        keep = np.flatnonzero((self.columns >= low) & (self.columns <= high))
+        channels = self.channels
+        if channels is not None:
+            channels = np.asarray(channels)[keep]
+        return SpectrumMatrix(self.matrix[:, keep], self.columns[keep],
+                              self.labels, channels)
+
+    def selectRows(self, mask):
+        '''
+        Returns a new SpectrumMatrix with only the rows where mask is True.
+        '''
+        keep = np.flatnonzero(mask)
+        labels = dict((k, np.asarray(v)[keep]) for k, v in self.labels.items())
+        return SpectrumMatrix(self.matrix[keep], self.columns, labels,
+                              self.channels)
+
+    def patch(self, update, drop=()):
+        '''
+        Returns a new SpectrumMatrix where the rows of the molecules in update
+        replace (or are added to) the rows in this matrix, and the rows of the
+        molecules in drop are removed. Columns are the union of both
+        matrices' columns, and rows stay sorted by inchikey.
+
+        Args:
+            update: SpectrumMatrix with the new rows
+            drop: inchikeys to remove (e.g. molecules whose spectra changed
+                but are no longer in update)
+        '''
+        if self.channels is not None or update.channels is not None:
+            raise ValueError('Matrices with neutral loss columns can not be '
+                             'patched')
+        columns = np.union1d(self.columns, update.columns)
+        replaced = np.concatenate([np.asarray(update.labels['inchi']),
+                                   np.array(list(drop), dtype=np.unicode_)])
+        keep = np.flatnonzero(~np.in1d(self.labels['inchi'], replaced))
+        blocks = []
+        for data, rows in [(self, keep),
+                           (update, np.arange(update.shape[0]))]:
+            matrix = data.matrix[rows].tocsr()
+            indices = np.searchsorted(columns, data.columns)[matrix.indices]
+            blocks.append(scipy.sparse.csr_matrix(
+                (matrix.data, indices, matrix.indptr),
+                shape=(len(rows), len(columns))))
+        labels = dict()
+        for label in LABEL_COLUMNS:
+            labels[label] = np.concatenate(
+                [np.asarray(self.labels[label])[keep].astype(object),
+                 np.asarray(update.labels[label]).astype(object)])
+        order = np.argsort(labels['inchi'].astype(np.unicode_), kind='mergesort')
+        matrix = scipy.sparse.vstack(blocks).tocsr()[order]
+        labels = dict((k, v[order]) for k, v in labels.items())
+        return SpectrumMatrix(matrix, columns, labels)
+
+    def save(self, path):
+        '''
+        Writes the matrix to a directory of .npy arrays.
+        '''
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        matrix = self.matrix.tocsr()
+        # int32 indices let scipy use the memory-mapped arrays without a copy
+        index_dtype = np.int32 if matrix.nnz < 2**31 else np.int64
+        arrays = {'data': matrix.data.astype(np.float64),
+                  'indices': matrix.indices.astype(index_dtype),
+                  'indptr': matrix.indptr.astype(index_dtype),
+                  'shape': np.array(matrix.shape, dtype=np.int64),
+                  'columns': np.asarray(self.columns, dtype=np.float64)}
+        for label in LABEL_COLUMNS:
+            arrays[label] = np.array([u'' if v is None else v
+                                      for v in self.labels[label]],
+                                     dtype=np.unicode_)
+        if self.channels is not None:
+            arrays['channels'] = np.array(self.channels, dtype=np.unicode_)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+
+def isSpectrumMatrix(path):
+    '''
+    Returns True if path is a directory written by SpectrumMatrix.save().
+    '''
+    return os.path.isfile(os.path.join(path, 'indptr.npy'))
+
+def loadSpectrumMatrix(path, mmap_mode='r'):
+    '''
+    Loads a matrix written by SpectrumMatrix.save(). By default the arrays
+    are memory mapped, so this returns almost immediately.
+    '''
+    arrays = dict((name, loadArray(path, name, mmap_mode))
+                  for name in MATRIX_ARRAYS + LABEL_COLUMNS)
+    matrix = scipy.sparse.csr_matrix(
+        (arrays['data'], arrays['indices'], arrays['indptr']),
+        shape=tuple(arrays['shape']), copy=False)
+    labels = dict((label, arrays[label]) for label in LABEL_COLUMNS)
+    channels = None
+    if os.path.isfile(os.path.join(path, 'channels.npy')):
+        channels = loadArray(path, 'channels', mmap_mode)
+    return SpectrumMatrix(matrix, arrays['columns'], labels, channels)
+
+def concatenateChannels(blocks):
+    '''
+    Joins the columns of matrices with the same rows, e.g. the fragment and
+    neutral loss matrices of one PeakTable and ionization mode.
+
+    Args:
+        blocks: list of (channel, SpectrumMatrix) pairs, channel in CHANNELS
+    Returns:
+        SpectrumMatrix with the columns of all blocks, in order, and the
+        channel of each column in its channels
+    '''
+    first = blocks[0][1]
+    for channel, block in blocks:
+        if channel not in CHANNELS:
+            raise ValueError('Unknown channel: ' + str(channel))
+        if not np.array_equal(block.labels['inchi'], first.labels['inchi']):
+            raise ValueError('Matrices to concatenate must have the same rows')
+    matrix = scipy.sparse.hstack([block.matrix for channel, block in blocks],
+                                 format='csr')
+    columns = np.concatenate([np.asarray(block.columns, dtype=np.float64)
+                              for channel, block in blocks])
+    channels = np.array([channel for channel, block in blocks
+                         for _ in xrange(len(block.columns))],
+                        dtype=np.unicode_)
+    return SpectrumMatrix(matrix, columns, first.labels, channels)
+
+class PeakTable:
+    '''
+    The peaks of all spectra as flat arrays, sorted once by (molecule, m/z),
+    that any number of SpectrumMatrices can be built from (e.g. raw and
+    integer x positive, negative and all scans) without sorting or binning
+    the peaks again.
+
+    Since the peaks are sorted by (molecule, m/z) and every bin assignment is
+    monotonic in m/z, the (row, column) entries of every matrix come out
+    sorted, so binning.reducePeaks() can skip its sort. Ionization subsets
+    are index arrays into the sorted peaks, which keep that order too.
+
+    The neutral losses of the peaks (parentmass - m/z, see
+    binning.neutralLosses()) are computed along with them, and are binned the
+    same way for the 'loss' channel, through an index that orders the peaks
+    by (molecule, loss), built the first time it is needed.
+
+    Args:
+        spectra: {spec_id: spectrum} dictionary, as written by clean_csv.py
+        ionization: if given, only use spectra with this ionization mode
+    '''
+    def __init__(self, spectra, ionization=None):
+        spec_ids, metadata, mz, intensity, offsets = util.flattenSpectra(
+            spectra, ionization)
+        inchis, first_spectrum, spectrum_rows = np.unique(
+            np.array(metadata['inchi'], dtype=np.unicode_),
+            return_index=True, return_inverse=True)
+        counts = np.diff(offsets)
+        rows = np.repeat(spectrum_rows, counts)
+        spectrum_ionization = np.array(metadata['ionization'], dtype=object)
+        ionization = np.repeat(spectrum_ionization, counts)
+        self.spectrum_rows = spectrum_rows
+        self.spectrum_ionization = spectrum_ionization
+
+        losses = binning.neutralLosses(mz, offsets, metadata['parentmass'])
+
+        order = np.lexsort((mz, rows))
+        self.rows = rows[order].astype(np.int64)
+        self.mz = mz[order]
+        self.loss = losses[order]
+        self.intensity = intensity[order]
+        self.ionization = ionization[order]
+        self.inchis = inchis
+        self.labels = {'inchi': inchis}
+        for label in LABEL_COLUMNS[1:]:
+            self.labels[label] = np.array(
+                [metadata[label][i] for i in first_spectrum], dtype=object)
+        self._bins = dict()
+        self._loss_order = None
+
+    def values(self, channel='fragment'):
+        '''
+        The m/z ('fragment') or neutral loss ('loss') of every peak.
+        '''
+        if channel == 'fragment':
+            return self.mz
+        if channel == 'loss':
+            return self.loss
+        raise ValueError('Unknown channel: ' + str(channel))
+
+    def peaks(self, ionization=None, channel='fragment'):
+        '''
+        Returns the indices of the peaks of the spectra with an ionization
+        mode, or of all peaks if ionization is None. For the 'loss' channel,
+        only peaks with a neutral loss are returned, in (molecule, loss)
+        order.
+        '''
+        if channel == 'loss':
+            if self._loss_order is None:
+                valid = np.flatnonzero(self.loss > 0)
+                self._loss_order = valid[
+                    np.lexsort((self.loss[valid], self.rows[valid]))]
+            order = self._loss_order
+            if ionization is None:
+                return order
+            return order[self.ionization[order] == ionization]
+        if channel != 'fragment':
+            raise ValueError('Unknown channel: ' + str(channel))
+        if ionization is None:
+            return np.arange(len(self.mz))
+        return np.flatnonzero(self.ionization == ionization)
+
+    def _binsOf(self, strategy, channel='fragment'):
+        '''
+        Column of every peak for the 'raw' (distinct values) and 'integer'
+        strategies, computed once for all matrices.
+        '''
+        key = (channel, strategy)
+        if key not in self._bins:
+            values = self.values(channel)
+            if strategy == 'raw':
+                self._bins[key] = np.unique(values, return_inverse=True)
+            else:
+                self._bins[key] = (None, binning.integerBins(values))
+        return self._bins[key]
+
+    def matrix(self, ionization=None, strategy='raw', edges=None,
+               reduce='max', tolerance=0., tolerance_ppm=None,
+               channel='fragment', **params):
+        '''
+        Builds the molecule x m/z bin matrix of the spectra with an
+        ionization mode (or of all spectra). Takes the same arguments as
+        buildSpectrumMatrix().
+        '''
+        peaks = self.peaks(ionization, channel)
+        spectrum_rows = self.spectrum_rows
+        if ionization is not None:
+            spectrum_rows = spectrum_rows[
+                self.spectrum_ionization == ionization]
+        # Rows and columns are renumbered to the ones in use, which keeps
+        # their order
+        used_rows = np.bincount(spectrum_rows,
+                                minlength=len(self.inchis)) > 0
+        rows = (np.cumsum(used_rows) - 1)[self.rows[peaks]]
+        n_rows = int(used_rows.sum())
+        mz, intensity = self.values(channel)[peaks], self.intensity[peaks]
+
+        merge = tolerance or tolerance_ppm
+        if strategy == 'raw' and edges is None and merge:
+            merged_rows, _, mz, intensity, offsets = \
+                spectrum_merge.mergeMolecules(
+                    rows, mz, intensity, np.arange(len(rows) + 1), reduce,
+                    tolerance, tolerance_ppm)
+            rows = np.repeat(merged_rows, np.diff(offsets))
+            columns, cols = spectrum_merge.alignPeaks(
+                mz, intensity, tolerance, tolerance_ppm)
+        elif strategy == 'raw' and edges is None:
+            all_columns, cols = self._binsOf('raw', channel)
+            used_cols = np.bincount(cols[peaks],
+                                    minlength=len(all_columns)) > 0
+            cols = (np.cumsum(used_cols) - 1)[cols[peaks]]
+            columns = all_columns[used_cols]
+        elif strategy == 'integer' and edges is None and not params:
+            edges = binning.integerEdges(mz)
+            cols = self._binsOf('integer', channel)[1][peaks]
+            columns = edges[:-1]
+        else:
+            if edges is None:
+                edges = binning.makeEdges(strategy, mz, **params)
+            cols = binning.assignBins(mz, edges)
+            columns = edges[:-1]
+        keep = (cols >= 0) & (cols < len(columns))
+        if not keep.all():
+            rows, cols, intensity = rows[keep], cols[keep], intensity[keep]
+        matrix = binning.reducePeaks(rows, cols, intensity,
+                                     (n_rows, len(columns)), reduce)
+        labels = dict((label, values[used_rows])
+                      for label, values in self.labels.items())
+        return SpectrumMatrix(matrix, columns, labels)
+
+def buildSpectrumMatrix(spectra, ionization=None, strategy='raw', edges=None,
+                        reduce='max', tolerance=0., tolerance_ppm=None,
+                        channel='fragment', **params):
+    '''
+    Builds a molecule x m/z bin matrix from the spectra in clean_spectra.json.
+    All spectra of a molecule are merged, keeping the highest intensity peak
+    per bin (by default), as make_mz_feature_tables.py does. To build several
+    matrices from the same spectra, use one PeakTable instead.
+
+    Args:
+        spectra: {spec_id: spectrum} dictionary, as written by clean_csv.py
+        ionization: if given, only use spectra with this ionization mode
+        strategy: 'raw' to use each distinct m/z value as a column, or one of
+            binning.BIN_STRATEGIES (e.g. 'integer')
+        edges: precomputed bin edges, instead of computing them from strategy
+        reduce: how to combine peaks in the same bin, 'max' or 'sum'
+        tolerance, tolerance_ppm: for 'raw', merge each molecule's peaks
+            within this tolerance (in Da, or in ppm) and share columns
+            between m/z values within it (see spectrum_merge.py), instead of
+            one column per distinct m/z
+        channel: 'fragment' to bin the peaks' m/z, or 'loss' to bin their
+            neutral losses (parentmass - m/z) instead
+        params: passed to binning.makeEdges()
+    Returns:
+        SpectrumMatrix. For binned matrices, the columns are the lower edges
+        of the bins.
+    '''
+    return PeakTable(spectra, ionization).matrix(
+        None, strategy, edges, reduce, tolerance, tolerance_ppm, channel,
+        **params)
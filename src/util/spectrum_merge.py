@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+"""
+This file contains the vectorized engine that merges all spectra of each
+molecule into one spectrum, as make_merged_json.py does, working on the flat
+peak arrays from util.flattenSpectra() rather than on one dataframe row per
+peak.
+
+The peaks of all spectra are sorted by (molecule, m/z) in one go, and peaks
+of the same molecule with the same m/z are combined with a segmented max (or
+sum) over their intensities. The merged spectra come out as flat arrays with
+offsets again, so they can be binned (see binning.py) or decomposed (see
+motifs.py) directly.
+
+Peaks can also be merged within a tolerance, in Da or in ppm, rather than on
+exact m/z: sweeping over each molecule's sorted peaks, a run of merged peaks
+takes every peak within the tolerance of its first (smallest) m/z, so that a
+run never spans more than the tolerance, and each run is reported at its
+intensity-weighted centroid. alignPeaks() then maps
+the merged peaks of all molecules onto shared m/z columns, so that near
+identical m/z values from different molecules don't each get a column of
+their own.
+"""
+import numpy as np
+
+REDUCERS = {'max': np.maximum, 'sum': np.add}
+
+
+def _threshold(mz, tolerance, ppm):
+    '''
+    Largest m/z difference at which peaks are merged, per peak.
+    '''
+    if ppm:
+        return mz * (ppm * 1e-6)
+    return tolerance
+
+
+def _anchoredStarts(sorted_mz, limits, breaks=None):
+    '''
+    Starts of the runs of sorted m/z values, where each run takes every value
+    up to the limit of its first one.
+
+    A value beyond the limit of the one before it always starts a run, so
+    those are found in one go. Only within the clusters of closer values does
+    a sweep jump, with one searchsorted per run, from each run's first value
+    to the first value beyond its limit.
+
+    Args:
+        sorted_mz: (n,) sorted float64 array (or sorted within segments)
+        limits: (n,) largest m/z in a run that starts at each value; must
+            grow with the m/z
+        breaks: (n,) bool array, True where a new segment (e.g. a molecule)
+            begins, if runs must not cross segments
+    Returns:
+        (n_runs,) sorted int64 array
+    '''
+    n = len(sorted_mz)
+    new_cluster = np.r_[True, sorted_mz[1:] > limits[:-1]]
+    if breaks is not None:
+        new_cluster |= breaks
+    cluster_starts = np.flatnonzero(new_cluster)
+    cluster_ends = np.r_[cluster_starts[1:], n]
+    starts = [cluster_starts]
+    for lo, hi in zip(cluster_starts[cluster_ends - cluster_starts > 1],
+                      cluster_ends[cluster_ends - cluster_starts > 1]):
+        i = lo
+        while True:
+            i += int(np.searchsorted(sorted_mz[i:hi], limits[i], side='right'))
+            if i >= hi:
+                break
+            starts.append([i])
+    return np.sort(np.concatenate(starts)).astype(np.int64)
+
+
+def _centroids(mz, intensity, starts):
+    '''
+    Intensity-weighted mean m/z of each run of peaks (runs begin at starts).
+    Runs without intensity get their plain mean.
+    '''
+    weights = np.add.reduceat(intensity, starts)
+    weighted = np.add.reduceat(mz * intensity, starts)
+    counts = np.diff(np.r_[starts, len(mz)])
+    means = np.add.reduceat(mz, starts) / counts
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(weights > 0, weighted / weights, means)
+
+
+def mergeMolecules(spectrum_inchis, mz, intensity, offsets, reduce='max',
+                   tolerance=0., ppm=None):
+    '''
+    Merges the spectra of each molecule.
+
+    Args:
+        spectrum_inchis: (n_spectra,) inchikey of each spectrum
+        mz, intensity: (n_peaks,) float64 arrays of all peaks, spectrum by
+            spectrum
+        offsets: (n_spectra + 1,) int64 array; the peaks of spectrum i are
+            mz[offsets[i]:offsets[i + 1]]
+        reduce: how to combine the intensities of merged peaks, 'max' or
+            'sum'
+        tolerance: merge each run of a molecule's peaks that are at most
+            this many Da above the run's first peak (0 to only merge peaks
+            with the same m/z)
+        ppm: if given, merge peaks that are at most this many parts per
+            million of the first peak's m/z above it instead
+    Returns:
+        inchis: (n_molecules,) sorted inchikeys
+        first_spectrum: (n_molecules,) index of the first spectrum of each
+            molecule, e.g. to look up its metadata
+        mz, intensity: (n_merged_peaks,) float64 arrays of the merged peaks,
+            molecule by molecule, in m/z order. Peaks merged within a
+            tolerance are at their intensity-weighted centroid.
+        offsets: (n_molecules + 1,) int64 array; the merged peaks of molecule
+            i are mz[offsets[i]:offsets[i + 1]]
+    '''
+    if reduce not in REDUCERS:
+        raise ValueError('Unknown reduction: ' + str(reduce))
+    inchis, first_spectrum, codes = np.unique(
+        np.asarray(spectrum_inchis), return_index=True, return_inverse=True)
+    codes = np.repeat(codes.astype(np.int64), np.diff(offsets))
+    mz = np.asarray(mz, dtype=np.float64)
+    intensity = np.asarray(intensity, dtype=np.float64)
+
+    order = np.lexsort((mz, codes))
+    codes, mz, intensity = codes[order], mz[order], intensity[order]
+    if len(codes):
+        if tolerance or ppm:
+            # Runs are anchored at their first peak and end with their
+            # molecule
+            starts = _anchoredStarts(mz, mz + _threshold(mz, tolerance, ppm),
+                                     np.r_[True, codes[1:] != codes[:-1]])
+            merged_mz = _centroids(mz, intensity, starts)
+        else:
+            starts = np.flatnonzero(np.r_[True, (codes[1:] != codes[:-1])
+                                          | (mz[1:] != mz[:-1])])
+            merged_mz = mz[starts]
+        intensity = REDUCERS[reduce].reduceat(intensity, starts)
+        codes, mz = codes[starts], merged_mz
+    merged_offsets = np.searchsorted(codes, np.arange(len(inchis) + 1))
+    return (inchis, first_spectrum, mz, intensity,
+            merged_offsets.astype(np.int64))
+
+
+def alignPeaks(mz, intensity=None, tolerance=0., ppm=None):
+    '''
+    Maps peaks (e.g. the merged peaks of all molecules) onto shared m/z
+    columns. Sweeping over the sorted m/z values, each column takes every
+    peak within the tolerance of its smallest m/z, so that a column never
+    spans more than the tolerance.
+
+    Args:
+        mz: (n_peaks,) float64 array
+        intensity: (n_peaks,) weights for the column centroids [default:
+            unweighted]
+        tolerance: width of the columns in Da (0 for one column per
+            distinct m/z, as np.unique())
+        ppm: if given, width of the columns in parts per million of their
+            smallest m/z instead
+    Returns:
+        columns: (n_columns,) sorted m/z of each column, the (weighted)
+            centroid of its peaks
+        peak_cols: (n_peaks,) column of each peak
+    '''
+    mz = np.asarray(mz, dtype=np.float64)
+    if not (tolerance or ppm) or not len(mz):
+        return np.unique(mz, return_inverse=True)
+    order = np.argsort(mz, kind='mergesort')
+    sorted_mz = mz[order]
+    starts = _anchoredStarts(
+        sorted_mz, sorted_mz + _threshold(sorted_mz, tolerance, ppm))
+    if intensity is None:
+        weights = np.ones(len(mz))
+    else:
+        weights = np.asarray(intensity, dtype=np.float64)[order]
+    columns = _centroids(sorted_mz, weights, starts)
+    peak_cols = np.empty(len(mz), dtype=np.int64)
+    peak_cols[order] = np.repeat(np.arange(len(starts)),
+                                 np.diff(np.r_[starts, len(mz)]))
+    return columns, peak_cols
+
+
+def testMergeMolecules():
+    '''
+    Tests mergeMolecules() within a tolerance: a chain of peaks each closer
+    than the tolerance to the next must not collapse into one peak wider
+    than the tolerance, runs must not cross molecules, and random spectra
+    must merge as a peak by peak sweep anchored at each run's first peak
+    would.
+
+    Returns:
+        Boolean indicating equality
+    '''
+    success = True
+    # 100.0, 100.8 and 101.6 are each 0.8 apart: the first two merge
+    inchis, _, mz, intensity, offsets = mergeMolecules(
+        ['A', 'B'], [100.0, 100.8, 101.6, 101.0], [1., 3., 2., 5.],
+        [0, 3, 4], tolerance=1.)
+    success &= list(inchis) == ['A', 'B']
+    success &= np.array_equal(np.round(mz, 9), [100.6, 101.6, 101.0])
+    success &= np.array_equal(intensity, [3., 2., 5.])
+    success &= np.array_equal(offsets, [0, 2, 3])
+    # The same chain in ppm (8000 ppm of 100 is 0.8 Da)
+    _, _, mz, _, offsets = mergeMolecules(
+        ['A'], [100.0, 100.8, 101.6], [1., 1., 1.], [0, 3], ppm=8000.)
+    success &= np.array_equal(np.round(mz, 9), [100.4, 101.6])
+
+    rng = np.random.RandomState(0)
+    n_spectra = 40
+    spectrum_inchis = rng.choice(['A', 'B', 'C', 'D'], n_spectra)
+    offsets = np.r_[0, np.cumsum(rng.randint(0, 12, n_spectra))]
+    mz = np.round(rng.uniform(50., 60., offsets[-1]), 1)
+    intensity = rng.uniform(0., 1., offsets[-1])
+    inchis, _, merged_mz, merged_intensity, merged_offsets = mergeMolecules(
+        spectrum_inchis, mz, intensity, offsets, 'sum', tolerance=0.25)
+    peak_inchis = np.repeat(spectrum_inchis, np.diff(offsets))
+    for i, inchi in enumerate(inchis):
+        peaks = sorted(zip(mz[peak_inchis == inchi],
+                           intensity[peak_inchis == inchi]))
+        expected = []
+        while peaks:
+            run = [p for p in peaks if p[0] <= peaks[0][0] + 0.25]
+            peaks = peaks[len(run):]
+            expected.append(sum(p[1] for p in run))
+        start, stop = merged_offsets[i], merged_offsets[i + 1]
+        success &= (stop - start == len(expected) and np.allclose(
+            merged_intensity[start:stop], expected))
+        success &= bool(np.all(np.diff(merged_mz[start:stop]) > 0))
+    return bool(success)
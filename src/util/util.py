@@ -3,129 +3,273 @@
 This file contains useful functions used multiple times throughout this project.
 """
 from MetabolomicsObjects import Metabolite, MS2, MSPeak
+import spectra_store
 import csv
+import numpy as np
 
-def unpackCSV(file_path, bins=0, zero_indexed=False):
+def loadMetabolites(path):
   '''
-  Reads from csv, generates {inchikey:Metabolite} dictionary w/populated MS2
+  Reads the parsed HMDB data from either a spectra store (see
+  spectra_store.py) or a csv written by writeToCSV().
 
   Args:
-    file_path: path to csv file to read
+    path: path to spectra store directory or csv file
   Returns:
     {inchikey:Metabolite} dictionary
   '''
-  csv_file = open(file_path, 'r')
-  reader = csv.reader(csv_file)
-  row_count = 0
-  metabolite_dict = dict()
-  for row in reader:
-    row_count += 1
-    #Row is for a Metabolite object
-    if row[0]:
-      metabolite = Metabolite()
-      ms2_object_lst = []
-      for cell in row:
-        # Dictionary in cell should have been written as key:value;;key2:value2
-        attribute = cell.split('=')[0]
-        if ':' in cell:
-          attribute_dictionary = dict()
-          dictionary = cell.split('=', 1)[1]
-          split_dictionary = dictionary.split(';;')
-          for item in split_dictionary:
-            key = item.split(':')[0]
-            if len(item.split(':')) == 2:
-              value = item.split(':')[1]
-            else:
-              value = None
-            attribute_dictionary[key] = value
-          setattr(metabolite, attribute, attribute_dictionary)
-        #list in cell
-        elif ',' in cell:
-          cell_list = cell.split('=', 1)[1]
-          split_list = cell_list.split(',')
-          setattr(metabolite, attribute, split_list)
-        #sole (attribute, value) pair in cell but not just cell w/ only inchikey
+  if spectra_store.isSpectraStore(path):
+    return spectra_store.unpackStore(path)
+  return unpackCSV(path)
+
+def iterMetabolites(path):
+  '''
+  Streaming version of loadMetabolites(): reads a csv one metabolite at a
+  time (see iterCSV()). A spectra store is memory mapped, and is read whole.
+
+  Args:
+    path: path to spectra store directory or csv file
+  Yields:
+    Metabolite objects w/populated MS2
+  '''
+  if spectra_store.isSpectraStore(path):
+    for metabolite in spectra_store.unpackStore(path).itervalues():
+      yield metabolite
+  else:
+    for metabolite in iterCSV(path):
+      yield metabolite
+
+def _unpackMetaboliteRow(row):
+  '''
+  Generates a Metabolite (without MS2s) from a metabolite row of the csv.
+  '''
+  metabolite = Metabolite()
+  for cell in row:
+    # Dictionary in cell should have been written as key:value;;key2:value2
+    attribute = cell.split('=')[0]
+    if ':' in cell:
+      attribute_dictionary = dict()
+      dictionary = cell.split('=', 1)[1]
+      split_dictionary = dictionary.split(';;')
+      for item in split_dictionary:
+        key = item.split(':')[0]
+        if len(item.split(':')) == 2:
+          value = item.split(':')[1]
         else:
-          if '=' not in cell:
-            setattr(metabolite, 'inchikey', cell)
-            setattr(metabolite, 'inchi_key', cell)
-          else:
-            value = cell.split('=')[1]
-            if value:
-              setattr(metabolite, attribute, value)
-            else:
-              setattr(metabolite, attribute, None)
-    # If there is nothing in first cell, row is for an MS2 object
+          value = None
+        attribute_dictionary[key] = value
+      setattr(metabolite, attribute, attribute_dictionary)
+    #list in cell
+    elif ',' in cell:
+      cell_list = cell.split('=', 1)[1]
+      split_list = cell_list.split(',')
+      setattr(metabolite, attribute, split_list)
+    #sole (attribute, value) pair in cell but not just cell w/ only inchikey
     else:
-      ms2_object = MS2()
-      for cell in row[1:]:
-        #dictionary in cell:
-        attribute = cell.split('=')[0]
-        if ':' in cell:
-          attribute_dictionary = dict()
-          dictionary = cell.split('=', 1)[1]
-          split_dictionary = dictionary.split(';;')
-          for item in split_dictionary:
-            key = item.split(':')[0]
-            if len(item.split(':')) == 2:
-              value = item.split(':')[1]
-            else:
-              value = None
-            attribute_dictionary[key] = value
-          setattr(ms2_object, attribute, attribute_dictionary)
-        # #ms_peak data in cell
-        # elif 'ms_peak' in cell and '!' in cell:
-        #   peak_list = cell.split('=')[1].split(',')
-        #   for peak in peak_list:
-        #     peak_attributes = peak_list.split('!')
-        #     peak_object = MSPeak()
-        #     for peak_item in peak_items:
-        #       peak_attribute = peak_items.split('=')[0]
-        #       peak_value = peak_items.split('=')[1]
-        #       setattr(peak_object, peak_attribute, peak_value)
-
-        # The "peaks" attributes are separated by exclamation points
-        elif '!' in cell and attribute == "peaks":
-            mspeaks_str = cell.split('=', 1)[1]
-            # This creates a list with ['peaks=', 'id=123',
-            # 'intensity=123', ...]
-            mspeaks = mspeaks_str.split('!')
-            # Collect all values corresponding to 'mass_charge=' key
-            mzs = [i.split('=')[1] for i in mspeaks
-                   if i.startswith('mass_charge')]
-            intensities = [i.split('=')[1] for i in mspeaks
-                           if i.startswith('intensity')]
-            # Store MS2 peaks as a list of tuples
-            mz_i = [(float(i), float(j)) for i, j in zip(mzs, intensities)]
-            ms2_object.peaks = mz_i
-
-        #sole attribute data in cell
+      if '=' not in cell:
+        setattr(metabolite, 'inchikey', cell)
+        setattr(metabolite, 'inchi_key', cell)
+      else:
+        value = cell.split('=')[1]
+        if value:
+          setattr(metabolite, attribute, value)
         else:
-          peak_attribute = cell.split('=')[0]
-          peak_value = cell.split('=')[1]
-          setattr(ms2_object, peak_attribute, peak_value)
-      ms2_object_lst.append(ms2_object)
-    metabolite.MS2 = ms2_object_lst
-    metabolite_dict[metabolite.inchikey] = metabolite
+          setattr(metabolite, attribute, None)
+  return metabolite
+
+def _unpackMS2Row(row):
+  '''
+  Generates an MS2 object from an MS2 row (one with an empty first cell) of
+  the csv.
+  '''
+  ms2_object = MS2()
+  for cell in row[1:]:
+    #dictionary in cell:
+    attribute = cell.split('=')[0]
+    if ':' in cell:
+      attribute_dictionary = dict()
+      dictionary = cell.split('=', 1)[1]
+      split_dictionary = dictionary.split(';;')
+      for item in split_dictionary:
+        key = item.split(':')[0]
+        if len(item.split(':')) == 2:
+          value = item.split(':')[1]
+        else:
+          value = None
+        attribute_dictionary[key] = value
+      setattr(ms2_object, attribute, attribute_dictionary)
+    # #ms_peak data in cell
+    # elif 'ms_peak' in cell and '!' in cell:
+    #   peak_list = cell.split('=')[1].split(',')
+    #   for peak in peak_list:
+    #     peak_attributes = peak_list.split('!')
+    #     peak_object = MSPeak()
+    #     for peak_item in peak_items:
+    #       peak_attribute = peak_items.split('=')[0]
+    #       peak_value = peak_items.split('=')[1]
+    #       setattr(peak_object, peak_attribute, peak_value)
+
+    # The "peaks" attributes are separated by exclamation points
+    elif '!' in cell and attribute == "peaks":
+        mspeaks_str = cell.split('=', 1)[1]
+        # This creates a list with ['peaks=', 'id=123',
+        # 'intensity=123', ...]
+        mspeaks = mspeaks_str.split('!')
+        # Collect all values corresponding to 'mass_charge=' key
+        mzs = [i[12:] for i in mspeaks if i.startswith('mass_charge=')]
+        intensities = [i[10:] for i in mspeaks
+                       if i.startswith('intensity=')]
+        peak_ids = [i[3:] for i in mspeaks if i.startswith('id=')]
+        # Store MS2 peaks as an (n, 2) array of [mz, intensity] rows,
+        # parsed by numpy in one go
+        ms2_object.peaks = np.column_stack(
+            [np.array(mzs, dtype=np.float64),
+             np.array(intensities, dtype=np.float64)]).reshape(-1, 2)
+        if peak_ids and len(peak_ids) == len(mzs):
+            ms2_object.peak_ids = np.array(
+                [peak_id or -1 for peak_id in peak_ids], dtype=np.int64)
+
+    #sole attribute data in cell
+    else:
+      peak_attribute = cell.split('=')[0]
+      peak_value = cell.split('=')[1]
+      setattr(ms2_object, peak_attribute, peak_value)
+  return ms2_object
 
+def iterCSVRows(rows):
+  '''
+  Generates the Metabolites, w/populated MS2, of csv rows in the format
+  written by writeToCSV(): each metabolite row followed by its MS2 rows.
 
+  Args:
+    rows: iterable of csv rows (lists of cells)
+  Yields:
+    Metabolite objects, in file order
+  '''
+  metabolite = None
+  for row in rows:
+    #Row is for a Metabolite object
+    if row[0]:
+      if metabolite is not None:
+        yield metabolite
+      metabolite = _unpackMetaboliteRow(row)
+    # If there is nothing in first cell, row is for an MS2 object
+    elif metabolite is not None:
+      metabolite.MS2.append(_unpackMS2Row(row))
+  if metabolite is not None:
+    yield metabolite
+
+def iterCSV(file_path):
+  '''
+  Streaming version of unpackCSV(): reads the csv one metabolite at a time.
+
+  Args:
+    file_path: path to csv file to read
+  Yields:
+    Metabolite objects w/populated MS2, in file order
+  '''
+  with open(file_path, 'r') as csv_file:
+    for metabolite in iterCSVRows(csv.reader(csv_file)):
+      yield metabolite
+
+def binPeaks(metabolite_dict, bins, zero_indexed=False):
+  '''
+  Replaces the peaks of every MS2 in metabolite_dict by the list of the bins
+  of their m/z values (see unpackCSV()).
+  '''
   # peaks expected to be in [mz, intensity] order
   # maximum mz in dataset is ~2000
   # bins are one-indexed (not zero-indexed)
-  if bins:
-    dividers = np.linspace(0., 2000, num=bins)
-    if zero_indexed:
-      dividers.pop(0)
-    for metabolite in metabolite_dict.itervalues():
-      for ms2 in metabolite.MS2:
-        if not ms2.peaks: continue
-        for index, (mz, intensity) in enumerate(ms2.peaks):
-          bin = np.searchsorted(dividers, mz)
-          ms2.peaks[index] = bin
+  dividers = np.linspace(0., 2000, num=bins)
+  if zero_indexed:
+    dividers = dividers[1:]
+  ms2_objects = [ms2 for metabolite in metabolite_dict.itervalues()
+                 for ms2 in metabolite.MS2
+                 if ms2.peaks is not None and len(ms2.peaks)]
+  # Bin every peak in the dataset with a single searchsorted call
+  mz = np.concatenate([ms2.peaks[:, 0] for ms2 in ms2_objects]
+                      or [np.zeros(0)])
+  peak_bins = np.searchsorted(dividers, mz).tolist()
+  start = 0
+  for ms2 in ms2_objects:
+    end = start + len(ms2.peaks)
+    ms2.peaks = peak_bins[start:end]
+    start = end
+
+def unpackCSV(file_path, bins=0, zero_indexed=False):
+  '''
+  Reads from csv, generates {inchikey:Metabolite} dictionary w/populated MS2
 
+  Args:
+    file_path: path to csv file to read
+  Returns:
+    {inchikey:Metabolite} dictionary
+  '''
+  metabolite_dict = dict()
+  for metabolite in iterCSV(file_path):
+    metabolite_dict[metabolite.inchikey] = metabolite
+  if bins:
+    binPeaks(metabolite_dict, bins, zero_indexed)
   return metabolite_dict
 
 
+def flattenSpectra(spectra, ionization=None):
+  '''
+  Flattens the spectra from clean_spectra.json into flat peak arrays, which is
+  what the vectorized feature-building code works on.
+
+  Args:
+    spectra: {spec_id: spectrum} dictionary, as written by clean_csv.py, or
+      iterable of (spec_id, spectrum) pairs (e.g. from
+      clean_spectra.iterSpectra()), which is read one pair at a time
+    ionization: if given, only keep spectra with this ionization mode
+  Returns:
+    spec_ids: list of spectrum ids, sorted
+    metadata: {key: list} with one entry per spectrum for 'inchi',
+      'ionization', 'kingdom', 'class', 'sub_class' and 'parentmass'; None
+      for the keys a spectrum doesn't have (e.g. the merged spectra from
+      make_merged_json.py have no 'inchi' or 'ionization')
+    mz, intensity: (n_peaks,) float64 arrays of all peaks, spectrum by
+      spectrum
+    offsets: (n_spectra + 1,) int64 array; the peaks of spectrum i are
+      mz[offsets[i]:offsets[i + 1]]
+  '''
+  metadata_keys = ['inchi', 'ionization', 'kingdom', 'class', 'sub_class',
+                   'parentmass']
+  if isinstance(spectra, dict):
+    spectra = spectra.iteritems()
+  # Read the spectra one at a time, in file order, so that a lazy iterable
+  # is never held in memory as a whole; they are sorted at the end
+  spec_ids = []
+  metadata = dict((k, []) for k in metadata_keys)
+  peak_arrays = []
+  for spec_id, spectrum in spectra:
+    if ionization is not None and spectrum.get('ionization') != ionization:
+      continue
+    spec_ids.append(spec_id)
+    for k in metadata_keys:
+      metadata[k].append(spectrum.get(k))
+    peak_arrays.append(
+        np.asarray(spectrum['peaks'], dtype=np.float64).reshape(-1, 2))
+  lengths = np.array([len(peaks) for peaks in peak_arrays], dtype=np.int64)
+  if peak_arrays:
+    peaks = np.concatenate(peak_arrays)
+  else:
+    peaks = np.zeros((0, 2))
+  del peak_arrays
+  # Sort by spectrum id, and gather the peaks segment by segment to match
+  order = sorted(range(len(spec_ids)), key=spec_ids.__getitem__)
+  spec_ids = [spec_ids[i] for i in order]
+  for k in metadata_keys:
+    metadata[k] = [metadata[k][i] for i in order]
+  starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+  order = np.array(order, dtype=np.int64)
+  offsets = np.zeros(len(spec_ids) + 1, dtype=np.int64)
+  np.cumsum(lengths[order], out=offsets[1:])
+  gather = (np.repeat(starts[order] - offsets[:-1], lengths[order])
+            + np.arange(offsets[-1], dtype=np.int64))
+  peaks = peaks[gather]
+  return spec_ids, metadata, peaks[:, 0].copy(), peaks[:, 1].copy(), offsets
+
 
 # def produceBins(metabolite_dict, bins=100):
 #   dividers = np.linspace(0., 2000, num=bins)
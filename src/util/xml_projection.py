@@ -0,0 +1,672 @@
+#!/usr/bin/env python
+"""
+This file contains the projecting xml record reader used by
+src/data/parse_xml_files.py to read the HMDB metabolite and spectra xml.
+
+A Projection declares, per child tag of a record element (a <metabolite>, or
+an <ms-ms> spectrum), whether the child is kept and how it is converted into
+an attribute of the record object:
+
+    TEXT          the child's text, set as one or more attributes
+    ID            the child's text, stored in a dictionary attribute
+                  (e.g. id_dict) under the child's name
+    LIST          the texts of the child's children, as a list
+    DICT          {grandchild name: text} of the child's children
+    NESTED_DICT   {name: text} of the child's grandchildren, flattened
+                  (e.g. all of the fields under <references><reference>)
+    RECORDS       one object per child of the child, with the grandchildren
+                  as attributes
+    COLUMNS       numpy arrays of the grandchildren's values, one row per
+                  child of the child (e.g. the m/z and intensity of the
+                  <ms-ms-peak>s)
+    REJECT        the whole record is dropped
+
+Children without a rule are skipped before any xml is parsed: the reader
+splits the raw bytes of the file into records, cuts the unwanted top-level
+subtrees (descriptions, pathways, proteins, concentrations, ...) out of each
+record with plain string searches, and only hands the remainder to
+cElementTree (Projections with prune=False skip the children while
+converting instead). Rules are looked up by raw (namespaced) tag, so each
+distinct tag is resolved only once.
+
+For parsing one large file in parallel, loadOffsetIndex() scans the file once
+for the byte offsets of its records and saves them next to it; disjoint runs
+of records can then be parsed independently with iterRecordRange().
+
+The byte scanner only handles UTF-8 (or ASCII) documents without comments,
+CDATA sections or a doctype, which could hide or fake record tags. It raises
+UnscannableXMLError on anything else, and iterRecords() then parses the file
+with ElementTree's iterparse instead (see iterParsedRecords()).
+"""
+import os
+import re
+
+import numpy as np
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+TEXT = 'text'
+ID = 'id'
+LIST = 'list'
+DICT = 'dict'
+NESTED_DICT = 'nested_dict'
+RECORDS = 'records'
+COLUMNS = 'columns'
+REJECT = 'reject'
+
+# Start tag of an element: its name, and whether it is empty (<tag ... />)
+_START_TAG = re.compile(
+    r'<([^\s/>!?]+)(?:[^>"\']|"[^"]*"|\'[^\']*\')*?(/?)>')
+_NAMESPACE_DECLARATION = re.compile(
+    r'(xmlns(?::[^\s=]+)?)\s*=\s*("[^"]*"|\'[^\']*\')')
+_ENCODING_DECLARATION = re.compile(
+    r'(?:\xef\xbb\xbf)?<\?xml[^>]*?encoding\s*=\s*["\']([^"\']*)')
+# Encodings whose bytes the scanner can search for ASCII tags as they are
+_SCANNABLE_ENCODINGS = frozenset(['utf-8', 'utf8', 'us-ascii', 'ascii'])
+
+
+class UnscannableXMLError(ValueError):
+    '''
+    Raised by the byte scanner (iterRecordBytes(), recordOffsets()) for xml
+    it can't split into records by itself; see the module docstring.
+    '''
+
+
+def localName(tag):
+    '''
+    Strips the namespace from an ElementTree tag ('{namespace}name').
+    '''
+    return tag.rsplit('}', 1)[-1]
+
+
+class Rule:
+    '''
+    How one child tag of a record is converted, see the module docstring.
+
+    Args:
+        kind: one of TEXT, ID, LIST, DICT, NESTED_DICT, RECORDS, REJECT
+        attributes: for TEXT, list of (attribute, value if the text is
+            empty) pairs to set. For COLUMNS, list of (attribute, fields,
+            dtype) triples: each attribute is set to an (n_rows,
+            len(fields)) array of the named fields (or an (n_rows,) array
+            for a single field). Rows missing any of the fields of the first
+            attribute are dropped. For the other kinds, the name of the
+            attribute to set (or, for ID, of the dictionary attribute).
+        key: for ID, the dictionary key. For DICT, NESTED_DICT, RECORDS and
+            COLUMNS, a function mapping the local name of a nested tag to its
+            key, attribute or field name, or to None to leave that element
+            out.
+        empty: value stored for elements with no text (except for TEXT). For
+            COLUMNS, the value of missing fields of the later attributes.
+        factory: for RECORDS, callable creating the object for each child
+    '''
+    def __init__(self, kind, attributes=None, key=None, empty=None,
+                 factory=None):
+        self.kind = kind
+        self.attributes = attributes
+        self.key = key
+        self.empty = empty
+        self.factory = factory
+        self._keys = dict()
+
+    def keyFor(self, tag):
+        '''
+        Key of a nested element, memoized by raw tag.
+        '''
+        try:
+            return self._keys[tag]
+        except KeyError:
+            key = self._keys[tag] = self.key(localName(tag))
+            return key
+
+
+class Projection:
+    '''
+    The fields kept from one kind of xml record.
+
+    Args:
+        record_tag: local name of the record elements, e.g. 'metabolite'
+        factory: callable creating an empty record object
+        rule_for: function mapping the local name of a child tag of the
+            record to its Rule, or to None to skip the child
+        prune: cut the skipped children out of the raw record before parsing
+            it. Only worth it when records have large skipped subtrees.
+    '''
+    def __init__(self, record_tag, factory, rule_for, prune=True):
+        self.record_tag = record_tag
+        self.factory = factory
+        self.rule_for = rule_for
+        self.prune = prune
+        self._rules = dict()
+
+    def rule(self, tag):
+        '''
+        The Rule for a raw child tag (namespaced, or with a prefix), memoized.
+        '''
+        try:
+            return self._rules[tag]
+        except KeyError:
+            rule = self._rules[tag] = self.rule_for(
+                localName(tag).rsplit(':', 1)[-1])
+            return rule
+
+    def apply(self, element):
+        '''
+        Converts a record element into a record object.
+
+        Returns:
+            the record object, or None if the record was rejected
+        '''
+        record = self.factory()
+        for child in element:
+            rule = self.rule(child.tag)
+            if rule is None:
+                continue
+            kind = rule.kind
+            if kind == TEXT:
+                for attribute, empty in rule.attributes:
+                    setattr(record, attribute, child.text or empty)
+            elif kind == ID:
+                getattr(record, rule.attributes)[rule.key] = \
+                    child.text or rule.empty
+            elif kind == LIST:
+                setattr(record, rule.attributes,
+                        [item.text for item in child])
+            elif kind == DICT:
+                dictionary = dict()
+                for item in child:
+                    key = rule.keyFor(item.tag)
+                    if key is not None:
+                        dictionary[key] = item.text or rule.empty
+                setattr(record, rule.attributes, dictionary)
+            elif kind == NESTED_DICT:
+                dictionary = dict()
+                for item in child:
+                    for field in item:
+                        key = rule.keyFor(field.tag)
+                        if key is not None:
+                            dictionary[key] = field.text or rule.empty
+                setattr(record, rule.attributes, dictionary)
+            elif kind == RECORDS:
+                objects = []
+                for item in child:
+                    obj = rule.factory()
+                    for field in item:
+                        key = rule.keyFor(field.tag)
+                        if key is not None:
+                            setattr(obj, key, field.text or rule.empty)
+                    objects.append(obj)
+                setattr(record, rule.attributes, objects)
+            elif kind == COLUMNS:
+                _setColumns(record, rule, child)
+            elif kind == REJECT:
+                return None
+        return record
+
+    def keeps(self, name):
+        '''
+        Whether a raw child tag name (as written in the file, e.g.
+        'hmdb:name' or 'name') is kept.
+        '''
+        return self.rule(name) is not None
+
+
+def _setColumns(record, rule, element):
+    '''
+    Applies a COLUMNS rule to element, see Rule.
+    '''
+    required = rule.attributes[0][1]
+    columns = [[] for _ in rule.attributes]
+    for item in element:
+        values = dict()
+        for field in item:
+            key = rule.keyFor(field.tag)
+            if key is not None:
+                values[key] = field.text
+        if not all(values.get(field) for field in required):
+            continue
+        for column, (_, fields, _) in zip(columns, rule.attributes):
+            column.append([values.get(field) or rule.empty
+                           for field in fields])
+    for column, (attribute, fields, dtype) in zip(columns, rule.attributes):
+        array = np.array(column, dtype=dtype).reshape(-1, len(fields))
+        setattr(record, attribute, array[:, 0] if len(fields) == 1 else array)
+
+
+# Start and end tags of each element name, compiled by _elementEnd()
+_tag_patterns = dict()
+
+def _elementEnd(data, name, start, stop):
+    '''
+    Returns the offset just past the end tag of the element named name whose
+    start tag ends at start, searching no further than stop. Nested elements
+    with the same name are accounted for.
+    '''
+    # Common case: no nested element with the same name
+    close = data.find('</' + name, start, stop)
+    after = close + len(name) + 2
+    if close >= 0 and after < stop and data[after] in '\t\n\r >' \
+            and data.find('<' + name, start, close) < 0:
+        return data.index('>', close, stop) + 1
+    tags = _tag_patterns.get(name)
+    if tags is None:
+        tags = _tag_patterns[name] = re.compile(
+            '<(/?)' + re.escape(name) + r'[\s/>]')
+    depth = 1
+    for match in tags.finditer(data, start, stop):
+        if match.group(1):
+            depth -= 1
+            if depth == 0:
+                return data.index('>', match.start(), stop) + 1
+        else:
+            tag = _START_TAG.match(data, match.start())
+            if tag is None or not tag.group(2):
+                depth += 1
+    raise ValueError('Unclosed <{}> element'.format(name))
+
+
+def pruneRecord(data, start, stop, projection, namespaces=''):
+    '''
+    Cuts the skipped children out of one record (unless projection.prune is
+    False).
+
+    Args:
+        data: str holding the record
+        start, stop: offsets of the record's start tag and of the end of its
+            end tag in data
+        projection: the Projection to apply
+        namespaces: namespace declarations of the enclosing elements (e.g.
+            'xmlns="http://www.hmdb.ca"'), added to the record's start tag so
+            that it can be parsed on its own
+    Returns:
+        str with the pruned record, as a standalone xml document
+    '''
+    start_tag = _START_TAG.match(data, start)
+    head = data[start:start_tag.end()]
+    if namespaces:
+        declared = set(name for name, _ in
+                       _NAMESPACE_DECLARATION.findall(head))
+        extra = ' '.join(name + '=' + value for name, value in
+                         _NAMESPACE_DECLARATION.findall(namespaces)
+                         if name not in declared)
+        if extra:
+            head = head[:-2] + ' ' + extra + '/>' if start_tag.group(2) \
+                else head[:-1] + ' ' + extra + '>'
+    if start_tag.group(2):
+        return head
+    body_start = start_tag.end()
+    if not projection.prune:
+        return head + data[body_start:stop]
+    body_stop = data.rindex('</', body_start, stop)
+    # Comments, CDATA and processing instructions could hide tags from the
+    # scan below; keep such records whole
+    if data.find('<!', body_start, body_stop) >= 0 \
+            or data.find('<?', body_start, body_stop) >= 0:
+        return head + data[body_start:stop]
+    kept = [head]
+    position = body_start
+    while True:
+        child = _START_TAG.search(data, position, body_stop)
+        if child is None:
+            break
+        name = child.group(1)
+        end = child.end() if child.group(2) else \
+            _elementEnd(data, name, child.end(), body_stop)
+        if projection.keeps(name):
+            kept.append(data[child.start():end])
+        position = end
+    kept.append(data[body_stop:stop])
+    return ''.join(kept)
+
+
+def _rootNamespaces(data):
+    '''
+    Namespace declarations on the root element of an xml document, given (at
+    least) the start of the document.
+    '''
+    position = 0
+    while True:
+        tag = _START_TAG.search(data, position)
+        if tag is None:
+            return ''
+        # Skip the xml declaration, comments and doctype
+        if data.startswith('<?', tag.start()) \
+                or data.startswith('<!', tag.start()):
+            position = tag.end()
+            continue
+        return ' '.join(name + '=' + value for name, value in
+                        _NAMESPACE_DECLARATION.findall(data[tag.start():
+                                                            tag.end()]))
+
+
+def _checkEncoding(data):
+    '''
+    Raises UnscannableXMLError unless a document, given its start, is in an
+    encoding the scanner can read.
+    '''
+    if data.startswith(('\xff\xfe', '\xfe\xff')) or '\x00' in data[:4]:
+        raise UnscannableXMLError('UTF-16 or UTF-32 xml')
+    declaration = _ENCODING_DECLARATION.match(data)
+    if declaration is not None \
+            and declaration.group(1).lower() not in _SCANNABLE_ENCODINGS:
+        raise UnscannableXMLError(declaration.group(1) + ' encoded xml')
+
+
+def _checkMarkup(data, start, stop):
+    '''
+    Raises UnscannableXMLError if there is a comment, CDATA section or
+    doctype in data[start:stop].
+    '''
+    if data.find('<!', start, stop) >= 0:
+        raise UnscannableXMLError('Comment, CDATA or doctype in the xml')
+
+
+def _scanRecords(xml_file, record_tag, chunk_size):
+    '''
+    Body of iterRecordBytes(), also yielding the offset in the file of the
+    start of data, for recordOffsets().
+    '''
+    start_tag = re.compile('<' + re.escape(record_tag) + r'[\s/>]')
+    data = ''
+    base = 0
+    namespaces = None
+    eof = False
+    position = 0
+    while True:
+        match = start_tag.search(data, position)
+        if match is not None:
+            tag = _START_TAG.match(data, match.start())
+            if tag is not None and tag.group(2):
+                _checkMarkup(data, position, tag.end())
+                yield data, match.start(), tag.end(), namespaces, base
+                position = tag.end()
+                continue
+            if tag is not None:
+                try:
+                    end = _elementEnd(data, record_tag, tag.end(), len(data))
+                except ValueError:
+                    end = None
+                if end is not None:
+                    _checkMarkup(data, position, end)
+                    yield data, match.start(), end, namespaces, base
+                    position = end
+                    continue
+        if eof:
+            return
+        # Need more data: keep from the start of the current record (or, if
+        # there isn't one, a tag's length of the tail, in case it was cut)
+        keep_from = match.start() if match is not None else \
+            max(position, len(data) - len(record_tag) - 2)
+        _checkMarkup(data, position, keep_from + 1)
+        chunk = xml_file.read(chunk_size)
+        eof = not chunk
+        data = data[keep_from:] + chunk
+        base += keep_from
+        position = 0
+        if namespaces is None:
+            _checkEncoding(data)
+            namespaces = _rootNamespaces(data)
+
+
+def iterRecordBytes(xml_file, record_tag, chunk_size=1 << 20):
+    '''
+    Splits an xml file into the raw bytes of its record elements, without
+    parsing it. The file is read in chunks, so memory use is bounded by the
+    size of a chunk plus a record.
+
+    Args:
+        xml_file: path to (or open file object of) the xml file
+        record_tag: name of the record elements, as written in the file
+        chunk_size: number of bytes read at a time
+    Yields:
+        (data, start, stop, namespaces) for each record, where the record is
+        data[start:stop] and namespaces are the root element's namespace
+        declarations
+    Raises:
+        UnscannableXMLError, once the scan reaches xml it can't handle (see
+        the module docstring)
+    '''
+    if isinstance(xml_file, basestring):
+        with open(xml_file, 'rb') as f:
+            for record in iterRecordBytes(f, record_tag, chunk_size):
+                yield record
+        return
+    for data, start, stop, namespaces, _ in _scanRecords(
+            xml_file, record_tag, chunk_size):
+        yield data, start, stop, namespaces
+
+
+def parseRecord(data, start, stop, projection, namespaces=''):
+    '''
+    Parses the record data[start:stop] through a projection (see
+    pruneRecord() for the arguments).
+
+    Returns:
+        the record object, or None if the record was rejected
+    '''
+    return projection.apply(ET.fromstring(
+        pruneRecord(data, start, stop, projection, namespaces)))
+
+
+def iterParsedRecords(xml_file, projection, skip=0):
+    '''
+    Streams the records of an xml file through a projection with
+    ElementTree's iterparse, clearing each record once it is converted. This
+    is the fallback of iterRecords() for the xml the byte scanner can't
+    handle: it is slower, since every element is parsed.
+
+    Args:
+        xml_file: path to (or open file object of) the xml file
+        projection: the Projection to apply
+        skip: number of records at the start of the file to drop without
+            converting them
+    Yields:
+        record objects, in document order. Rejected records are skipped.
+    '''
+    record_name = projection.record_tag.rsplit(':', 1)[-1]
+    parents = []
+    open_records = 0
+    for event, element in ET.iterparse(xml_file, events=('start', 'end')):
+        is_record = localName(element.tag) == record_name
+        if event == 'start':
+            parents.append(element)
+            open_records += is_record
+            continue
+        parents.pop()
+        if not is_record:
+            continue
+        open_records -= 1
+        if open_records:
+            continue
+        record = projection.apply(element) if skip <= 0 else None
+        skip -= 1
+        element.clear()
+        if parents:
+            parents[-1].remove(element)
+        if record is not None:
+            yield record
+
+
+def iterRecords(xml_file, projection, chunk_size=1 << 20, reopen=None):
+    '''
+    Streams the records of an xml file through a projection.
+
+    If the byte scanner can't handle the file (see the module docstring),
+    the file is parsed again from its start with iterParsedRecords(),
+    skipping the records that were already yielded.
+
+    Args:
+        xml_file: path to (or open file object of) the xml file
+        projection: the Projection to apply
+        chunk_size: number of bytes read at a time
+        reopen: for an open file object that can't seek back to its start
+            (e.g. a zip file member), function returning a new file object
+            of the same xml file, used by the fallback
+    Yields:
+        record objects, in document order. Rejected records are skipped.
+    '''
+    if isinstance(xml_file, basestring):
+        with open(xml_file, 'rb') as f:
+            for record in iterRecords(f, projection, chunk_size):
+                yield record
+        return
+    if reopen is None:
+        origin = xml_file.tell()
+        def reopen():
+            xml_file.seek(origin)
+            return xml_file
+    n_scanned = 0
+    try:
+        for data, start, stop, namespaces in iterRecordBytes(
+                xml_file, projection.record_tag, chunk_size):
+            n_scanned += 1
+            record = parseRecord(data, start, stop, projection, namespaces)
+            if record is not None:
+                yield record
+        return
+    except UnscannableXMLError:
+        pass
+    fallback = reopen()
+    try:
+        for record in iterParsedRecords(fallback, projection, n_scanned):
+            yield record
+    finally:
+        if fallback is not xml_file:
+            fallback.close()
+
+
+def recordOffsets(xml_file, record_tag, chunk_size=1 << 20):
+    '''
+    Scans an xml file for the byte offsets of its record elements, without
+    parsing it.
+
+    Args:
+        xml_file: path to the xml file
+        record_tag: name of the record elements, as written in the file
+        chunk_size: number of bytes read at a time
+    Returns:
+        (n_records, 2) int64 array of the [start, stop) offsets of each
+            record in the file
+        namespace declarations of the root element (see pruneRecord())
+    '''
+    offsets = []
+    namespaces = ''
+    with open(xml_file, 'rb') as f:
+        for _, start, stop, namespaces, base in _scanRecords(
+                f, record_tag, chunk_size):
+            offsets.append((base + start, base + stop))
+    return np.array(offsets, dtype=np.int64).reshape(-1, 2), namespaces or ''
+
+
+def offsetIndexPath(xml_file):
+    '''
+    Path of the offset index saved next to an xml file by loadOffsetIndex().
+    '''
+    return xml_file + '.offsets.npz'
+
+
+def loadOffsetIndex(xml_file, record_tag, chunk_size=1 << 20):
+    '''
+    Returns the record offsets of an xml file (see recordOffsets()). The
+    offsets are saved next to the file (see offsetIndexPath()), and read back
+    from there as long as the file's size and modification time and the
+    record tag are unchanged, so that the file is only scanned once.
+    '''
+    fname = offsetIndexPath(xml_file)
+    stat = os.stat(xml_file)
+    if os.path.isfile(fname):
+        index = np.load(fname)
+        if index['size'] == stat.st_size \
+                and index['mtime'] == stat.st_mtime \
+                and str(index['record_tag']) == record_tag:
+            return index['offsets'], str(index['namespaces'])
+    offsets, namespaces = recordOffsets(xml_file, record_tag, chunk_size)
+    try:
+        with open(fname + '.tmp', 'wb') as f:
+            np.savez(f, offsets=offsets, namespaces=namespaces,
+                     record_tag=record_tag, size=stat.st_size,
+                     mtime=stat.st_mtime)
+        os.rename(fname + '.tmp', fname)
+    except (IOError, OSError):
+        # e.g. a read-only data directory; the index is only a cache
+        pass
+    return offsets, namespaces
+
+
+def iterRecordRange(f, offsets, projection, namespaces=''):
+    '''
+    Parses a run of consecutive records of an xml file, e.g. one shard of
+    the offsets returned by loadOffsetIndex(), with a single read.
+
+    Args:
+        f: open file object of the xml file
+        offsets: (n, 2) array of the [start, stop) offsets of the records,
+            in file order
+        projection: the Projection to apply
+        namespaces: namespace declarations of the root element
+    Yields:
+        record objects, in file order. Rejected records are skipped.
+    '''
+    if len(offsets) == 0:
+        return
+    base = int(offsets[0, 0])
+    f.seek(base)
+    data = f.read(int(offsets[-1, 1]) - base)
+    for start, stop in offsets - base:
+        record = parseRecord(data, int(start), int(stop), projection,
+                             namespaces)
+        if record is not None:
+            yield record
+
+
+def testUnscannableXML():
+    '''
+    Tests iterRecords() on xml the byte scanner can't handle (a commented-out
+    record, CDATA holding an end tag, latin-1 and UTF-16 documents) against
+    iterParsedRecords(), and that the scanner does handle the plain
+    document.
+
+    Returns:
+        Boolean indicating equality
+    '''
+    from StringIO import StringIO
+
+    class Item(object):
+        pass
+    projection = Projection(
+        'item', Item,
+        lambda tag: Rule(TEXT, [(tag, None)]) if tag == 'name' else None)
+    head = '<?xml version="1.0" encoding="%s"?>\n<items>\n'
+    records = [u'<item><name>a</name><skip>x</skip></item>\n',
+               u'<item><name>\xe9</name></item>\n',
+               u'<item><name>c</name></item>\n']
+    tail = u'</items>\n'
+    names = [u'a', u'\xe9', u'c']
+    documents = [
+        ('UTF-8', records, names, False),
+        ('UTF-8', records[:2] + [u'<!-- <item><name>b</name></item> -->\n']
+         + records[2:], names, True),
+        ('UTF-8', records[:1]
+         + [u'<item><name><![CDATA[</item>]]></name></item>\n']
+         + records[1:], names[:1] + [u'</item>'] + names[1:], True),
+        ('ISO-8859-1', records, names, True),
+        ('UTF-16', records, names, True)]
+    success = True
+    for encoding, body, expected, unscannable in documents:
+        data = (head % encoding + u''.join(body) + tail).encode(encoding)
+        try:
+            list(iterRecordBytes(StringIO(data), 'item', chunk_size=64))
+            scanned = True
+        except UnscannableXMLError:
+            scanned = False
+        parsed = [item.name for item in iterParsedRecords(
+            StringIO(data), projection)]
+        streamed = [item.name for item in iterRecords(
+            StringIO(data), projection, chunk_size=64)]
+        if parsed != expected or streamed != expected \
+                or scanned == unscannable:
+            success = False
+    return success